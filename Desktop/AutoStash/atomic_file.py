@@ -0,0 +1,28 @@
+import os
+import json
+import tempfile
+
+
+def atomic_write_json(path, data, fsync=False, **options):
+    """Replace path with data as JSON so readers see the old file or the new one, never a partial write
+
+    The directory is created if needed, and the temporary file is removed
+    if anything fails. fsync makes the content durable before the rename.
+    options are passed to json.dump (e.g. indent).
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, **options)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
@@ -3,11 +3,15 @@ from tkinter import ttk, filedialog, messagebox
 import keyring
 import datetime
 import os
+import queue
+import threading
 import subprocess
 
 from github_integration import GitHubManager
 from backup_logic import BackupManager
 from config_manager import ConfigManager
+from progress import BackupCancelled, format_event
+from history_store import format_run
 import scheduler
 
 class AutoStashGUI(tk.Tk):
@@ -32,6 +36,8 @@ class AutoStashGUI(tk.Tk):
         self.config = ConfigManager()
         self.github = GitHubManager()
         self.backup = BackupManager()
+        self.events = queue.Queue()
+        self.worker = None
 
         os.makedirs(os.path.expanduser("~/.autostash"), exist_ok=True)
 
@@ -74,8 +80,10 @@ class AutoStashGUI(tk.Tk):
         self.options_frame.pack(fill="x", padx=18, pady=10, ipady=8)
         self.system_files_var = tk.BooleanVar(value=False)
         self.encrypt_var = tk.BooleanVar(value=False)
+        self.pack_var = tk.BooleanVar(value=False)
         tk.Checkbutton(self.options_frame, text="Backup system files (/etc)", variable=self.system_files_var, bg="#f7f7f7", font=("Arial", 10)).pack(anchor="w", padx=10, pady=3)
         tk.Checkbutton(self.options_frame, text="Encrypt backup with GPG", variable=self.encrypt_var, bg="#f7f7f7", font=("Arial", 10)).pack(anchor="w", padx=10, pady=3)
+        tk.Checkbutton(self.options_frame, text="Pack small files together", variable=self.pack_var, bg="#f7f7f7", font=("Arial", 10)).pack(anchor="w", padx=10, pady=3)
 
         # Schedule Frame
         self.schedule_frame = ttk.LabelFrame(self, text="Backup Schedule")
@@ -83,7 +91,7 @@ class AutoStashGUI(tk.Tk):
         schedule_inner = tk.Frame(self.schedule_frame, bg="#f7f7f7")
         schedule_inner.pack(fill="x", padx=10, pady=5)
         tk.Label(schedule_inner, text="Frequency:", bg="#f7f7f7", font=("Arial", 10)).pack(side="left")
-        self.schedule_combobox = ttk.Combobox(schedule_inner, values=["Daily", "Weekly"], width=14, state="readonly")
+        self.schedule_combobox = ttk.Combobox(schedule_inner, values=["Daily", "Weekly", "Continuous"], width=14, state="readonly")
         self.schedule_combobox.current(0)
         self.schedule_combobox.pack(side="left", padx=(8, 8))
         ttk.Button(schedule_inner, text="Set Schedule", command=self.set_schedule).pack(side="left")
@@ -107,7 +115,7 @@ class AutoStashGUI(tk.Tk):
         timeline_inner = tk.Frame(self.timeline_frame, bg="#f7f7f7")
         timeline_inner.pack(fill="x", padx=0, pady=0)
         self.timeline_scrollbar = tk.Scrollbar(timeline_inner, orient="vertical")
-        self.timeline_list = tk.Listbox(timeline_inner, width=110, height=5, font=("Arial", 10), yscrollcommand=self.timeline_scrollbar.set)
+        self.timeline_list = tk.Listbox(timeline_inner, width=110, height=5, font=("Arial", 10), yscrollcommand=self.on_timeline_scroll)
         self.timeline_scrollbar.config(command=self.timeline_list.yview)
         self.timeline_list.pack(side="left", fill="both", expand=True, padx=(10,0), pady=5)
         self.timeline_scrollbar.pack(side="left", fill="y", pady=5)
@@ -115,10 +123,14 @@ class AutoStashGUI(tk.Tk):
         # Action Buttons (Modern style)
         action_frame = tk.Frame(self, bg="#f7f7f7")
         action_frame.pack(pady=18)
-        run_btn = tk.Button(action_frame, text="Run Backup", bg="#27ae60", fg="white", font=("Arial", 12, "bold"), width=18, relief="flat", command=self.run_backup, activebackground="#219150")
-        run_btn.pack(side="left", padx=22)
-        restore_btn = tk.Button(action_frame, text="Restore Backup", bg="#2980b9", fg="white", font=("Arial", 12, "bold"), width=18, relief="flat", command=self.restore_backup, activebackground="#2471a3")
-        restore_btn.pack(side="left", padx=22)
+        self.run_btn = tk.Button(action_frame, text="Run Backup", bg="#27ae60", fg="white", font=("Arial", 12, "bold"), width=18, relief="flat", command=self.run_backup, activebackground="#219150")
+        self.run_btn.pack(side="left", padx=22)
+        self.preview_btn = tk.Button(action_frame, text="Preview", bg="#8e44ad", fg="white", font=("Arial", 12, "bold"), width=10, relief="flat", command=self.preview_backup, activebackground="#7d3c98")
+        self.preview_btn.pack(side="left", padx=22)
+        self.restore_btn = tk.Button(action_frame, text="Restore Backup", bg="#2980b9", fg="white", font=("Arial", 12, "bold"), width=18, relief="flat", command=self.restore_backup, activebackground="#2471a3")
+        self.restore_btn.pack(side="left", padx=22)
+        self.cancel_btn = tk.Button(action_frame, text="Cancel", bg="#e74c3c", fg="white", font=("Arial", 12, "bold"), width=10, relief="flat", command=self.cancel_job, activebackground="#c0392b", state="disabled")
+        self.cancel_btn.pack(side="left", padx=22)
 
         # Status Bar
         self.status_var = tk.StringVar()
@@ -153,14 +165,26 @@ class AutoStashGUI(tk.Tk):
         self.after(3600000, self.check_backup_status)
 
     def load_backup_timeline(self):
+        """Show the newest runs; older pages are fetched as the list is scrolled"""
         self.timeline_list.delete(0, tk.END)
-        history_path = os.path.expanduser("~/.autostash/backup_history")
-        if os.path.exists(history_path):
-            with open(history_path, "r") as f:
-                lines = [line.strip() for line in f if line.strip()]
-            # Show latest entries at the top
-            for line in reversed(lines):
-                self.timeline_list.insert(tk.END, line)
+        self.timeline_last_id = None
+        self.timeline_exhausted = False
+        self.load_timeline_page()
+
+    def load_timeline_page(self, page_size=50):
+        if self.timeline_exhausted:
+            return
+        runs = self.backup.history.page(before_id=self.timeline_last_id, limit=page_size)
+        for run in runs:
+            self.timeline_list.insert(tk.END, format_run(run))
+        if runs:
+            self.timeline_last_id = runs[-1]["id"]
+        self.timeline_exhausted = len(runs) < page_size
+
+    def on_timeline_scroll(self, first, last):
+        self.timeline_scrollbar.set(first, last)
+        if float(last) >= 0.9:
+            self.load_timeline_page()
 
     def add_folder(self):
         folder = filedialog.askdirectory()
@@ -188,15 +212,48 @@ class AutoStashGUI(tk.Tk):
             keyring.set_password("autostash", "github_token", token)
         try:
             self.github.authenticate(token)
-            repos = self.github.get_repos()
-            self.repo_combobox['values'] = repos
-            if repos:
-                self.repo_combobox.current(0)
-            self.github_status.config(text="Connected", fg="#27ae60")
-            self.status_var.set("GitHub connected. Select a repository.")
         except Exception as e:
             self.github_status.config(text="Failed to connect", fg="#c0392b")
             self.status_var.set(f"GitHub error: {e}")
+            return
+        self.repo_combobox['values'] = []
+        self.github_status.config(text="Connecting...", fg="#7f8c8d")
+        repo_events = queue.Queue()
+
+        def worker():
+            # Pages arrive on this thread; the Tk thread picks them up in poll_repos
+            try:
+                self.github.get_repos(on_page=lambda names: repo_events.put(("page", names)))
+                repo_events.put(("done", None))
+            except Exception as e:
+                repo_events.put(("error", e))
+
+        threading.Thread(target=worker, daemon=True).start()
+        self.after(50, self.poll_repos, repo_events)
+
+    def poll_repos(self, repo_events):
+        try:
+            while True:
+                kind, payload = repo_events.get_nowait()
+                if kind == "page":
+                    first = not self.repo_combobox['values']
+                    self.repo_combobox['values'] = list(self.repo_combobox['values']) + payload
+                    if first and payload:
+                        self.repo_combobox.current(0)
+                        self.github_status.config(text="Connected", fg="#27ae60")
+                        self.status_var.set("GitHub connected. Select a repository.")
+                elif kind == "done":
+                    self.github_status.config(text="Connected", fg="#27ae60")
+                    if not self.repo_combobox['values']:
+                        self.status_var.set("GitHub connected, but no repositories were found.")
+                    return
+                else:
+                    self.github_status.config(text="Failed to connect", fg="#c0392b")
+                    self.status_var.set(f"GitHub error: {payload}")
+                    return
+        except queue.Empty:
+            pass
+        self.after(50, self.poll_repos, repo_events)
 
     def run_backup(self):
         folders = self.folder_list.get(0, tk.END)
@@ -204,51 +261,156 @@ class AutoStashGUI(tk.Tk):
         if not folders or not repo:
             messagebox.showerror("Missing Info", "Please select at least one folder and a GitHub repository.")
             return
-        self.status_var.set("Running backup...")
-        self.update_idletasks()
-        self.progress_var.set(0)
-        self.progress_bar.update()
+        self.config.save_repo(repo)
+        backup_system = self.system_files_var.get()
+        encrypt = self.encrypt_var.get()
+        # Scheduled runs and the daemon read the mode from the config, so they must agree with this run
+        self.config.save_encryption(encrypt)
+        recipient = self.config.get_encryption()["recipient"]
+        self.config.save_packing(self.pack_var.get())
+        packing = self.config.get_packing()
+        self.backup.packing = packing["enabled"]
+        self.backup.pack_threshold = packing["threshold"]
+        rules = self.config.get_all_rules(folders)
+        system_paths = self.config.get_system_paths()
+        # The same repositories the CLI and the daemon push to: the primary, then any mirrors
+        repos = [repo] + self.config.get_mirrors()
+        self.start_job("backup", "Running backup...", lambda progress: self.backup.run(
+            folders, repos,
+            backup_system=backup_system,
+            progress_callback=progress,
+            rules=rules,
+            system_paths=system_paths,
+            encrypt=encrypt,
+            gpg_recipient=recipient
+        ))
 
-        def progress_callback(percent, *args):  # <-- FIXED: accepts extra args
-            self.progress_var.set(percent)
-            self.progress_bar.update()
-
-        try:
-            backup_system = self.system_files_var.get()
-            # encrypt = self.encrypt_var.get()  # encryption not used
-            self.backup.run(
-                folders, repo,
-                backup_system=backup_system,
-                # encrypt=encrypt,  # encryption not used
-                progress_callback=progress_callback
-            )
-            self.status_var.set("Backup completed successfully!")
-            messagebox.showinfo("Backup", "Backup completed successfully!")
-            self.check_backup_status()
-            self.progress_var.set(100)
-            self.load_backup_timeline()
-        except Exception as e:
-            self.status_var.set(f"Backup failed: {e}")
-            messagebox.showerror("Backup Failed", str(e))
-            self.progress_var.set(0)
+    def preview_backup(self):
+        """Show what Run Backup would change and how long it should take, without backing anything up"""
+        folders = self.folder_list.get(0, tk.END)
+        repo = self.repo_combobox.get()
+        if not folders or not repo:
+            messagebox.showerror("Missing Info", "Please select at least one folder and a GitHub repository.")
+            return
+        rules = self.config.get_all_rules(folders)
+        encrypt = self.encrypt_var.get()
+        self.start_job("plan", "Planning backup...", lambda progress: self.backup.plan(
+            folders, repo, rules=rules, encrypt=encrypt
+        ))
 
     def restore_backup(self):
         repo = self.repo_combobox.get()
         if not repo:
             messagebox.showerror("Missing Repo", "Please select a GitHub repository first.")
             return
-        self.status_var.set("Restoring backup...")
-        self.update_idletasks()
+        self.start_job("restore", "Restoring backup...", lambda progress: self.backup.restore(
+            repo, progress_callback=progress
+        ))
+
+    def start_job(self, kind, status, job):
+        """Run a backup or restore on a worker thread so the window stays responsive"""
+        if self.worker and self.worker.is_alive():
+            return
+        self.status_var.set(status)
+        self.progress_var.set(0)
+        self.set_busy(True)
+
+        def progress_callback(percent, message, event=None):
+            # Called on the worker thread: hand the update to the Tk thread via the queue
+            self.events.put(("progress", percent, message, event))
+
+        def worker():
+            try:
+                self.events.put(("done", kind, job(progress_callback)))
+            except BackupCancelled:
+                self.events.put(("cancelled", kind, None))
+            except Exception as e:
+                self.events.put(("error", kind, e))
+
+        self.worker = threading.Thread(target=worker, daemon=True)
+        self.worker.start()
+        self.after(100, self.poll_events)
+
+    def poll_events(self):
+        finished = False
         try:
-            restore_path = self.backup.restore(repo)
+            while True:
+                item = self.events.get_nowait()
+                if item[0] == "progress":
+                    percent, message, event = item[1:]
+                    self.progress_var.set(percent)
+                    if event:
+                        message = f"{message} ({format_event(event)})"
+                    self.status_var.set(message)
+                else:
+                    self.finish_job(*item)
+                    finished = True
+        except queue.Empty:
+            pass
+        if not finished:
+            self.after(100, self.poll_events)
+
+    def finish_job(self, outcome, kind, result):
+        self.set_busy(False)
+        if outcome == "cancelled":
+            self.status_var.set(f"{kind.capitalize()} cancelled.")
+            self.progress_var.set(0)
+        elif outcome == "error":
+            self.status_var.set(f"{kind.capitalize()} failed: {result}")
+            messagebox.showerror(f"{kind.capitalize()} Failed", str(result))
+            self.progress_var.set(0)
+        elif kind == "plan":
+            self.status_var.set(result.summary())
+            self.progress_var.set(0)
+            if result.is_empty():
+                messagebox.showinfo("Backup Preview", "Nothing has changed since the last backup.")
+                return
+            details = "\n".join(result.lines(limit=10))
+            reason = self.config.get_defer_policy().oversized(result)
+            if reason:
+                details += f"\n\nScheduled runs would defer this backup: {reason}."
+            if messagebox.askyesno("Backup Preview", f"{result.summary()}\n\n{details}\n\nRun the backup now?"):
+                self.run_backup()
+        elif kind == "backup":
+            self.status_var.set("Backup completed successfully!")
+            self.progress_var.set(100)
+            messagebox.showinfo("Backup", "Backup completed successfully!")
+            self.check_backup_status()
+            self.load_backup_timeline()
+        else:
             self.status_var.set("Restore completed successfully!")
-            messagebox.showinfo("Restore", f"Restore completed successfully to {restore_path}!")
-        except Exception as e:
-            self.status_var.set(f"Restore failed: {e}")
-            messagebox.showerror("Restore Failed", str(e))
+            self.progress_var.set(100)
+            messagebox.showinfo("Restore", f"Restore completed successfully to {result}!")
+
+    def cancel_job(self):
+        if self.worker and self.worker.is_alive():
+            self.backup.cancel()
+            self.status_var.set("Cancelling at the next safe point...")
+            self.cancel_btn.config(state="disabled")
+
+    def set_busy(self, busy):
+        state = "disabled" if busy else "normal"
+        self.run_btn.config(state=state)
+        self.preview_btn.config(state=state)
+        self.restore_btn.config(state=state)
+        self.cancel_btn.config(state="normal" if busy else "disabled")
 
     def set_schedule(self):
         freq = self.schedule_combobox.get()
+        repo = self.repo_combobox.get()
+        if repo:
+            # The scheduled job and the daemon read the repository from the config
+            self.config.save_repo(repo)
+        if freq == "Continuous":
+            try:
+                scheduler.setup_daemon(os.path.join(os.path.dirname(os.path.abspath(__file__)), "daemon.py"))
+                self._schedule_maintenance()
+                self.status_var.set("Continuous backups enabled.")
+                messagebox.showinfo("Schedule", "Changes will be backed up continuously.")
+            except Exception as e:
+                self.status_var.set(f"Schedule failed: {e}")
+                messagebox.showerror("Schedule Failed", str(e))
+            return
         if freq == "Daily":
             interval = "0 2 * * *"
         elif freq == "Weekly":
@@ -256,19 +418,29 @@ class AutoStashGUI(tk.Tk):
         else:
             interval = "0 2 * * *"
         try:
-            scheduler.setup_schedule(interval, os.path.abspath(__file__))
+            scheduler.setup_schedule(interval)
+            self._schedule_maintenance()
             self.status_var.set(f"Scheduled backups: {freq.lower()}.")
             messagebox.showinfo("Schedule", f"Backups scheduled: {freq}.")
         except Exception as e:
             self.status_var.set(f"Schedule failed: {e}")
             messagebox.showerror("Schedule Failed", str(e))
 
+    def _schedule_maintenance(self):
+        """Weekly retention and repacking go with any schedule; failing to set them up is not fatal"""
+        try:
+            scheduler.setup_maintenance()
+        except Exception as e:
+            self.status_var.set(f"Repository maintenance not scheduled: {e}")
+
     def load_saved_settings(self):
         folders = self.config.get_folders()
         for folder in folders:
             self.folder_list.insert(tk.END, folder)
             self.folder_entry.delete(0, tk.END)
             self.folder_entry.insert(0, folder)
+        self.encrypt_var.set(self.config.get_encryption()["enabled"])
+        self.pack_var.set(self.config.get_packing()["enabled"])
 
 if __name__ == "__main__":
     app = AutoStashGUI()
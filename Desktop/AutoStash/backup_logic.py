@@ -1,17 +1,108 @@
 import os
 import shutil
-import requests
-import hashlib
 import logging
 import datetime
 import subprocess
-from git import Repo, GitCommandError
+import time
+import json
+import cProfile
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from git import Repo, GitCommandError, RemoteProgress
+from atomic_file import atomic_write_json
+from file_index import FileIndex
+from sync_engine import SyncStats, diff_manifests, apply_plan, copy_writer, plan_bytes
+from chunk_store import ChunkStore, CHUNK_THRESHOLD, MANIFEST_SUFFIX, STORE_DIR, is_manifest
+from progress import ProgressTracker, BackupCancelled
+from git_ingest import DirectIngest, file_mode
+from history_store import HistoryStore
+from metrics import RunMetrics, default_prom_path
+from folder_rules import FolderRules
+from system_capture import SystemCapture
+from run_coordinator import RunCoordinator
+from throttle import ResourceLimits
+from encryption import ENCRYPTED_SUFFIX, KEY_FILE, is_encrypted
+from pack_store import PACK_NAME, PACK_INDEX, PACK_THRESHOLD, apply_packed, is_pack, is_pack_index, read_index, \
+    unpack_tree
+from verify import write_manifest, read_manifest, discard_manifest, replace_subtree
+from planner import Planner
+
+# A mirror that takes longer than this is abandoned for the run and caught up next time
+MIRROR_PUSH_TIMEOUT = 15 * 60
+# Each commit (and so each push) carries at most this much changed data, well under server pack limits
+BATCH_BYTES = 512 * 1024 * 1024
+BATCH_FILES = 20000
+PUSH_CHECKPOINT = os.path.expanduser("~/.autostash/push_checkpoint.json")
+
+
+class _GitProgress(RemoteProgress):
+    """Feed git's object transfer progress into a ProgressTracker"""
+
+    def __init__(self, tracker, nbytes=None):
+        super().__init__()
+        self.tracker = tracker
+        self.nbytes = nbytes
+        self.credited = 0
+
+    def update(self, op_code, cur_count, max_count=None, message=''):
+        if not max_count or not op_code & (self.WRITING | self.RECEIVING):
+            return
+        if self.nbytes is None:
+            # Restores have no byte total up front; report git's own figures instead
+            if self.tracker.callback:
+                self.tracker.callback(cur_count / max_count * 100, f"Downloading... {message}".strip(), None)
+            return
+        target = int(self.nbytes * cur_count / max_count)
+        if target > self.credited:
+            # Runs on GitPython's reader thread, so never raise a cancellation here
+            self.tracker.advance(target - self.credited, safe_point=False)
+            self.credited = target
+
 
 class BackupManager:
-    def __init__(self):
+    def __init__(self, workers=None, use_processes=False, chunking=False, chunk_threshold=CHUNK_THRESHOLD,
+                 direct_ingest=False, profile_path=None, batch_bytes=BATCH_BYTES, batch_files=BATCH_FILES,
+                 limits=None, packing=False, pack_threshold=PACK_THRESHOLD):
         self.repo_path = os.path.expanduser("~/.autostash_repo")
+        self.bare_path = os.path.expanduser("~/.autostash_repo.git")
+        self.direct_ingest = direct_ingest
         self.repo = None
+        self.index_path = os.path.expanduser("~/.autostash_repo.index")
+        self.index = None
+        self.sync_stats = SyncStats()
+        self.workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.chunking = chunking
+        self.chunk_threshold = chunk_threshold
+        self.chunk_store = None
+        # Small files go into per-directory packs (see pack_store.py)
+        self.packing = packing
+        self.pack_threshold = pack_threshold
+        self.batch_bytes = batch_bytes
+        self.batch_files = batch_files
+        self.cancel_event = threading.Event()
+        # Only one run at a time per user; limits apply to the thread doing the run
+        self.coordinator = RunCoordinator()
+        self.limits = limits or ResourceLimits()
+        self.joined = False
+        self.encrypt = False
+        self.gpg_recipient = None
+        self.cipher = None
+        self.history = HistoryStore()
+        self.last_commit = None
+        self.primary = None
+        self.rules = {}
+        self.system_paths = None
+        self.mirrors = []
+        self.push_results = {}
+        self.scanned = (0, 0)
+        self.metrics = RunMetrics()
+        # Opt-in: dump a cProfile of each run here (also settable via AUTOSTASH_PROFILE)
+        self.profile_path = profile_path or os.environ.get("AUTOSTASH_PROFILE")
         self.log_path = "/var/log/autostash"
+        self.log_dir = self.log_path
         self._setup_logging()
 
     def _setup_logging(self):
@@ -33,152 +124,911 @@ class BackupManager:
             os.makedirs(os.path.expanduser("~/.autostash/logs"), exist_ok=True)
             self.logger = logging.getLogger('autostash')
             self.logger.setLevel(logging.INFO)
-            handler = logging.FileHandler(os.path.expanduser("~/.autostash/logs/backup.log"))
+            self.log_dir = os.path.expanduser("~/.autostash/logs")
+            handler = logging.FileHandler(os.path.join(self.log_dir, "backup.log"))
             formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
             handler.setFormatter(formatter)
             self.logger.addHandler(handler)
             print(f"Using fallback log location due to: {str(e)}")
 
-    def run(self, folders, repo_name, backup_system=False, progress_callback=None):
+    def cancel(self):
+        """Ask a running backup or restore to stop at its next safe point"""
+        self.cancel_event.set()
+
+    def run(self, folders, repo_name, backup_system=False, progress_callback=None, touched=None, rules=None,
+            system_paths=None, encrypt=False, gpg_recipient=None):
+        """Back up folders to repo_name
+
+        repo_name may also be a list of repositories. The first is the primary
+        that the staging repo tracks; the same commit is pushed to the others
+        as mirrors, all in parallel. A failed mirror does not fail the run and
+        is caught up by the next one; per-remote outcomes are left in
+        self.push_results.
+
+        touched optionally maps each folder to the relative paths known to have
+        changed (files or directories, "" for the whole folder); only those are
+        synced. It is used by the watch daemon and ignored in direct-ingest
+        mode, where the stat-based scan is already cheap.
+
+        rules maps folders to FolderRules (see ConfigManager.get_all_rules);
+        folders without an entry get the default excludes. With backup_system,
+        the files and trees in system_paths (default: a few files in /etc) are
+        captured through the privileged helper in system_capture.
+
+        With encrypt, files are stored compressed and encrypted (see
+        encryption.py) under a data key protected by GPG, encrypted to
+        gpg_recipient or else with a passphrase. Files stored in the other
+        form are rewritten, so switching modes converts the staging tree.
+
+        Runs are coordinated through RunCoordinator: if another run holds the
+        lock this call waits behind it, or joins an already queued run that
+        covers the same folders and returns once that run is done (with
+        self.joined set).
+        """
+        self.system_paths = system_paths
+        self.encrypt = encrypt
+        self.gpg_recipient = gpg_recipient
+        rules = rules or {}
+        self.rules = {folder: rules.get(folder) or FolderRules() for folder in folders}
+        if touched is not None:
+            for folder in touched:
+                self.rules.setdefault(folder, rules.get(folder) or FolderRules())
+        repos = [repo_name] if isinstance(repo_name, str) else list(repo_name)
+        repo_name, self.mirrors = repos[0], repos[1:]
+        self.primary = repo_name
+        self.push_results = {}
+        self.cancel_event.clear()
+        progress = ProgressTracker(progress_callback, self.cancel_event)
+        request = {"kind": "backup", "repos": repos, "folders": sorted(folders if touched is None else touched),
+                   "system": bool(backup_system), "touched": touched is not None}
+
+        def waiting(message):
+            self.logger.info(message)
+            if progress_callback:
+                progress_callback(0, message, None)
+
         try:
-            self.logger.info(f"Starting backup to {repo_name}")
-            steps = len(folders)
-            if backup_system:
-                steps += 1
-            completed = 0
+            with self.coordinator.slot(request, waiting, self.cancel_event) as slot:
+                self.joined = slot.joined
+                if slot.joined:
+                    if slot.result["outcome"] != "success":
+                        raise Exception(f"The backup run this request joined failed: {slot.result['error']}")
+                    self.logger.info("Joined a queued backup run that covered this request")
+                    progress.finish("Backup complete")
+                    return
+                self.limits.apply_priority(self.logger)
+                self._run_exclusive(folders, repo_name, backup_system, progress, touched, slot)
+        except InterruptedError:
+            raise BackupCancelled("Cancelled while waiting for another backup run")
 
-            if not self._repo_exists(repo_name):
-                raise Exception(f"Repository {repo_name} doesn't exist or no access")
+    def _run_exclusive(self, folders, repo_name, backup_system, progress, touched, slot):
+        """The backup itself, run while holding the coordinator's run lock"""
+        started = time.time()
+        self.last_commit = None
+        self.scanned = (0, 0)
+        self.metrics = RunMetrics(os.path.join(self.log_dir, "metrics.jsonl"), default_prom_path())
+        profiler = cProfile.Profile() if self.profile_path else None
+        if profiler:
+            profiler.enable()
+        try:
+            self.logger.info(f"Starting backup to {repo_name}")
+            self.index = FileIndex(self.index_path, self.workers, self.use_processes,
+                                   read_limiter=self.limits.read_limiter())
+            self.sync_stats = SyncStats()
+            self.chunk_store = ChunkStore(self.repo_path)
 
-            self._prepare_repo(repo_name)
+            progress.set_phase("prepare", "Checking repository...")
+            with self.metrics.span("repo_exists"):
+                if not self._repo_exists(repo_name):
+                    raise Exception(f"Repository {repo_name} doesn't exist or no access")
 
-            for folder in folders:
-                if progress_callback:
-                    progress_callback(completed / steps * 100, f"Backing up {os.path.basename(folder)}...")
-                self._sync_folder(folder)
-                completed += 1
-
-            if backup_system:
-                if progress_callback:
-                    progress_callback(completed / steps * 100, "Backing up system files...")
-                self._backup_system_files()
-                completed += 1
-
-            self._git_commit_push()
+            if self.direct_ingest:
+                if self.encrypt:
+                    raise Exception("Encrypted backups are not supported in direct-ingest mode")
+                self._run_direct(repo_name, folders, backup_system, progress)
+            else:
+                with self.metrics.span("prepare_repo"):
+                    self._prepare_repo(repo_name)
+                if self.encrypt:
+                    self._prepare_cipher()
+                if touched is not None:
+                    self._run_touched(touched, progress)
+                else:
+                    self._run_staged(folders, backup_system, progress)
+            with self.metrics.span("save_index"):
+                self.index.save()
+            self.logger.info(f"Sync summary: {self.sync_stats}")
+            if self.chunking:
+                self.logger.info(f"Chunk store: {self.chunk_store.new_chunks} new chunks, "
+                                 f"{self.chunk_store.new_bytes} new bytes")
             self._record_backup_time()
-            self._append_backup_history()
-            
-            if progress_callback:
-                progress_callback(100, "Backup complete")
+            failed = [name for name, result in self.push_results.items() if result["status"] == "failed"]
+            self._record_run(repo_name, started, "success",
+                             f"Mirror push failed: {', '.join(failed)}" if failed else None)
+
+            progress.finish("Backup complete")
 
+        except BackupCancelled:
+            self.logger.warning("Backup cancelled before commit; staging changes will be picked up next run")
+            self._record_run(repo_name, started, "cancelled")
+            slot.finish("cancelled")
+            raise
         except Exception as e:
             self.logger.error(f"Backup failed: {str(e)}")
+            self._record_run(repo_name, started, "failed", str(e))
+            slot.finish("failed", str(e))
             raise
+        finally:
+            if self.cipher:
+                self.cipher.close()
+                self.cipher = None
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+                self.logger.info(f"Wrote profile to {self.profile_path}")
+
+    def _run_staged(self, folders, backup_system, progress):
+        """Mirror the folders into the staging checkout, then commit and push it"""
+        progress.set_phase("scan", "Scanning folders...")
+        with self.metrics.span("scan") as span:
+            manifests = self._scan_folders(folders, progress)
+            self._count_scanned(folders, manifests)
+            span.set(**self.index.last_scan)
+
+        with self.metrics.span("plan") as span:
+            plans = {folder: self._plan_folder(folder, manifests) for folder in folders}
+            copy_bytes = sum(plan_bytes(plan, folder) for folder, (plan, locations) in plans.items())
+            span.set(bytes_to_copy=copy_bytes)
+        # Push volume is not known until git packs the objects; estimate it as what we copy
+        progress.add_work(copy_bytes * 2)
+
+        with self.metrics.span("sync"):
+            for folder in folders:
+                progress.set_phase("copy", f"Backing up {os.path.basename(folder)}...")
+                with self.metrics.span("sync_folder", folder=folder) as span:
+                    stats = self._sync_folder(folder, manifests, plans[folder], progress)
+                    span.set(files_added=stats.added, files_modified=stats.modified,
+                             files_deleted=stats.deleted, files_renamed=stats.renamed,
+                             bytes_copied=stats.bytes_copied, copy_methods=stats.copy_methods)
+        with self.metrics.span("record_manifests"):
+            for folder in folders:
+                self._record_manifest(folder, manifests[folder])
+
+        if backup_system:
+            progress.set_phase("copy", "Backing up system files...")
+            with self.metrics.span("system_files"):
+                if self.cipher:
+                    # Capture outside the repository, then store the copies encrypted like any folder
+                    capture_dir = os.path.expanduser("~/.autostash/system_config")
+                    if self._backup_system_files(capture_dir) is not None:
+                        self._sync_folder(capture_dir, progress=progress)
+                else:
+                    self._backup_system_files()
 
-    def restore(self, repo_name):
+        progress.set_phase("commit", "Committing changes...")
+        self._git_commit_push(progress)
+
+    def _run_touched(self, touched, progress):
+        """Sync only the given paths of each folder, then commit and push"""
+        progress.set_phase("copy", "Syncing changed paths...")
+        with self.metrics.span("sync_paths") as span:
+            for folder, rels in touched.items():
+                name = os.path.basename(folder)
+                recorded = read_manifest(self.repo_path, name, self.cipher)
+                stats = self._sync_paths(folder, rels, progress, recorded)
+                self.sync_stats.merge(stats)
+                if recorded is not None:
+                    write_manifest(self.repo_path, name, recorded, self.cipher)
+                else:
+                    # Only a full scan can record the whole folder; until then it has no manifest
+                    discard_manifest(self.repo_path, name)
+            span.set(paths=sum(len(rels) for rels in touched.values()),
+                     bytes_copied=self.sync_stats.bytes_copied)
+        self.scanned = (sum(len(rels) for rels in touched.values()), self.sync_stats.bytes_copied)
+        progress.set_phase("commit", "Committing changes...")
+        self._git_commit_push(progress)
+
+    def _run_direct(self, repo_name, folders, backup_system, progress):
+        """Hash changed files straight into a bare repository and commit from there"""
+        if self.chunking:
+            self.logger.warning("Chunking is not used in direct-ingest mode; files are stored as plain blobs")
+        if self.packing:
+            self.logger.warning("Packing is not used in direct-ingest mode; files are stored as plain blobs")
+        ingest = DirectIngest(self.bare_path, self.workers, self.index.read_limiter,
+                              self.limits.push_wrapper(self.logger))
+        with self.metrics.span("prepare_repo"):
+            ingest.ensure_repo(self._repo_url(repo_name))
+            branch = ingest.branch()
+            parent = ingest.head(branch)
+
+        progress.set_phase("scan", "Scanning folders...")
+        with self.metrics.span("scan") as span:
+            manifests = self.index.scan_trees(list(folders), progress, hasher=ingest.hash_objects,
+                                              rules=self.rules)
+            self._count_scanned(folders, manifests)
+            span.set(**self.index.last_scan)
+        sources = {}
+        for folder in folders:
+            prefix = os.path.basename(folder)
+            for rel, digest in manifests[folder].items():
+                sources[f"{prefix}/{rel}"] = (os.path.join(folder, rel), digest)
+        prefixes = [os.path.basename(folder) for folder in folders]
+        if backup_system:
+            prefixes.append("system_config")
+            with self.metrics.span("system_files"):
+                capture_dir = os.path.expanduser("~/.autostash/system_config")
+                self._backup_system_files(capture_dir)
+                captured = self.index.scan_trees([capture_dir])[capture_dir]
+            for rel, digest in captured.items():
+                sources[f"system_config/{rel}"] = (os.path.join(capture_dir, rel), digest)
+
+        with self.metrics.span("plan") as span:
+            tree = ingest.tree_entries(parent, prefixes)
+            changes = {}
+            for path, (src, digest) in sources.items():
+                entry = (file_mode(os.stat(src)), digest)
+                if tree.get(path) != entry:
+                    changes[path] = entry
+            deletes = [path for path in tree if path not in sources]
+
+            # Files whose digest came from the index may never have been written to this object store
+            missing = ingest.missing_objects({sha for mode, sha in changes.values()})
+            if missing:
+                paths = [sources[path][0] for path, (mode, sha) in changes.items() if sha in missing]
+                ingest.hash_objects(paths)
+            span.set(files_changed=len(changes), files_deleted=len(deletes), blobs_rewritten=len(missing))
+
+        self.sync_stats.added = sum(1 for path in changes if path not in tree)
+        self.sync_stats.modified = len(changes) - self.sync_stats.added
+        self.sync_stats.deleted = len(deletes)
+        self.sync_stats.bytes_copied = sum(os.path.getsize(sources[path][0]) for path in changes)
+        progress.add_work(self.sync_stats.bytes_copied)
+
+        progress.set_phase("commit", "Committing changes...")
+        # Batches already pushed by an interrupted run are on origin now, so they drop out of changes;
+        # their blobs are still in the object store, so nothing is re-hashed either
+        sizes = ((path, os.path.getsize(sources[path][0])) for path in sorted(changes))
+        batches = list(_size_batches(sizes, self.batch_bytes, self.batch_files)) or ([([], 0)] if deletes else [])
+        head = parent
+        for number, (paths, nbytes) in enumerate(batches, 1):
+            if number > 1:
+                progress.set_phase("commit", f"Committing batch {number} of {len(batches)}...")
+            message = "AutoStash Backup" if len(batches) == 1 else f"AutoStash Backup (batch {number}/{len(batches)})"
+            with self.metrics.span("commit", batch=number, files=len(paths), bytes=nbytes):
+                head = self.last_commit = ingest.commit(branch, head, {path: changes[path] for path in paths},
+                                                        deletes if number == 1 else [], message)
+            self._push_direct(ingest, branch, head, push_origin=True, progress=progress)
+            progress.advance(nbytes, safe_point=False)
+        if not batches:
+            self._push_direct(ingest, branch, parent, push_origin=False, progress=progress)
+
+    def _push_direct(self, ingest, branch, head, push_origin, progress):
+        """Push branch from the bare repository to origin and to any mirror that is behind"""
+        # The fetch in ensure_repo reset the local branch to origin's, so origin only needs a push after a commit
+        pushes = [(self.primary, lambda: ingest.push(branch))] if push_origin else []
+        for mirror in self.mirrors:
+            remote = _mirror_remote(mirror)
+            ingest.set_remote(remote, self._repo_url(mirror))
+            if head and ingest.remote_head(remote, branch) != head:
+                pushes.append((mirror, lambda remote=remote: ingest.push(branch, remote, MIRROR_PUSH_TIMEOUT)))
+        if pushes:
+            progress.set_phase("push", "Pushing to GitHub...", safe_point=False)
+            self._fan_out(self.primary, pushes)
+
+    def plan(self, folders, repo_name, rules=None, encrypt=False):
+        """Predict what run() would do, from stat data and cached digests only (see planner.py)
+
+        Nothing is hashed, copied or committed and the index is not saved.
+        With encrypt, the folders' manifests are encrypted and the data key is
+        unlocked to read them; if that fails the plan compares against the
+        index's record of the last scan instead.
+        """
+        repo_name = repo_name if isinstance(repo_name, str) else list(repo_name)[0]
+        rules = rules or {}
+        index = FileIndex(self.index_path, self.workers)
+        cipher = None
+        if encrypt and not self.direct_ingest and os.path.exists(os.path.join(self.repo_path, KEY_FILE)):
+            from encryption import FileCipher, load_key
+            try:
+                cipher = FileCipher(load_key(self.repo_path))
+            except Exception as e:
+                self.logger.warning(f"Planning without the backup's manifests: {str(e)}")
+        try:
+            baselines = {folder: self._plan_baseline(folder, index, cipher, encrypt) for folder in folders}
+        finally:
+            if cipher:
+                cipher.close()
+        planner = Planner(index, self.history, self.workers)
+        return planner.plan(repo_name, list(folders), {folder: rules.get(folder) or FolderRules() for folder in folders},
+                            baselines, staged=not self.direct_ingest)
+
+    def _plan_baseline(self, folder, index, cipher, encrypt):
+        """What the last backup stored for folder as ({rel: (digest, size or None)}, where that came from)"""
+        name = os.path.basename(folder)
+        if self.direct_ingest:
+            if not os.path.isdir(self.bare_path):
+                return {}, "none"
+            ingest = DirectIngest(self.bare_path)
+            prefix = name + "/"
+            tree = ingest.tree_entries(ingest.head(ingest.branch()), [name])
+            return {path[len(prefix):]: (sha, None) for path, (mode, sha) in tree.items()}, "last commit"
+        if cipher or not encrypt:
+            manifest = read_manifest(self.repo_path, name, cipher)
+            if manifest is not None:
+                return manifest, "backup manifest"
+        # No manifest yet: the digests the last scan left in the index
+        prefix = os.path.join(folder, "")
+        entries = {path[len(prefix):]: (entry[3], entry[0]) for path, entry in index.entries.items()
+                   if path.startswith(prefix)}
+        return entries, "last scan" if entries else "none"
+
+    def restore(self, repo_name, progress_callback=None, paths=None, commit=None, depth=None,
+                update=False, restore_path=None):
+        """Restore a backup into restore_path (~/autostash_restore by default)
+
+        paths limits the restore to some folders or files through a sparse
+        checkout of a blob-filtered clone, commit picks an older backup, depth
+        makes the clone shallow and update reuses an existing restore directory,
+        fetching only the objects it is missing.
+        """
+        self.cancel_event.clear()
+        progress = ProgressTracker(progress_callback, self.cancel_event)
         try:
             self.logger.info(f"Restoring from {repo_name}")
-            repo_url = f"https://github.com/{repo_name}.git"
-            restore_path = os.path.expanduser("~/autostash_restore")
-            
-            if os.path.exists(restore_path):
-                shutil.rmtree(restore_path)
-                
-            Repo.clone_from(repo_url, restore_path)
+            repo_url = self._repo_url(repo_name)
+            restore_path = restore_path or os.path.expanduser("~/autostash_restore")
+
+            progress.set_phase("prepare", "Preparing restore...")
+            if update and os.path.isdir(os.path.join(restore_path, ".git")):
+                repo = Repo(restore_path)
+                # Checkout only updates tracked files, so clear the ones the last restore unpacked itself
+                self._remove_derived(repo, restore_path)
+                progress.set_phase("fetch", "Fetching new backups...")
+                fetch_options = {"depth": depth} if depth else {}
+                repo.remotes.origin.fetch(progress=_GitProgress(progress), **fetch_options)
+            else:
+                if os.path.exists(restore_path):
+                    shutil.rmtree(restore_path)
+                clone_options = {"no_checkout": True}
+                if paths:
+                    clone_options["filter"] = "blob:none"
+                if depth:
+                    clone_options["depth"] = depth
+                repo = Repo.clone_from(self._transport_url(repo_url), restore_path,
+                                       progress=_GitProgress(progress), **clone_options)
+            with repo.config_writer() as config:
+                config.set_value("checkout", "workers", self.workers)
+
+            target = commit or "origin/HEAD"
+            if commit and not self._has_commit(repo, commit):
+                repo.git.fetch("origin", commit, **({"depth": depth} if depth else {}))
+                target = "FETCH_HEAD"
+
+            progress.set_phase("checkout", "Writing files...")
+            if paths:
+                # Without the data key an encrypted restore would be left as ciphertext
+                patterns = ["/" + KEY_FILE]
+                # A file may be stored chunked or encrypted under a suffixed name
+                for path in paths:
+                    patterns += ["/" + path.strip("/") + suffix for suffix in ("", MANIFEST_SUFFIX, ENCRYPTED_SUFFIX)]
+                # A requested file may be packed, so also check out the pack and index beside it
+                for path in paths:
+                    parent = os.path.dirname(path.strip("/"))
+                    patterns += [f"/{parent}/{PACK_NAME}" if parent else f"/{PACK_NAME}",
+                                 f"/{parent}/{PACK_INDEX}" if parent else f"/{PACK_INDEX}"]
+                repo.git.sparse_checkout("set", "--no-cone", *patterns)
+            elif repo.config_reader().get_value("core", "sparseCheckout", False):
+                repo.git.sparse_checkout("disable")
+            repo.git.checkout("--force", "--detach", target)
+
+            if paths:
+                # Sparse restores only fetch the chunks their manifests point at
+                chunk_patterns = self._chunk_patterns(restore_path)
+                if chunk_patterns:
+                    repo.git.sparse_checkout("add", *chunk_patterns)
+            if os.path.isdir(os.path.join(restore_path, STORE_DIR)):
+                progress.set_phase("reassemble", "Reassembling chunked files...")
+                restored = ChunkStore(restore_path).reassemble_tree(restore_path)
+                # The chunks are only a storage format; the restored tree holds whole files
+                shutil.rmtree(os.path.join(restore_path, STORE_DIR))
+                self.logger.info(f"Reassembled {restored} chunked files")
+            if os.path.exists(os.path.join(restore_path, KEY_FILE)):
+                progress.set_phase("decrypt", "Decrypting files...")
+                from encryption import FileCipher, load_key
+                cipher = FileCipher(load_key(restore_path), self.workers)
+                try:
+                    restored = cipher.decrypt_tree(restore_path)
+                finally:
+                    cipher.close()
+                self.logger.info(f"Decrypted {restored} files")
+            progress.set_phase("unpack", "Unpacking small files...")
+            restored = unpack_tree(restore_path, paths)
+            if restored:
+                self.logger.info(f"Unpacked {restored} packed files")
+            if paths:
+                unmatched = [path for path in paths
+                             if not os.path.lexists(os.path.join(restore_path, path.strip("/")))]
+                if unmatched:
+                    raise Exception(f"Nothing in the backup matches {', '.join(unmatched)}")
+            progress.finish("Restore complete")
             return restore_path
-            
+
+        except BackupCancelled:
+            self.logger.warning("Restore cancelled")
+            raise
         except Exception as e:
             self.logger.error(f"Restore failed: {str(e)}")
             raise Exception(f"Restore failed: {str(e)}")
 
+    def _has_commit(self, repo, commit):
+        try:
+            repo.git.rev_parse("--verify", "-q", f"{commit}^{{commit}}")
+            return True
+        except GitCommandError:
+            return False
+
+    def _remove_derived(self, repo, root):
+        """Delete the files a previous restore wrote from packs, chunk manifests and encrypted files"""
+        try:
+            tracked = repo.git.ls_tree("-r", "-z", "--name-only", "HEAD").split("\0")
+        except GitCommandError:
+            return
+        derived = []
+        for path in filter(None, tracked):
+            if is_pack_index(path):
+                directory = os.path.dirname(path)
+                index = json.loads(repo.git.show(f"HEAD:{path}"))
+                derived += [os.path.join(directory, name) for name in index["files"]]
+            elif is_manifest(path):
+                derived.append(path[:-len(MANIFEST_SUFFIX)])
+            elif is_encrypted(path):
+                derived.append(path[:-len(ENCRYPTED_SUFFIX)])
+        for path in derived:
+            try:
+                os.remove(os.path.join(root, path))
+            except FileNotFoundError:
+                pass
+
+    def _chunk_patterns(self, root):
+        """Sparse-checkout patterns for the chunks referenced by manifests under root"""
+        patterns = set()
+        for dirpath, dirs, files in os.walk(root):
+            for skip in (".git", STORE_DIR):
+                if skip in dirs:
+                    dirs.remove(skip)
+            for name in files:
+                if is_manifest(name):
+                    manifest = ChunkStore.read_manifest(os.path.join(dirpath, name))
+                    for digest, length in manifest["chunks"]:
+                        patterns.add(f"/{STORE_DIR}/{digest[:2]}/{digest[2:]}")
+        return sorted(patterns)
+
     def _record_backup_time(self):
         """Record the time of successful backup"""
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         with open(os.path.expanduser("~/.autostash/last_backup"), "w") as f:
             f.write(timestamp)
 
-    def _append_backup_history(self):
-        """Append backup time to history file"""
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(os.path.expanduser("~/.autostash/backup_history"), "a") as f:
-            f.write(timestamp + "\n")
-
-    def _backup_system_files(self):
-        system_backup_path = os.path.join(self.repo_path, "system_config")
-        os.makedirs(system_backup_path, exist_ok=True)
-        critical_files = [
-            "/etc/fstab",
-            "/etc/hosts",
-            "/etc/passwd"
-        ]
-        for file_path in critical_files:
-            if os.path.exists(file_path):
-                try:
-                    dest_dir = os.path.join(system_backup_path, os.path.dirname(file_path)[1:])
-                    os.makedirs(dest_dir, exist_ok=True)
-                    shutil.copy2(file_path, os.path.join(dest_dir, os.path.basename(file_path)))
-                    self.logger.info(f"Backed up: {file_path}")
-                except PermissionError:
-                    self.logger.warning(f"Permission denied for: {file_path}")
-                except Exception as e:
-                    self.logger.error(f"Failed to backup {file_path}: {str(e)}")
+    def _count_scanned(self, folders, manifests):
+        files = sum(len(manifests[folder]) for folder in folders)
+        nbytes = sum(self.index.entries[os.path.join(folder, rel)][0]
+                     for folder in folders for rel in manifests[folder])
+        self.scanned = (files, nbytes)
+
+    def _record_run(self, repo_name, started, outcome, error=None):
+        """Store this run's statistics in the history database"""
+        stats = self.sync_stats
+        try:
+            self.history.record_run(
+                started_at=started,
+                repo=repo_name,
+                outcome=outcome,
+                error=error,
+                commit_sha=self.last_commit,
+                files_scanned=self.scanned[0],
+                bytes_scanned=self.scanned[1],
+                files_changed=stats.added + stats.modified + stats.deleted + stats.renamed,
+                bytes_changed=stats.bytes_copied,
+                # Uncompressed size of the changed content; git's pack on the wire is usually smaller
+                bytes_pushed=stats.bytes_copied if self.last_commit else 0,
+            )
+        except Exception as e:
+            self.logger.error(f"Failed to record backup history: {str(e)}")
+        summary = self.metrics.finish(
+            outcome,
+            files_scanned=self.scanned[0],
+            bytes_scanned=self.scanned[1],
+            files_changed=stats.added + stats.modified + stats.deleted + stats.renamed,
+            bytes_changed=stats.bytes_copied,
+        )
+        self.logger.info(f"Run {outcome} in {summary['duration']:.1f}s, phases: "
+                         + ", ".join(f"{name}={seconds:.2f}s" for name, seconds in summary["phases"].items()))
+
+    def _backup_system_files(self, dest_root=None):
+        """Refresh the copy of the system path set through one privileged helper run"""
+        dest_root = dest_root or os.path.join(self.repo_path, "system_config")
+        capture = SystemCapture(dest_root, self.system_paths, logger=self.logger)
+        try:
+            stats = capture.capture()
+        except Exception as e:
+            # As before, system files never fail the backup; the previous copy is kept
+            self.logger.error(f"Failed to back up system files: {str(e)}")
+            return None
+        self.logger.info(f"System files: {stats['sent']} changed, {stats['unchanged']} unchanged, "
+                         f"{stats['deleted']} removed, {stats['unreadable']} unreadable")
+        return stats
 
     def _repo_exists(self, repo_name):
-        url = f"https://github.com/{repo_name}"
-        response = requests.get(url)
-        return response.status_code == 200
+        if self._is_local(repo_name):
+            return os.path.isdir(repo_name)
+        from http_client import shared_client
+        return shared_client().repo_exists(repo_name)
+
+    def _is_local(self, repo_name):
+        """An absolute path names a local (usually bare) repository instead of a GitHub repo"""
+        return os.path.isabs(repo_name)
+
+    def _repo_url(self, repo_name):
+        if self._is_local(repo_name):
+            return repo_name
+        return f"https://github.com/{repo_name}.git"
+
+    def _transport_url(self, repo_url):
+        # Local clones ignore --depth and --filter unless they go through file://
+        if os.path.isabs(repo_url):
+            return "file://" + repo_url
+        return repo_url
 
     def _prepare_repo(self, repo_name):
-        repo_url = f"https://github.com/{repo_name}.git"
+        repo_url = self._repo_url(repo_name)
         if not os.path.exists(self.repo_path):
             os.makedirs(os.path.dirname(self.repo_path), exist_ok=True)
             try:
-                self.repo = Repo.clone_from(repo_url, self.repo_path)
+                with self.metrics.span("clone"):
+                    self.repo = Repo.clone_from(repo_url, self.repo_path)
             except GitCommandError as e:
                 raise Exception(f"Cloning failed: {str(e)}")
         else:
             self.repo = Repo(self.repo_path)
             try:
-                self.repo.remotes.origin.pull()
+                with self.metrics.span("pull"):
+                    self.repo.remotes.origin.pull()
             except GitCommandError:
                 raise Exception("Failed to sync with remote repository")
 
-    def _sync_folder(self, src_folder):
+    def _staging_path(self, src_folder):
+        return os.path.join(self.repo_path, os.path.basename(src_folder))
+
+    def _scan_folders(self, folders, progress=None):
+        """Scan every source folder and its staging copy in one parallel pass"""
+        roots = list(folders) + [self._staging_path(folder) for folder in folders]
+        # Staging copies are scanned unfiltered, so files that become excluded are deleted from them
+        return self.index.scan_trees(roots, progress, rules=self.rules)
+
+    def _plan_folder(self, src_folder, manifests):
+        """Work out which files of src_folder differ from its staging copy"""
+        dest = self._staging_path(src_folder)
+        dest_manifest, locations = self._logical_manifest(dest, manifests[dest])
+        return diff_manifests(manifests[src_folder], dest_manifest), locations
+
+    def _sync_paths(self, src_folder, rels, progress=None, recorded=None):
+        """Sync individual files or subtrees of src_folder into its staging copy
+
+        recorded, the folder's verification manifest, is updated in place for
+        the synced paths when given.
+        """
+        stats = SyncStats()
+        dest_folder = self._staging_path(src_folder)
+        writer = self._writer()
+        rules = self.rules.get(src_folder) or FolderRules()
+        for rel in _outermost(rels):
+            src = os.path.join(src_folder, rel) if rel else src_folder
+            dest = os.path.join(dest_folder, rel) if rel else dest_folder
+            if os.path.isdir(src) or os.path.isdir(dest):
+                manifests = self.index.scan_trees([src, dest], rules={src: rules.for_subtree(rel)})
+                # An excluded directory syncs as empty, which removes any copy made before the rule existed
+                src_manifest = manifests[src] if rules.keep_path(rel, is_dir=True) else {}
+                dest_manifest, locations = self._logical_manifest(dest, manifests[dest])
+                src_root, dest_root = src, dest
+                prefix = rel
+            else:
+                # A single file: diff it within its parent directory
+                src_root, dest_root = os.path.dirname(src), os.path.dirname(dest)
+                name = os.path.basename(src)
+                src_manifest = {}
+                if os.path.isfile(src) and rules.keep_path(rel, os.path.getsize(src)):
+                    src_manifest = {name: self.index.digest(src)}
+                stored = {}
+                for candidate in (name, name + MANIFEST_SUFFIX, name + ENCRYPTED_SUFFIX):
+                    path = os.path.join(dest_root, candidate)
+                    if os.path.isfile(path):
+                        stored[candidate] = self.index.digest(path)
+                if os.path.isfile(os.path.join(dest_root, PACK_INDEX)):
+                    stored[PACK_INDEX] = None
+                dest_manifest, locations = self._logical_manifest(dest_root, stored)
+                # The directory's pack index lists its other files too, which are not being synced
+                dest_manifest = {name: dest_manifest[name]} if name in dest_manifest else {}
+                prefix = os.path.dirname(rel)
+            if recorded is not None:
+                replace_subtree(recorded, rel, {
+                    os.path.join(prefix, name): (digest, self.index.entries[os.path.join(src_root, name)][0])
+                    for name, digest in src_manifest.items()})
+            plan = diff_manifests(src_manifest, dest_manifest)
+            if not plan.is_empty():
+                plan, locations, packed = self._apply_packed(plan, src_root, dest_root, locations, progress)
+                stats.merge(packed)
+                stats.merge(apply_plan(plan, src_root, dest_root, src_manifest, self.index,
+                                       writer, locations, progress))
+        self.logger.info(f"Synced {len(rels)} changed paths in {src_folder}: {stats}")
+        return stats
+
+    def _sync_folder(self, src_folder, manifests=None, planned=None, progress=None):
         try:
-            dest = os.path.join(self.repo_path, os.path.basename(src_folder))
-            if self._files_changed(src_folder, dest):
-                if os.path.exists(dest):
-                    shutil.rmtree(dest)
-                shutil.copytree(src_folder, dest, dirs_exist_ok=True)
+            dest = self._staging_path(src_folder)
+            if manifests is None:
+                manifests = self.index.scan_trees([src_folder, dest], rules={src_folder: self.rules.get(src_folder)})
+            plan, locations = planned or self._plan_folder(src_folder, manifests)
+            if plan.is_empty():
+                return SyncStats()
+            writer = self._writer()
+            plan, locations, stats = self._apply_packed(plan, src_folder, dest, locations, progress)
+            stats.merge(apply_plan(plan, src_folder, dest, manifests[src_folder], self.index,
+                                   writer, locations, progress))
+            self.sync_stats.merge(stats)
+            self.logger.info(f"Synced {src_folder}: {stats}")
+            return stats
+        except BackupCancelled:
+            raise
         except Exception as e:
             raise Exception(f"Failed to sync {src_folder}: {str(e)}")
 
-    def _files_changed(self, src, dest):
-        if not os.path.exists(dest):
-            return True
-        src_hash = self._dir_hash(src)
-        dest_hash = self._dir_hash(dest)
-        return src_hash != dest_hash
+    def _record_manifest(self, folder, digests):
+        """Write folder's verification manifest from the digests its scan produced (see verify.py)"""
+        entries = {rel: (digest, self.index.entries[os.path.join(folder, rel)][0]) for rel, digest in digests.items()}
+        write_manifest(self.repo_path, os.path.basename(folder), entries, self.cipher)
 
-    def _dir_hash(self, path):
-        hash = hashlib.sha1()
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                filepath = os.path.join(root, name)
-                with open(filepath, 'rb') as f:
-                    while chunk := f.read(8192):
-                        hash.update(chunk)
-        return hash.hexdigest()
-
-    def _git_commit_push(self):
-        try:
-            if self.repo.is_dirty() or len(self.repo.untracked_files) > 0:
-                self.repo.git.add(A=True)
-                self.repo.git.commit(m="AutoStash Backup")
-                self.repo.remotes.origin.push()
+    def _logical_manifest(self, dest, stored_manifest):
+        """Map chunk manifests, encrypted files and packs in the staging tree back to the files they stand for
+
+        A file stored in a form the current mode does not use (plain or
+        chunked while encrypting, encrypted while not, packed while not
+        packing, small and unpacked while packing) gets a digest no source
+        file can have, so it is rewritten in the current form.
+        """
+        manifest = {}
+        locations = {}
+        packing = self._packing()
+        for rel, digest in stored_manifest.items():
+            if is_pack(rel):
+                if not is_pack_index(rel):
+                    continue
+                directory = os.path.dirname(rel)
+                for name, entry in read_index(os.path.join(dest, rel)).items():
+                    logical = os.path.join(directory, name)
+                    manifest[logical] = entry[2] if packing else f"packed:{entry[2]}"
+                    locations[logical] = os.path.join(directory, PACK_NAME)
+            elif is_manifest(rel):
+                logical = rel[:-len(MANIFEST_SUFFIX)]
+                digest = ChunkStore.read_manifest(os.path.join(dest, rel))["digest"]
+                manifest[logical] = f"chunked:{digest}" if self.cipher else digest
+                locations[logical] = rel
+            elif is_encrypted(rel):
+                logical = rel[:-len(ENCRYPTED_SUFFIX)]
+                manifest[logical] = (self.cipher.read_info(os.path.join(dest, rel))["digest"] if self.cipher
+                                     else f"encrypted:{digest}")
+                locations[logical] = rel
+            elif self.cipher or (packing and self.index.entries[os.path.join(dest, rel)][0] < self.pack_threshold):
+                manifest[rel] = f"plain:{digest}"
+                locations[rel] = rel
+            else:
+                manifest[rel] = digest
+        return manifest, locations
+
+    def _packing(self):
+        """Whether small files are packed this run; encrypted files are always stored one by one"""
+        return self.packing and not self.cipher
+
+    def _apply_packed(self, plan, src_root, dest_root, locations, progress):
+        """Do the packing part of plan (see pack_store.apply_packed); returns what apply_plan still has to do"""
+        if not self._packing() and not any(os.path.basename(stored) == PACK_NAME for stored in locations.values()):
+            return plan, locations, SyncStats()
+        return apply_packed(plan, src_root, dest_root, locations, self.pack_threshold if self._packing() else 0,
+                            progress, self.index.read_limiter)
+
+    def _prepare_cipher(self):
+        """Unlock (or on first use create) the repository's data key and start the cipher workers"""
+        from encryption import FileCipher, load_or_create_key
+        if self.chunking:
+            self.logger.warning("Chunking is not used for encrypted backups; files are encrypted whole")
+        if self.packing:
+            self.logger.warning("Packing is not used for encrypted backups; files are encrypted one by one")
+        self.cipher = FileCipher(load_or_create_key(self.repo_path, self.gpg_recipient), self.workers)
+
+    def _encrypted_writer(self, src_path, dest_root, rel):
+        stored = rel + ENCRYPTED_SUFFIX
+        written = self.cipher.encrypt_file(src_path, os.path.join(dest_root, stored))
+        return stored, written, "encrypted"
+
+    def _writer(self):
+        """The staging writer, paced by the read-rate cap when one is set"""
+        if self.cipher:
+            writer = self._encrypted_writer
+        else:
+            writer = self._chunk_writer if self.chunking else copy_writer
+        limiter = self.index.read_limiter
+        if limiter is None:
+            return writer
+
+        def paced(src_path, dest_root, rel):
+            limiter.consume(os.path.getsize(src_path))
+            return writer(src_path, dest_root, rel)
+        return paced
+
+    def _chunk_writer(self, src_path, dest_root, rel):
+        """Store large files as chunk manifests and everything else as plain copies"""
+        if os.path.getsize(src_path) < self.chunk_threshold:
+            return copy_writer(src_path, dest_root, rel)
+        stored = rel + MANIFEST_SUFFIX
+        before = self.chunk_store.new_bytes
+        self.chunk_store.store_file(src_path, os.path.join(dest_root, stored))
+        return stored, self.chunk_store.new_bytes - before, "chunked"
+
+    def _git_commit_push(self, progress=None):
+        """Commit and push the staging repo's changes in size-bounded batches
+
+        `git status` is streamed, so only the current batch's paths are held in
+        memory however large the changeset is. Each batch is committed and
+        pushed before the next is staged, and a checkpoint records how far the
+        run got: after an interruption the pushed batches stay pushed, any
+        commit that was not pushed goes out first, and batching carries on
+        with the rest of the working tree.
+        """
+        try:
+            if self.repo.head.is_valid():
+                self._push_pending(progress, 0)
+            checkpoint = self._load_checkpoint()
+            number = checkpoint.get("batches", 0)
+            total_bytes = checkpoint.get("bytes", 0)
+            if number:
+                self.logger.info(f"Resuming interrupted backup after batch {number}")
+            for paths, nbytes in _size_batches(self._status_entries(), self.batch_bytes, self.batch_files):
+                number += 1
+                if progress:
+                    # Between batches is a safe point: everything committed so far is already pushed
+                    progress.set_phase("commit", f"Committing batch {number}...")
+                with self.metrics.span("commit", batch=number, files=len(paths), bytes=nbytes):
+                    self._git_stdin(["--literal-pathspecs", "add", "-A",
+                                     "--pathspec-from-file=-", "--pathspec-file-nul"], b"\0".join(paths))
+                    self.repo.git.commit(m="AutoStash Backup" if number == 1 else f"AutoStash Backup (batch {number})")
+                    self.last_commit = self.repo.head.commit.hexsha
+                total_bytes += nbytes
+                self._save_checkpoint({"repo": self.primary, "batches": number, "bytes": total_bytes,
+                                       "head": self.last_commit})
+                self._push_pending(progress, nbytes)
+            self._clear_checkpoint()
         except GitCommandError as e:
             raise Exception(f"Git error: {str(e)}")
 
+    def _status_entries(self):
+        """Yield (path, size) for every changed path, straight from a streamed `git status -z`"""
+        # --no-optional-locks: batches are committed while status is still being read
+        proc = subprocess.Popen(["git", "--no-optional-locks", "status", "--porcelain", "-z", "--no-renames",
+                                 "--untracked-files=all"], cwd=self.repo_path, stdout=subprocess.PIPE)
+        root = os.fsencode(self.repo_path)
+        tail = b""
+        try:
+            for block in iter(functools.partial(proc.stdout.read, 64 * 1024), b""):
+                records = (tail + block).split(b"\0")
+                tail = records.pop()
+                for record in records:
+                    path = record[3:]
+                    try:
+                        size = os.lstat(os.path.join(root, path)).st_size
+                    except FileNotFoundError:
+                        size = 0  # a deletion
+                    yield path, size
+            if proc.wait() != 0:
+                raise Exception("git status failed in the staging repository")
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+    def _git_stdin(self, args, data):
+        result = subprocess.run(["git", *args], cwd=self.repo_path, input=data, capture_output=True)
+        if result.returncode != 0:
+            raise Exception(f"git {args[1]} failed: {result.stderr.decode(errors='replace').strip()}")
+
+    def _push_pending(self, progress, nbytes):
+        """Bring every remote up to HEAD, pushing commits one at a time so each push stays one batch"""
+        branch = self.repo.active_branch.name
+        head = self.repo.head.commit.hexsha
+        pushes = []
+        for name, remote in [(self.primary, "origin")] + [(mirror, _mirror_remote(mirror)) for mirror in self.mirrors]:
+            if remote != "origin":
+                self._set_remote(remote, self._repo_url(name))
+            # Compare against the remote-tracking ref so a push that failed last run is retried
+            tracking = self._tracking_head(remote, branch)
+            if tracking == head:
+                continue
+            commits = self.repo.git.rev_list("--reverse", f"{tracking}..{head}").split() if tracking else [head]
+            git_progress = _GitProgress(progress, nbytes) if progress and remote == "origin" else None
+            pushes.append((name, functools.partial(self._push_commits, remote, branch, commits, git_progress)))
+        if pushes:
+            if progress:
+                progress.set_phase("push", "Pushing to GitHub...", safe_point=False)
+            self._fan_out(self.primary, pushes)
+
+    def _push_commits(self, remote, branch, commits, progress=None):
+        wrapper = self.limits.push_wrapper(self.logger)
+        for sha in commits:
+            refspec = f"{sha}:refs/heads/{branch}"
+            if wrapper:
+                # Capped pushes go through trickle, which GitPython's push cannot wrap; no progress then
+                self.repo.git.execute(wrapper + ["git", "push", "-q", remote, refspec],
+                                      kill_after_timeout=None if remote == "origin" else MIRROR_PUSH_TIMEOUT)
+            elif remote == "origin":
+                self.repo.remote(remote).push(refspec, progress=progress).raise_if_error()
+            else:
+                self.repo.git.push(remote, refspec, kill_after_timeout=MIRROR_PUSH_TIMEOUT)
+
+    def _load_checkpoint(self):
+        try:
+            with open(PUSH_CHECKPOINT, "r") as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return checkpoint if checkpoint.get("repo") == self.primary else {}
+
+    def _save_checkpoint(self, checkpoint):
+        atomic_write_json(PUSH_CHECKPOINT, checkpoint)
+
+    def _clear_checkpoint(self):
+        try:
+            os.remove(PUSH_CHECKPOINT)
+        except FileNotFoundError:
+            pass
+
+    def _tracking_head(self, remote, branch):
+        try:
+            return self.repo.git.rev_parse("--verify", "-q", f"refs/remotes/{remote}/{branch}")
+        except GitCommandError:
+            return None
+
+    def _set_remote(self, remote, url):
+        if remote in [r.name for r in self.repo.remotes]:
+            if self.repo.remotes[remote].url != url:
+                self.repo.git.remote("set-url", remote, url)
+        else:
+            self.repo.create_remote(remote, url)
+
+    def _fan_out(self, primary, pushes):
+        """Run (repo name, push callable) pairs in parallel and record how each went
+
+        Only a failed push to the primary fails the run; mirrors that fail are
+        logged and left behind, to be caught up on the next run.
+        """
+        def timed(name, push):
+            start = time.perf_counter()
+            try:
+                push()
+                result = {"status": "ok"}
+            except Exception as e:
+                result = {"status": "failed", "error": str(e)}
+            result["seconds"] = round(time.perf_counter() - start, 3)
+            return name, result
+
+        with self.metrics.span("push", bytes_changed=self.sync_stats.bytes_copied, remotes=len(pushes)) as span:
+            with ThreadPoolExecutor(max_workers=len(pushes)) as executor:
+                for name, result in executor.map(lambda pair: timed(*pair), pushes):
+                    self.push_results[name] = result
+                    if result["status"] == "failed":
+                        self.logger.warning(f"Push to {name} failed: {result['error']}")
+                    else:
+                        self.logger.info(f"Pushed to {name} in {result['seconds']:.1f}s")
+            span.set(remote_results=self.push_results)
+        if self.push_results.get(primary, {}).get("status") == "failed":
+            raise Exception(f"Push to {primary} failed: {self.push_results[primary]['error']}")
+
     def get_last_backup_time(self):
         try:
             with open(os.path.expanduser("~/.autostash/last_backup"), "r") as f:
@@ -186,3 +1036,35 @@ class BackupManager:
         except Exception:
             return None
 
+
+def _size_batches(entries, max_bytes, max_files):
+    """Group (item, size) pairs into ([items], bytes) batches; an oversized item gets a batch of its own"""
+    items, nbytes = [], 0
+    for item, size in entries:
+        if items and (nbytes + size > max_bytes or len(items) >= max_files):
+            yield items, nbytes
+            items, nbytes = [], 0
+        items.append(item)
+        nbytes += size
+    if items:
+        yield items, nbytes
+
+
+def _mirror_remote(repo_name):
+    """Stable git remote name for a mirror repository"""
+    return "mirror-" + hashlib.sha1(repo_name.encode()).hexdigest()[:10]
+
+
+def _outermost(rels):
+    """Drop paths that lie inside another path of the same set"""
+    rels = set(rels)
+    if "" in rels:
+        return [""]
+    result = []
+    for rel in sorted(rels):
+        parent = os.path.dirname(rel)
+        while parent and parent not in rels:
+            parent = os.path.dirname(parent)
+        if not parent:
+            result.append(rel)
+    return result
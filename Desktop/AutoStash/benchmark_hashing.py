@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Measure how scanning and hashing scale with the number of workers.
+
+Usage: python3 benchmark_hashing.py [--files N] [--size BYTES] [--max-workers N] [--processes]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from file_index import FileIndex
+
+
+def make_tree(root, files, size):
+    """Create a synthetic tree of random files spread over a few directories"""
+    for i in range(files):
+        directory = os.path.join(root, f"dir{i % 16:02d}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file{i:05d}.bin"), "wb") as f:
+            f.write(os.urandom(size))
+
+
+def worker_counts(max_workers):
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_workers:
+        counts.append(max_workers)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoStash hashing benchmark")
+    parser.add_argument("--files", type=int, default=400)
+    parser.add_argument("--size", type=int, default=1024 * 1024)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--processes", action="store_true", help="hash in worker processes instead of threads")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="autostash-bench-")
+    try:
+        tree = os.path.join(work_dir, "tree")
+        make_tree(tree, args.files, args.size)
+        total_mb = args.files * args.size / (1024 * 1024)
+        print(f"{args.files} files, {total_mb:.1f} MiB, {'processes' if args.processes else 'threads'}")
+        print(f"{'workers':>8} {'seconds':>9} {'MiB/s':>9} {'speedup':>8}")
+
+        baseline = None
+        reference = None
+        for workers in worker_counts(args.max_workers):
+            # A fresh index each time forces every file to be hashed
+            index = FileIndex(os.path.join(work_dir, f"index-{workers}.json"), workers, args.processes)
+            start = time.perf_counter()
+            manifest = index.scan_tree(tree)
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = manifest
+            elif manifest != reference:
+                sys.exit(f"Result with {workers} workers differs from the single-worker scan")
+            baseline = baseline or elapsed
+            print(f"{workers:>8} {elapsed:>9.3f} {total_mb / elapsed:>9.1f} {baseline / elapsed:>7.2f}x")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
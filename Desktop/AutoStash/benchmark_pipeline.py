@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Benchmark the whole backup pipeline against a local bare repository.
+
+Builds a synthetic source tree, runs BackupManager.run against a throwaway
+bare remote and times each phase (prepare, scan, hash, copy, commit, push)
+from the progress events. A cold run starts with no staging repo and no file
+index; warm runs reuse both after changing a fraction of the files.
+
+Usage: python3 benchmark_pipeline.py --shape small --files 2000 --change-fraction 0.05 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+
+SHAPES = {
+    # name: (default file count, default file size, directory depth)
+    "small": (5000, 2 * 1024, 2),
+    "huge": (4, 256 * 1024 * 1024, 1),
+    "deep": (2000, 8 * 1024, 12),
+    "mixed": (1000, 64 * 1024, 4),
+}
+
+
+def make_tree(root, files, size, depth, rng):
+    """Create files of the given size spread over nested directories"""
+    paths = []
+    for i in range(files):
+        parts = [f"d{(i >> (2 * level)) % 4}" for level in range(depth)]
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"f{i:06d}.bin")
+        write_random(path, size, rng)
+        paths.append(path)
+    return paths
+
+
+def write_random(path, size, rng):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = min(remaining, 4 * 1024 * 1024)
+            f.write(rng.randbytes(block))
+            remaining -= block
+
+
+def change_files(paths, fraction, rng):
+    """Rewrite a slice of each chosen file in place; returns the number changed"""
+    chosen = rng.sample(paths, max(1, int(len(paths) * fraction))) if fraction > 0 else []
+    for path in chosen:
+        with open(path, "r+b") as f:
+            f.seek(rng.randrange(max(1, os.path.getsize(path))))
+            f.write(rng.randbytes(64))
+    return len(chosen)
+
+
+def make_remote(path):
+    """A bare repository with one commit, standing in for the GitHub remote"""
+    subprocess.run(["git", "init", "-q", "--bare", "-b", "main", path], check=True)
+    seed = path + "-seed"
+    subprocess.run(["git", "clone", "-q", path, seed], check=True, capture_output=True)
+    with open(os.path.join(seed, "README"), "w") as f:
+        f.write("AutoStash benchmark remote\n")
+    subprocess.run(["git", "-C", seed, "add", "README"], check=True)
+    subprocess.run(["git", "-C", seed, "commit", "-q", "-m", "seed"], check=True)
+    subprocess.run(["git", "-C", seed, "push", "-q", "origin", "HEAD:main"], check=True)
+    shutil.rmtree(seed)
+
+
+class PhaseTimer:
+    """Progress callback that turns phase changes into per-phase durations"""
+
+    def __init__(self):
+        self.phases = {}
+        self.current = None
+        self.since = None
+
+    def __call__(self, percent, message, event=None):
+        if not event or event["phase"] == self.current:
+            return
+        now = time.perf_counter()
+        self._close(now)
+        self.current = event["phase"]
+        self.since = now
+
+    def _close(self, now):
+        if self.current is not None:
+            self.phases[self.current] = self.phases.get(self.current, 0.0) + now - self.since
+
+    def finish(self):
+        self._close(time.perf_counter())
+        self.phases.pop("done", None)
+        return self.phases
+
+
+def timed_run(backup, label, folder, remote):
+    timer = PhaseTimer()
+    start = time.perf_counter()
+    backup.run([folder], remote, progress_callback=timer)
+    total = time.perf_counter() - start
+    stats = backup.sync_stats
+    return {
+        "label": label,
+        "total_seconds": round(total, 4),
+        "phases": {name: round(seconds, 4) for name, seconds in timer.finish().items()},
+        "spans": {name: round(seconds, 4) for name, seconds in backup.metrics.phase_durations().items()},
+        "files_scanned": backup.scanned[0],
+        "bytes_scanned": backup.scanned[1],
+        "files_changed": stats.added + stats.modified + stats.deleted + stats.renamed,
+        "bytes_changed": stats.bytes_copied,
+        "copy_methods": stats.copy_methods,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoStash pipeline benchmark")
+    parser.add_argument("--shape", choices=sorted(SHAPES), default="mixed")
+    parser.add_argument("--files", type=int, help="number of files (default depends on shape)")
+    parser.add_argument("--size", type=int, help="bytes per file (default depends on shape)")
+    parser.add_argument("--depth", type=int, help="directory nesting depth (default depends on shape)")
+    parser.add_argument("--change-fraction", type=float, default=0.05)
+    parser.add_argument("--warm-runs", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--direct", action="store_true", help="benchmark direct-ingest mode")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON results here as well as to stdout")
+    args = parser.parse_args()
+
+    files, size, depth = SHAPES[args.shape]
+    files = args.files or files
+    size = args.size or size
+    depth = args.depth or depth
+    rng = random.Random(args.seed)
+
+    work_dir = tempfile.mkdtemp(prefix="autostash-pipeline-")
+    # BackupManager keeps its state under ~, so point ~ at the scratch directory first
+    os.environ["HOME"] = work_dir
+    os.makedirs(os.path.join(work_dir, ".autostash"), exist_ok=True)
+    with open(os.path.join(work_dir, ".gitconfig"), "w") as f:
+        f.write("[user]\n\tname = AutoStash Benchmark\n\temail = bench@localhost\n")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from backup_logic import BackupManager
+
+    try:
+        remote = os.path.join(work_dir, "remote.git")
+        make_remote(remote)
+        source = os.path.join(work_dir, "source")
+        paths = make_tree(source, files, size, depth, rng)
+
+        backup = BackupManager(workers=args.workers, direct_ingest=args.direct)
+        runs = [timed_run(backup, "cold", source, remote)]
+        for i in range(args.warm_runs):
+            changed = change_files(paths, args.change_fraction, rng)
+            result = timed_run(backup, f"warm-{i + 1}", source, remote)
+            result["files_touched"] = changed
+            runs.append(result)
+        runs.append(timed_run(backup, "warm-unchanged", source, remote))
+
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "config": {
+                "shape": args.shape, "files": files, "size": size, "depth": depth,
+                "change_fraction": args.change_fraction, "workers": args.workers,
+                "mode": "direct" if args.direct else "staged",
+            },
+            "runs": runs,
+        }
+        text = json.dumps(report, indent=2)
+        print(text)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
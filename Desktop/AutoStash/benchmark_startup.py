@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Check that `cli.py status` starts within a fixed budget and stays free of heavy imports.
+
+Runs the command repeatedly under `python3 -X importtime` with ~ pointed at a
+scratch directory. The exit status is non-zero when the median wall time is
+over budget or a forbidden module was imported, so this can gate a release;
+test_startup.py runs the same check under pytest.
+
+Usage: python3 benchmark_startup.py --runs 10 --budget 0.25
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# Modules the status path must never pull in
+FORBIDDEN = ["tkinter", "git", "github", "requests", "keyring", "urllib3", "backup_logic"]
+BUDGET = 0.25
+
+
+def imported_modules(importtime_output):
+    """Top-level package names from -X importtime lines ("import time: self | cumulative | name")"""
+    names = set()
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        name = line.rsplit("|", 1)[1].strip()
+        names.add(name.split(".")[0])
+    return names
+
+
+def measure(command="status", runs=10):
+    """(wall times, top-level modules imported) over runs of `cli.py command` with a scratch ~"""
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+    home = tempfile.mkdtemp(prefix="autostash-startup-")
+    os.makedirs(os.path.join(home, ".config"))
+    env = dict(os.environ, HOME=home)
+    try:
+        times = []
+        modules = set()
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, "-X", "importtime", cli, command],
+                                    env=env, capture_output=True, text=True)
+            times.append(time.perf_counter() - start)
+            if result.returncode != 0:
+                raise Exception(f"cli.py {command} failed:\n{result.stderr[-2000:]}")
+            modules |= imported_modules(result.stderr)
+    finally:
+        shutil.rmtree(home)
+    return times, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoStash CLI startup check")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=BUDGET, help="maximum median wall time in seconds")
+    parser.add_argument("--command", default="status", choices=["status", "history"])
+    args = parser.parse_args()
+
+    try:
+        times, modules = measure(args.command, args.runs)
+    except Exception as e:
+        sys.exit(str(e))
+    median = statistics.median(times)
+    heavy = sorted(name for name in FORBIDDEN if name in modules)
+    print(json.dumps({
+        "command": args.command,
+        "runs": args.runs,
+        "median_seconds": round(median, 4),
+        "min_seconds": round(min(times), 4),
+        "budget_seconds": args.budget,
+        "forbidden_imports": heavy,
+    }, indent=2))
+    if heavy:
+        sys.exit(f"FAIL: {args.command} imported {', '.join(heavy)}")
+    if median > args.budget:
+        sys.exit(f"FAIL: median startup {median:.3f}s is over the {args.budget:.3f}s budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import os
+import json
+import random
+import hashlib
+import tempfile
+
+MANIFEST_SUFFIX = ".autostash-chunks"
+STORE_DIR = ".autostash_chunks"
+MIN_CHUNK = 256 * 1024
+AVG_CHUNK = 1024 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+CHUNK_THRESHOLD = 8 * 1024 * 1024
+
+# Fixed gear table so chunk boundaries are stable across runs and machines
+_rng = random.Random(0x4175746f53746173)
+GEAR = [_rng.getrandbits(64) for _ in range(256)]
+MASK64 = (1 << 64) - 1
+
+
+def _boundary_mask(avg_size):
+    # Use the high bits: with a shift-left gear hash the low bits only see the last few bytes
+    bits = avg_size.bit_length() - 1
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def find_cut(buf, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """Return the length of the next content-defined chunk at the start of buf"""
+    n = len(buf)
+    if n <= min_size:
+        return n
+    mask = _boundary_mask(avg_size)
+    end = min(n, max_size)
+    h = 0
+    gear = GEAR
+    # Bytes before min_size can never end a chunk, so they are not hashed at all
+    for i in range(min_size, end):
+        h = ((h << 1) + gear[buf[i]]) & MASK64
+        if not h & mask:
+            return i + 1
+    return end
+
+
+def iter_chunks(f, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """Yield content-defined chunks from a binary file object, holding at most two chunks in memory"""
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = f.read(max_size)
+            if not data:
+                eof = True
+            buf += data
+        if not buf:
+            return
+        cut = find_cut(buf, min_size, avg_size, max_size)
+        yield bytes(buf[:cut])
+        del buf[:cut]
+
+
+def is_manifest(path):
+    return path.endswith(MANIFEST_SUFFIX)
+
+
+class ChunkStore:
+    """Content-addressed chunk store kept inside the staging repo"""
+
+    def __init__(self, repo_path):
+        self.root = os.path.join(repo_path, STORE_DIR)
+        self.new_chunks = 0
+        self.new_bytes = 0
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def _put_chunk(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".chunk-", dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.new_chunks += 1
+            self.new_bytes += len(data)
+        return digest
+
+    def store_file(self, src_path, manifest_path):
+        """Split src_path into chunks and write its manifest; returns the file size"""
+        with open(src_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # Same digest as FileIndex so staging manifests compare against the source index
+            file_digest = hashlib.sha1(f"blob {size}\0".encode())
+            chunks = []
+            for data in iter_chunks(f):
+                file_digest.update(data)
+                chunks.append([self._put_chunk(data), len(data)])
+        st = os.stat(src_path)
+        manifest = {
+            "size": size,
+            "digest": file_digest.hexdigest(),
+            "mode": st.st_mode & 0o7777,
+            "mtime": st.st_mtime,
+            "chunks": chunks,
+        }
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        return size
+
+    @staticmethod
+    def read_manifest(manifest_path):
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def restore_file(self, manifest_path, dest_path):
+        """Reassemble the file described by manifest_path into dest_path"""
+        manifest = self.read_manifest(manifest_path)
+        tmp_path = dest_path + ".partial"
+        with open(tmp_path, 'wb') as out:
+            for digest, length in manifest["chunks"]:
+                with open(self._chunk_path(digest), 'rb') as f:
+                    data = f.read()
+                if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+                    raise Exception(f"Corrupt chunk {digest} in {manifest_path}")
+                out.write(data)
+        os.chmod(tmp_path, manifest.get("mode", 0o644))
+        os.utime(tmp_path, (manifest["mtime"], manifest["mtime"]))
+        os.replace(tmp_path, dest_path)
+
+    def reassemble_tree(self, root):
+        """Replace every chunk manifest under root with the file it describes"""
+        restored = 0
+        for dirpath, dirs, files in os.walk(root):
+            if STORE_DIR in dirs:
+                dirs.remove(STORE_DIR)
+            if ".git" in dirs:
+                dirs.remove(".git")
+            for name in files:
+                if is_manifest(name):
+                    manifest_path = os.path.join(dirpath, name)
+                    self.restore_file(manifest_path, manifest_path[:-len(MANIFEST_SUFFIX)])
+                    os.remove(manifest_path)
+                    restored += 1
+        return restored
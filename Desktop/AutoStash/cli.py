@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""Headless AutoStash command line, used by the scheduled jobs.
+
+Usage: autostash {backup,plan,restore,status,history,maintain,verify} [options]
+
+Only the standard library is imported at startup. GitPython, requests and
+the backup pipeline are imported inside the subcommands that need them, so
+`status` and `history` stay cheap enough to run from frequent timers.
+"""
+import os
+import sys
+import json
+import argparse
+import datetime
+
+ERROR_LOG = os.path.expanduser("~/.autostash/error.log")
+LAST_BACKUP = os.path.expanduser("~/.autostash/last_backup")
+
+
+def cmd_backup(args):
+    from config_manager import ConfigManager
+    config = ConfigManager()
+    folders = args.folders or config.get_folders()
+    repo_name = args.repo or config.get_repo()
+    mirrors = args.mirror if args.mirror is not None else config.get_mirrors()
+    if not folders or not repo_name:
+        print("No folders or repository configured; pass --folders and --repo or set them in the GUI",
+              file=sys.stderr)
+        return 2
+
+    from throttle import ResourceLimits
+    limits = config.get_limits() if args.throttle else ResourceLimits()
+    if args.read_mbps:
+        limits.read_rate = args.read_mbps * 1024 * 1024
+    if args.push_kbps:
+        limits.push_rate = args.push_kbps * 1024
+
+    from backup_logic import BackupManager
+    packing = config.get_packing()
+    backup = BackupManager(workers=args.workers, direct_ingest=args.direct, limits=limits,
+                           packing=args.pack_small or packing["enabled"], pack_threshold=packing["threshold"])
+    if args.batch_mb:
+        backup.batch_bytes = args.batch_mb * 1024 * 1024
+    encryption = config.get_encryption()
+    encrypt = args.encrypt or encryption["enabled"]
+    rules = config.get_all_rules(folders)
+    policy = config.get_defer_policy() if args.defer else None
+    try:
+        if policy and (policy.max_bytes is not None or policy.max_seconds is not None):
+            reason = policy.check(backup.plan(folders, repo_name, rules=rules, encrypt=encrypt))
+            if reason:
+                backup.logger.info(f"Scheduled backup deferred: {reason}")
+                print(f"Backup deferred: {reason}")
+                return 0
+        backup.run(folders, [repo_name] + mirrors, backup_system=args.system, progress_callback=_printer(args),
+                   rules=rules, system_paths=config.get_system_paths(), encrypt=encrypt,
+                   gpg_recipient=args.gpg_recipient or encryption["recipient"])
+    except Exception as e:
+        _log_error(e)
+        print(f"Backup failed: {e}", file=sys.stderr)
+        return 1
+    if policy:
+        policy.clear()
+    if backup.joined:
+        print("Backup complete: joined a queued run that covered this request")
+        return 0
+    print(f"Backup complete: {backup.sync_stats}")
+    for name, result in backup.push_results.items():
+        line = f"  {name}: {result['status']} ({result['seconds']:.1f}s)"
+        print(line + (f"  {result['error']}" if "error" in result else ""))
+    return 0
+
+
+def cmd_plan(args):
+    from config_manager import ConfigManager
+    config = ConfigManager()
+    folders = args.folders or config.get_folders()
+    repo_name = args.repo or config.get_repo()
+    if not folders or not repo_name:
+        print("No folders or repository configured; pass --folders and --repo or set them in the GUI",
+              file=sys.stderr)
+        return 2
+
+    from backup_logic import BackupManager
+    backup = BackupManager(direct_ingest=args.direct)
+    try:
+        plan = backup.plan(folders, repo_name, rules=config.get_all_rules(folders),
+                           encrypt=args.encrypt or config.get_encryption()["enabled"])
+    except Exception as e:
+        _log_error(e)
+        print(f"Planning failed: {e}", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(plan.to_dict(), indent=2))
+        return 0
+    for line in plan.lines(None if args.files else 0):
+        print(line)
+    print(plan.summary())
+    reason = config.get_defer_policy().oversized(plan)
+    if reason:
+        print(f"A scheduled run would be deferred: {reason}")
+    return 0
+
+
+def cmd_restore(args):
+    from config_manager import ConfigManager
+    repo_name = args.repo or ConfigManager().get_repo()
+    if not repo_name:
+        print("No repository configured; pass --repo", file=sys.stderr)
+        return 2
+
+    from backup_logic import BackupManager
+    backup = BackupManager()
+    try:
+        restored = backup.restore(repo_name, progress_callback=_printer(args), paths=args.paths or None,
+                                  commit=args.commit, depth=args.depth, update=args.update,
+                                  restore_path=args.to)
+    except Exception as e:
+        _log_error(e)
+        print(f"Restore failed: {e}", file=sys.stderr)
+        return 1
+    print(f"Restored to {restored}")
+    return 0
+
+
+def cmd_status(args):
+    from config_manager import ConfigManager
+    config = ConfigManager()
+    print(f"Repository:  {config.get_repo() or '(not set)'}")
+    for mirror in config.get_mirrors():
+        print(f"Mirror:      {mirror}")
+    folders = config.get_folders()
+    print(f"Folders:     {', '.join(folders) if folders else '(none)'}")
+
+    try:
+        with open(LAST_BACKUP, "r") as f:
+            last = f.read().strip()
+    except OSError:
+        last = None
+    if last:
+        age = datetime.datetime.now() - datetime.datetime.strptime(last, "%Y-%m-%d %H:%M:%S")
+        overdue = "  (overdue)" if age.total_seconds() > 24 * 60 * 60 else ""
+        print(f"Last backup: {last}{overdue}")
+    else:
+        print("Last backup: never")
+
+    from history_store import HistoryStore, format_run
+    latest = HistoryStore().page(limit=1)
+    if latest:
+        print(f"Last run:    {format_run(latest[0])}")
+
+    from run_coordinator import RunCoordinator
+    running = RunCoordinator().running()
+    if running:
+        started = datetime.datetime.fromtimestamp(running["started"]).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"Running:     backup started {started} (pid {running['pid']})")
+
+    from daemon import DAEMON_STATE
+    try:
+        with open(DAEMON_STATE, "r") as f:
+            pending = sum(len(rels) for rels in json.load(f).get("dirty", {}).values())
+        print(f"Daemon:      {pending} paths pending")
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def cmd_history(args):
+    from history_store import HistoryStore, format_run
+    store = HistoryStore()
+    if args.slowest:
+        runs = store.slowest_runs(args.limit)
+    elif args.largest:
+        runs = store.largest_runs(args.limit)
+    else:
+        runs = store.page(limit=args.limit)
+    for run in runs:
+        print(format_run(run))
+    return 0
+
+
+def cmd_maintain(args):
+    from config_manager import ConfigManager
+    config = ConfigManager()
+    repo_name = args.repo or config.get_repo()
+    if not repo_name:
+        print("No repository configured; pass --repo", file=sys.stderr)
+        return 2
+
+    from backup_logic import BackupManager, PUSH_CHECKPOINT
+    from retention import RetentionManager, RetentionPolicy
+    if os.path.exists(PUSH_CHECKPOINT):
+        print("An interrupted backup is still being pushed; run a backup first", file=sys.stderr)
+        return 1
+    backup = BackupManager()
+    mirrors = args.mirror if args.mirror is not None else config.get_mirrors()
+    retention = RetentionManager(backup._repo_url(repo_name), [backup._repo_url(mirror) for mirror in mirrors],
+                                 policy=RetentionPolicy.from_config(config.get_retention()),
+                                 local_repos=[backup.repo_path, backup.bare_path], logger=backup.logger)
+    try:
+        # Rewriting history under a running backup would lose its commit, so take the run lock
+        with backup.coordinator.slot({"kind": "maintain"},
+                                     on_wait=lambda message: print(message, file=sys.stderr)):
+            if args.repack_only:
+                report = {"repos": retention.repack()}
+            else:
+                report = retention.apply(dry_run=args.dry_run, measure=args.measure)
+    except Exception as e:
+        _log_error(e)
+        print(f"Maintenance failed: {e}", file=sys.stderr)
+        return 1
+
+    if "commits_before" in report:
+        verb = "would keep" if report["dry_run"] else "kept"
+        print(f"Retention {verb} {report['commits_after']} of {report['commits_before']} commits")
+    for name, outcome in report.get("pushed", {}).items():
+        print(f"  {name}: {outcome}")
+    for path, sizes in report.get("repos", {}).items():
+        print(f"  {path}: {sizes['before'] / 1024 / 1024:.1f} MiB -> {sizes['after'] / 1024 / 1024:.1f} MiB")
+    timings = report.get("timings")
+    if timings:
+        for op in ("clone", "fetch"):
+            print(f"  {op}: {timings['before'][op]:.2f}s -> {timings['after'][op]:.2f}s")
+    return 0
+
+
+def cmd_verify(args):
+    from config_manager import ConfigManager
+    from backup_logic import BackupManager
+    from verify import Verifier
+    backup = BackupManager()
+    verifier = Verifier(workers=args.workers, sample=args.sample, seed=args.seed, logger=backup.logger)
+    try:
+        if args.target == "remote":
+            repo_name = args.repo or ConfigManager().get_repo()
+            if not repo_name:
+                print("No repository configured; pass --repo", file=sys.stderr)
+                return 2
+            report = verifier.verify_remote(backup._transport_url(backup._repo_url(repo_name)))
+        else:
+            default = os.path.expanduser("~/autostash_restore") if args.target == "restore" else backup.repo_path
+            report = verifier.verify_tree(args.path or default, paths=args.paths)
+    except Exception as e:
+        _log_error(e)
+        print(f"Verification failed: {e}", file=sys.stderr)
+        return 1
+    finally:
+        verifier.close()
+
+    for line in report.problems():
+        print(line)
+    print(("OK " if report.ok else "PROBLEMS ") + report.summary())
+    if not report.ok:
+        _log_error(f"Verification found problems: {report.summary()}")
+    return 0 if report.ok else 1
+
+
+def _printer(args):
+    """Progress callback printing one line per update, or None when --quiet"""
+    if args.quiet:
+        return None
+    from progress import format_event
+
+    def callback(percent, message, event=None):
+        line = f"{percent:5.1f}%  {message}"
+        if event:
+            line += f" ({format_event(event)})"
+        print(line, file=sys.stderr)
+    return callback
+
+
+def _log_error(error):
+    try:
+        os.makedirs(os.path.dirname(ERROR_LOG), exist_ok=True)
+        with open(ERROR_LOG, "a") as f:
+            f.write(f"{datetime.datetime.now()}: {str(error)}\n")
+    except OSError:
+        pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="autostash", description="AutoStash backups from the command line")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backup = commands.add_parser("backup", help="back up the configured folders")
+    backup.add_argument("--repo", help="owner/name on GitHub, or an absolute path to a local repository")
+    backup.add_argument("--mirror", action="append", help="also push to this repository (repeatable)")
+    backup.add_argument("--folders", nargs="+", help="folders to back up instead of the configured ones")
+    backup.add_argument("--system", action="store_true", help="also back up system files")
+    backup.add_argument("--direct", action="store_true", help="write straight into a bare repository")
+    backup.add_argument("--workers", type=int, help="hashing workers (default: CPU count)")
+    backup.add_argument("--batch-mb", type=int, help="largest commit/push in MiB (default: 512)")
+    backup.add_argument("--encrypt", action="store_true",
+                        help="store files compressed and encrypted (default: as configured)")
+    backup.add_argument("--pack-small", action="store_true",
+                        help="store small files in one pack per directory (default: as configured)")
+    backup.add_argument("--gpg-recipient", help="GPG key that protects a new data key (default: a passphrase)")
+    backup.add_argument("--throttle", action="store_true",
+                        help="run at background CPU/IO priority with the configured rate caps")
+    backup.add_argument("--read-mbps", type=int, help="cap file reads for hashing and copying, in MiB/s")
+    backup.add_argument("--push-kbps", type=int, help="cap push bandwidth in KiB/s (needs trickle)")
+    backup.add_argument("--defer", action="store_true",
+                        help="skip the run for now if it is over the configured size or time limits")
+    backup.add_argument("-q", "--quiet", action="store_true")
+    backup.set_defaults(func=cmd_backup)
+
+    plan = commands.add_parser("plan", help="show what a backup would change and how long it should take")
+    plan.add_argument("--repo", help="owner/name on GitHub, or an absolute path to a local repository")
+    plan.add_argument("--folders", nargs="+", help="folders to plan instead of the configured ones")
+    plan.add_argument("--direct", action="store_true", help="plan a direct-ingest backup")
+    plan.add_argument("--encrypt", action="store_true", help="plan an encrypted backup (default: as configured)")
+    plan.add_argument("--files", action="store_true", help="list every changed file")
+    plan.add_argument("--json", action="store_true", help="print the full plan as JSON")
+    plan.set_defaults(func=cmd_plan)
+
+    restore = commands.add_parser("restore", help="restore a backup")
+    restore.add_argument("--repo", help="owner/name on GitHub, or an absolute path to a local repository")
+    restore.add_argument("--paths", nargs="+", help="restore only these paths")
+    restore.add_argument("--commit", help="restore the tree as of this commit")
+    restore.add_argument("--depth", type=int, help="shallow history depth")
+    restore.add_argument("--update", action="store_true", help="update an existing restore in place")
+    restore.add_argument("--to", help="restore into this directory")
+    restore.add_argument("-q", "--quiet", action="store_true")
+    restore.set_defaults(func=cmd_restore)
+
+    status = commands.add_parser("status", help="show the configuration and the last backup")
+    status.set_defaults(func=cmd_status)
+
+    history = commands.add_parser("history", help="list recent backup runs")
+    history.add_argument("--limit", type=int, default=20)
+    order = history.add_mutually_exclusive_group()
+    order.add_argument("--slowest", action="store_true")
+    order.add_argument("--largest", action="store_true")
+    history.set_defaults(func=cmd_history)
+
+    maintain = commands.add_parser("maintain", help="thin old backups by the retention policy and repack")
+    maintain.add_argument("--repo", help="owner/name on GitHub, or an absolute path to a local repository")
+    maintain.add_argument("--mirror", action="append", help="mirror to rewrite as well (repeatable)")
+    maintain.add_argument("--dry-run", action="store_true", help="only report how many commits would be kept")
+    maintain.add_argument("--repack-only", action="store_true", help="skip retention, just repack incrementally")
+    maintain.add_argument("--measure", action="store_true", help="time a clone and a fetch before and after")
+    maintain.set_defaults(func=cmd_maintain)
+
+    verify = commands.add_parser("verify", help="check a restore, the staging copy or the remote for damage")
+    verify.add_argument("--target", choices=["restore", "staging", "remote"], default="restore")
+    verify.add_argument("--repo", help="repository to check with --target remote")
+    verify.add_argument("--path", help="directory to check (default: ~/autostash_restore or the staging repo)")
+    verify.add_argument("--paths", nargs="+", help="only check these folders or files")
+    verify.add_argument("--sample", type=float, default=100,
+                        help="re-hash a random selection holding this percentage of the bytes (default: 100)")
+    verify.add_argument("--seed", type=int, help="seed for the sample, to repeat an earlier check")
+    verify.add_argument("--workers", type=int, help="parallel hashing workers (default: CPU count)")
+    verify.set_defaults(func=cmd_verify)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
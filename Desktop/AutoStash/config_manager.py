@@ -1,21 +1,121 @@
 import json
 import os
+import threading
+from atomic_file import atomic_write_json
+from folder_rules import FolderRules
 
 CONFIG_PATH = os.path.expanduser("~/.config/autostash.json")
 
 class ConfigManager:
-    def __init__(self):
-        if not os.path.exists(CONFIG_PATH):
-            with open(CONFIG_PATH, 'w') as f:
-                json.dump({"folders": []}, f)
-    
+    """Settings in CONFIG_PATH, parsed once and re-read only when the file changes on disk
+
+    Writes go to a temporary file that replaces the config atomically, so a
+    crash or a concurrent reader never sees a half-written file.
+    """
+
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        self._data = None
+        self._stamp = None
+        self._lock = threading.Lock()
+        if not os.path.exists(self.path):
+            self._write({"folders": []})
+
+    def _load(self):
+        """The parsed config, reloaded if the file's mtime or size changed since the last read"""
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp != self._stamp:
+            with open(self.path, 'r') as f:
+                self._data = json.load(f)
+            self._stamp = stamp
+        return self._data
+
+    def _write(self, data):
+        atomic_write_json(self.path, data, indent=2)
+        st = os.stat(self.path)
+        self._data = data
+        self._stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _update(self, key, value):
+        with self._lock:
+            data = dict(self._load())
+            data[key] = value
+            self._write(data)
+
     def save_folders(self, folders):
-        with open(CONFIG_PATH, 'r+') as f:
-            data = json.load(f)
-            data["folders"] = folders
-            f.seek(0)
-            json.dump(data, f)
-    
+        self._update("folders", list(folders))
+
     def get_folders(self):
-        with open(CONFIG_PATH, 'r') as f:
-            return json.load(f)["folders"]
+        return list(self._load()["folders"])
+
+    def save_repo(self, repo_name):
+        self._update("repo", repo_name)
+
+    def get_repo(self):
+        return self._load().get("repo")
+
+    def get_mirrors(self):
+        """Extra repositories every backup is also pushed to"""
+        return list(self._load().get("mirrors", []))
+
+    def get_system_paths(self):
+        """Files and trees captured by "Backup system files"; None means the built-in set"""
+        return self._load().get("system_paths")
+
+    def get_retention(self):
+        """Retention policy settings (hourly_hours, daily_days, monthly_months); {} means the defaults"""
+        return dict(self._load().get("retention", {}))
+
+    def get_encryption(self):
+        """{"enabled": bool, "recipient": GPG key id or None}; every run of a repository should agree"""
+        data = self._load().get("encryption", {})
+        return {"enabled": bool(data.get("enabled")), "recipient": data.get("recipient")}
+
+    def save_encryption(self, enabled, recipient=None):
+        """Turn encryption on or off, keeping a previously set recipient unless one is given"""
+        with self._lock:
+            data = dict(self._load())
+            current = data.get("encryption", {})
+            data["encryption"] = {"enabled": bool(enabled), "recipient": recipient or current.get("recipient")}
+            self._write(data)
+
+    def get_packing(self):
+        """{"enabled": bool, "threshold": bytes}: whether small files are packed (see pack_store.py)"""
+        from pack_store import PACK_THRESHOLD
+        data = self._load().get("packing", {})
+        return {"enabled": bool(data.get("enabled")), "threshold": int(data.get("threshold") or PACK_THRESHOLD)}
+
+    def save_packing(self, enabled):
+        """Turn packing on or off, keeping a configured threshold"""
+        with self._lock:
+            data = dict(self._load())
+            data["packing"] = dict(data.get("packing", {}), enabled=bool(enabled))
+            self._write(data)
+
+    def get_defer_policy(self):
+        """DeferPolicy for scheduled runs (max_bytes, max_seconds, max_defer_hours); no limits by default"""
+        from planner import DeferPolicy
+        return DeferPolicy.from_config(self._load().get("defer"))
+
+    def get_limits(self):
+        """ResourceLimits for throttled (scheduled and daemon) runs; background priority unless configured"""
+        from throttle import ResourceLimits
+        data = self._load().get("limits")
+        return ResourceLimits.from_config(data) if data is not None else ResourceLimits.governed()
+
+    def get_rules(self, folder):
+        """FolderRules for folder; folders without an entry get the default excludes"""
+        return FolderRules.from_config(self._load().get("rules", {}).get(folder))
+
+    def get_all_rules(self, folders):
+        return {folder: self.get_rules(folder) for folder in folders}
+
+    def save_rules(self, folder, exclude=None, include=None, max_file_size=None):
+        """Store include/exclude patterns and a size limit for folder (None keeps the defaults)"""
+        with self._lock:
+            data = dict(self._load())
+            rules = dict(data.get("rules", {}))
+            rules[folder] = FolderRules(exclude, include, max_file_size).to_config()
+            data["rules"] = rules
+            self._write(data)
@@ -0,0 +1,107 @@
+import os
+import errno
+import fcntl
+import shutil
+import tempfile
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+COPY_CHUNK = 1024 * 1024
+
+# Errors meaning "this mechanism does not work here", as opposed to a real I/O failure.
+# The first set depends only on the filesystems involved, so it is remembered per device pair.
+_UNSUPPORTED_FS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS}
+_UNSUPPORTED = _UNSUPPORTED_FS | {errno.EINVAL, errno.EBADF, errno.EPERM}
+
+# (method, source device, destination device) combinations that already failed once
+_unsupported = set()
+
+
+def copy_file(src_path, dest_path):
+    """Copy src_path over dest_path with the cheapest mechanism that works; returns its name
+
+    Tries, per file: a reflink clone (FICLONE, shares extents on Btrfs/XFS),
+    os.copy_file_range (in-kernel, server-side on NFS), os.sendfile, then a
+    plain buffered copy. A mechanism that fails for a pair of filesystems is
+    not tried again for that pair. The copy is written to a temporary file
+    and renamed into place, with permissions and times copied like copy2.
+    """
+    dest_dir = os.path.dirname(dest_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=".autostash-copy-", dir=dest_dir)
+    try:
+        with open(src_path, "rb") as src, os.fdopen(fd, "wb") as dest:
+            method = _copy_fds(src.fileno(), dest.fileno(), os.fstat(src.fileno()), os.fstat(dest.fileno()))
+        shutil.copystat(src_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return method
+
+
+def _copy_fds(src_fd, dest_fd, src_st, dest_st):
+    devices = (src_st.st_dev, dest_st.st_dev)
+    size = src_st.st_size
+    copied = 0
+    for method, copy in (("reflink", _reflink), ("copy_file_range", _copy_file_range),
+                         ("sendfile", _sendfile), ("buffered", _buffered)):
+        if (method, *devices) in _unsupported:
+            continue
+        try:
+            copied = copy(src_fd, dest_fd, copied, size)
+            return method
+        except OSError as e:
+            if method == "buffered" or e.errno not in _UNSUPPORTED:
+                raise
+            if e.errno in _UNSUPPORTED_FS:
+                _unsupported.add((method, *devices))
+            # Carry on from wherever the failed mechanism stopped
+            copied = getattr(e, "copied", copied)
+            os.lseek(src_fd, copied, os.SEEK_SET)
+            os.lseek(dest_fd, copied, os.SEEK_SET)
+
+
+def _reflink(src_fd, dest_fd, copied, size):
+    if copied:
+        # A clone is all or nothing, so it cannot finish a partial copy
+        raise OSError(errno.EINVAL, "reflink cannot resume a partial copy")
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    return size
+
+
+def _copy_file_range(src_fd, dest_fd, copied, size):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    return _loop(lambda count: os.copy_file_range(src_fd, dest_fd, count), copied, size)
+
+
+def _sendfile(src_fd, dest_fd, copied, size):
+    return _loop(lambda count: os.sendfile(dest_fd, src_fd, None, count), copied, size)
+
+
+def _buffered(src_fd, dest_fd, copied, size):
+    while True:
+        data = os.read(src_fd, COPY_CHUNK)
+        if not data:
+            return copied
+        view = memoryview(data)
+        while view:
+            written = os.write(dest_fd, view)
+            view = view[written:]
+        copied += len(data)
+
+
+def _loop(step, copied, size):
+    """Call step(count) until the file is copied; a zero return means the source ended early"""
+    while copied < size:
+        try:
+            done = step(min(size - copied, 1 << 30))
+        except OSError as e:
+            e.copied = copied
+            raise
+        if done == 0:
+            break
+        copied += done
+    return copied
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Continuous backup: watch the configured folders with inotify and commit in debounced batches.
+
+Usage: python3 daemon.py [--debounce SECONDS] [--max-delay SECONDS]
+"""
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import logging
+import argparse
+from atomic_file import atomic_write_json
+from folder_rules import FolderRules
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+DAEMON_STATE = os.path.expanduser("~/.autostash/daemon_state.json")
+
+
+class Inotify:
+    """Minimal ctypes binding to the Linux inotify API"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        """Yield (wd, mask, cookie, name) for every queued event"""
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                yield wd, mask, cookie, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class BackupDaemon:
+    """Keeps a dirty set of changed paths and flushes it through BackupManager.run(touched=...)
+
+    Bursts of events are coalesced until nothing has changed for `debounce`
+    seconds, or `max_delay` seconds after the first pending change. Pending
+    paths are persisted, so a batch interrupted by a crash or restart is
+    replayed. With catch_up, start() also marks every folder dirty once its
+    watches exist, so changes made while stopped go out with the first flush
+    (a stat walk with no re-hashing, thanks to the file index) and nothing
+    changed during it is missed; like any batch it is retried if it fails.
+    Directories that could not be watched (for example because
+    fs.inotify.max_user_watches is exhausted) are rescanned every
+    `rescan_interval` seconds instead.
+    """
+
+    def __init__(self, folders, repo_name, backup, debounce=5.0, max_delay=60.0,
+                 rescan_interval=300.0, state_path=DAEMON_STATE, rules=None, run_options=None, catch_up=False):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        # Excluded directories are never watched, and events for excluded paths are dropped
+        self.rules = {folder: (rules or {}).get(folder) or FolderRules() for folder in self.folders}
+        self.repo_name = repo_name
+        self.backup = backup
+        # Extra keyword arguments for every BackupManager.run, e.g. encrypt
+        self.run_options = dict(run_options or {})
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.rescan_interval = rescan_interval
+        self.catch_up = catch_up
+        self.state_path = state_path
+        self.logger = logging.getLogger('autostash')
+        self.inotify = None
+        self.watches = {}  # wd -> (folder, relative directory)
+        self.unwatched = set()  # (folder, relative directory) rescanned periodically
+        self.dirty = {}  # folder -> set of relative paths
+        self.first_dirty = None
+        self.last_event = None
+        self.last_rescan = time.monotonic()
+        self.retry_at = 0.0
+        self.running = False
+        self._wake_write = None
+
+    def start(self):
+        self.inotify = Inotify()
+        for folder in self.folders:
+            self._watch_tree(folder, "")
+        self._load_state()
+        if self.dirty:
+            self.logger.info(f"Replaying {sum(len(r) for r in self.dirty.values())} pending paths from last session")
+        if self.catch_up:
+            # Watches are in place, so anything that changes from here on is seen by them
+            for folder in self.folders:
+                self.dirty.setdefault(folder, set()).add("")
+        if self.dirty:
+            self.first_dirty = self.last_event = time.monotonic() - self.debounce
+
+    def run_forever(self):
+        self.start()
+        self.running = True
+        poller = select.poll()
+        poller.register(self.inotify.fd, select.POLLIN)
+        # Signals only set a flag, so route them through a pipe to wake up poll()
+        wake_read, self._wake_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        poller.register(wake_read, select.POLLIN)
+        try:
+            previous_wakeup = signal.set_wakeup_fd(self._wake_write)
+        except ValueError:
+            previous_wakeup = None  # not the main thread; stop() wakes the loop itself
+        try:
+            while self.running:
+                poller.poll(self._next_timeout() * 1000)
+                try:
+                    os.read(wake_read, 512)
+                except BlockingIOError:
+                    pass
+                self._drain_events()
+                self._maybe_rescan()
+                if self._due():
+                    self.flush()
+        finally:
+            if previous_wakeup is not None:
+                signal.set_wakeup_fd(previous_wakeup)
+            wake_write, self._wake_write = self._wake_write, None
+            os.close(wake_read)
+            os.close(wake_write)
+            self._save_state()
+            self.inotify.close()
+
+    def stop(self, *args):
+        self.running = False
+        if self._wake_write is not None:
+            try:
+                os.write(self._wake_write, b"\0")
+            except OSError:
+                pass
+
+    def _watch_tree(self, folder, rel_dir):
+        """Watch a directory and everything below it, recording what could not be watched"""
+        top = os.path.join(folder, rel_dir) if rel_dir else folder
+        rules = self.rules[folder]
+        if rel_dir and not rules.keep_path(rel_dir, is_dir=True):
+            return
+        for dirpath, dirs, files in os.walk(top):
+            rel = os.path.relpath(dirpath, folder)
+            rel = "" if rel == "." else rel
+            dirs[:] = [d for d in dirs if not rules.prune_dir(os.path.join(rel, d))]
+            try:
+                wd = self.inotify.add_watch(dirpath)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    if not self.unwatched:
+                        self.logger.warning("inotify watch limit reached; falling back to periodic rescans "
+                                            "(raise fs.inotify.max_user_watches to avoid this)")
+                    self.unwatched.add((folder, rel))
+                    dirs[:] = []
+                    continue
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            self.watches[wd] = (folder, rel)
+
+    def _drain_events(self):
+        for wd, mask, cookie, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped: only a rescan of everything is safe
+                self.logger.warning("inotify queue overflowed; rescanning all folders")
+                for folder in self.folders:
+                    self._mark(folder, "")
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            folder, rel_dir = self.watches[wd]
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self._mark(folder, rel_dir)
+                continue
+            rel = os.path.join(rel_dir, name) if rel_dir else name
+            if not self.rules[folder].keep_path(rel, is_dir=bool(mask & IN_ISDIR)):
+                continue
+            self._mark(folder, rel)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may land in a new directory before its watch exists; the dirty mark covers them
+                self._watch_tree(folder, rel)
+
+    def _mark(self, folder, rel):
+        now = time.monotonic()
+        self.dirty.setdefault(folder, set()).add(rel)
+        if self.first_dirty is None:
+            self.first_dirty = now
+        self.last_event = now
+
+    def _maybe_rescan(self):
+        if not self.unwatched or time.monotonic() - self.last_rescan < self.rescan_interval:
+            return
+        self.last_rescan = time.monotonic()
+        for folder, rel in self.unwatched:
+            self._mark(folder, rel)
+
+    def _due(self):
+        if not self.dirty:
+            return False
+        now = time.monotonic()
+        if now < self.retry_at:
+            return False
+        return now - self.last_event >= self.debounce or now - self.first_dirty >= self.max_delay
+
+    def _next_timeout(self):
+        if not self.dirty:
+            return self.rescan_interval if self.unwatched else 3600
+        now = time.monotonic()
+        due = min(self.last_event + self.debounce, self.first_dirty + self.max_delay)
+        return max(0.05, max(due, self.retry_at) - now)
+
+    def flush(self):
+        """Back up the pending paths in one commit"""
+        batch, self.dirty = self.dirty, {}
+        self.first_dirty = self.last_event = None
+        # Persist first so a crash mid-backup replays this batch on restart
+        self._save_state(batch)
+        try:
+            self.backup.run(list(batch), self.repo_name, touched=batch, rules=self.rules, **self.run_options)
+        except Exception as e:
+            for folder, rels in batch.items():
+                self.dirty.setdefault(folder, set()).update(rels)
+            self.first_dirty = self.last_event = time.monotonic()
+            self.retry_at = time.monotonic() + 60
+            self.logger.error(f"Daemon batch failed, retrying in 60s: {str(e)}")
+        self._save_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        for folder, rels in saved.get("dirty", {}).items():
+            if folder in self.folders:
+                self.dirty.setdefault(folder, set()).update(rels)
+
+    def _save_state(self, extra=None):
+        pending = {folder: set(rels) for folder, rels in self.dirty.items()}
+        for folder, rels in (extra or {}).items():
+            pending.setdefault(folder, set()).update(rels)
+        atomic_write_json(self.state_path, {"dirty": {folder: sorted(rels) for folder, rels in pending.items()}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoStash continuous backup daemon")
+    parser.add_argument("--debounce", type=float, default=5.0)
+    parser.add_argument("--max-delay", type=float, default=60.0)
+    parser.add_argument("--rescan-interval", type=float, default=300.0)
+    args = parser.parse_args()
+
+    from backup_logic import BackupManager
+    from config_manager import ConfigManager
+
+    config = ConfigManager()
+    folders = config.get_folders()
+    repo_name = config.get_repo()
+    if not folders or not repo_name:
+        sys.exit("Configure folders and a repository in the AutoStash GUI first")
+    repos = [repo_name] + config.get_mirrors()
+
+    packing = config.get_packing()
+    backup = BackupManager(limits=config.get_limits(), packing=packing["enabled"],
+                           pack_threshold=packing["threshold"])
+    rules = config.get_all_rules(folders)
+    encryption = config.get_encryption()
+    run_options = {"encrypt": encryption["enabled"], "gpg_recipient": encryption["recipient"]}
+    daemon = BackupDaemon(folders, repos, backup, args.debounce, args.max_delay, args.rescan_interval,
+                          rules=rules, run_options=run_options, catch_up=True)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""Encrypted backups: files are compressed and encrypted before they reach the staging repo.
+
+Each file is read in BLOCK_SIZE blocks that are zlib-compressed and sealed
+with AES-256-GCM on a thread pool (both release the GIL), and written in
+order to `<name>.autostash-enc` next to where the plain copy would go. At
+most a few blocks per worker are in memory and no plaintext is written
+anywhere but the restore target.
+
+A block's nonce is derived from its own content (an HMAC of the compressed
+block and its position), so an unchanged file encrypts to the same bytes
+every run and git stores no new blob for it; the cost is that identical
+files are recognisable as identical, which git's own dedup reveals anyway.
+
+GPG protects only the 256-bit data key, stored in the repository as
+KEY_FILE and encrypted to a GPG recipient or, without one, with a
+passphrase (taken from AUTOSTASH_GPG_PASSPHRASE for unattended runs, else
+asked for by gpg-agent). Encrypting every file with gpg itself would give
+different ciphertext each run and a gpg process per file.
+
+The AES implementation comes from the optional `cryptography` package,
+imported only when encryption is used.
+"""
+import io
+import os
+import json
+import hmac
+import zlib
+import struct
+import hashlib
+import tempfile
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ENCRYPTED_SUFFIX = ".autostash-enc"
+KEY_FILE = ".autostash-key.gpg"
+BLOCK_SIZE = 1024 * 1024
+MAGIC = b"AUTOSTASH-ENC1\n"
+NONCE_SIZE = 12
+COMPRESS_LEVEL = 6
+PASSPHRASE_ENV = "AUTOSTASH_GPG_PASSPHRASE"
+
+_RAW, _ZLIB = b"\0", b"\1"
+
+
+def is_encrypted(path):
+    return path.endswith(ENCRYPTED_SUFFIX)
+
+
+def _aead_class():
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise Exception("Encrypted backups need the 'cryptography' package (pip install cryptography)")
+    return AESGCM
+
+
+class FileCipher:
+    """Streams files into and out of the encrypted format with a pool of workers"""
+
+    def __init__(self, data_key, workers=1):
+        self._aead = _aead_class()(hmac.new(data_key, b"autostash file encryption", hashlib.sha256).digest())
+        self._nonce_key = hmac.new(data_key, b"autostash block nonces", hashlib.sha256).digest()
+        self.workers = max(1, workers)
+        self.window = self.workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def encrypt_file(self, src_path, dest_path):
+        """Write the encrypted form of src_path to dest_path; returns the bytes written"""
+        with open(src_path, "rb", buffering=0) as src:
+            st = os.fstat(src.fileno())
+            return self._write_encrypted(src, st.st_size, st.st_mode & 0o7777, st.st_mtime, dest_path)
+
+    def encrypt_bytes(self, data, dest_path, mode=0o644, mtime=0):
+        """Like encrypt_file, for small in-memory content such as a verification manifest"""
+        return self._write_encrypted(io.BytesIO(data), len(data), mode, mtime, dest_path)
+
+    def _write_encrypted(self, src, expected_size, mode, mtime, dest_path):
+        dest_dir = os.path.dirname(dest_path)
+        os.makedirs(dest_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".autostash-enc-", dir=dest_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                digest = hashlib.sha1(f"blob {expected_size}\0".encode())
+                size = 0
+                out.write(MAGIC)
+                pending = deque()
+                block = src.read(BLOCK_SIZE)
+                index = 0
+                while True:
+                    following = src.read(BLOCK_SIZE) if block else b""
+                    digest.update(block)
+                    size += len(block)
+                    pending.append(self._executor.submit(self._seal_block, index, block, not following))
+                    # Keep reading ahead of the workers, but never more than a window of blocks
+                    while len(pending) >= self.window or (pending and not following):
+                        sealed = pending.popleft().result()
+                        out.write(struct.pack(">I", len(sealed)) + sealed)
+                    if not following:
+                        break
+                    block, index = following, index + 1
+                # A file that changed size while being read has no valid digest; the next run rewrites it
+                recorded = digest.hexdigest() if size == expected_size else None
+                trailer = self._seal(json.dumps({"digest": recorded, "size": size, "mode": mode,
+                                                 "mtime": mtime}).encode(), MAGIC + b"trailer")
+                out.write(trailer + struct.pack(">I", len(trailer)))
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return os.path.getsize(dest_path)
+
+    def read_info(self, path):
+        """The trailer of an encrypted file: plain git blob digest, size, mode and mtime"""
+        with open(path, "rb") as f:
+            f.seek(-4, os.SEEK_END)
+            length = struct.unpack(">I", f.read(4))[0]
+            f.seek(-4 - length, os.SEEK_END)
+            return json.loads(self._open(f.read(length), MAGIC + b"trailer"))
+
+    def decrypt_file(self, src_path, dest_path, parallel=True):
+        """Restore the plain file from src_path to dest_path, checking it against its digest"""
+        dest_dir = os.path.dirname(dest_path) or "."
+        fd, tmp_path = tempfile.mkstemp(prefix=".autostash-dec-", dir=dest_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                info, digest = self._decrypt(src_path, out.write, parallel)
+            if info["digest"] is not None and digest != info["digest"]:
+                raise Exception(f"Decrypted {src_path} does not match its recorded digest")
+            os.chmod(tmp_path, info["mode"])
+            os.utime(tmp_path, (info["mtime"], info["mtime"]))
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def digest_file(self, path, parallel=True):
+        """Git blob digest of the plain content, decrypting without writing anything"""
+        return self._decrypt(path, lambda data: None, parallel)[1]
+
+    def read_bytes(self, path):
+        """The plain content of a small encrypted file"""
+        parts = []
+        info, digest = self._decrypt(path, parts.append, parallel=False)
+        if info["digest"] is not None and digest != info["digest"]:
+            raise Exception(f"Decrypted {path} does not match its recorded digest")
+        return b"".join(parts)
+
+    def _decrypt(self, src_path, sink, parallel):
+        """Feed each plain block of src_path to sink in order; returns (trailer, git blob digest)"""
+        info = self.read_info(src_path)
+        with open(src_path, "rb") as src:
+            end = os.fstat(src.fileno()).st_size
+            src.seek(-4, os.SEEK_END)
+            end -= 4 + struct.unpack(">I", src.read(4))[0]
+            src.seek(0)
+            if src.read(len(MAGIC)) != MAGIC:
+                raise Exception(f"{src_path} is not an AutoStash encrypted file")
+            digest = hashlib.sha1(f"blob {info['size']}\0".encode())
+            pending = deque()
+            index = 0
+            while src.tell() < end:
+                length = struct.unpack(">I", src.read(4))[0]
+                sealed = src.read(length)
+                last = src.tell() >= end
+                if parallel:
+                    pending.append(self._executor.submit(self._open_block, index, sealed, last))
+                else:
+                    pending.append(_Done(self._open_block(index, sealed, last)))
+                while len(pending) >= self.window or (pending and last):
+                    data = pending.popleft().result()
+                    digest.update(data)
+                    sink(data)
+                index += 1
+        return info, digest.hexdigest()
+
+    def decrypt_tree(self, root):
+        """Replace every encrypted file under root with its plain content; returns how many
+
+        Files of one block are decrypted several at a time; larger ones one at
+        a time with their blocks spread over the pool, so memory stays bounded.
+        """
+        small, large = [], []
+        for dirpath, dirs, names in os.walk(root):
+            if ".git" in dirs:
+                dirs.remove(".git")
+            for name in names:
+                if is_encrypted(name):
+                    path = os.path.join(dirpath, name)
+                    (small if os.path.getsize(path) <= BLOCK_SIZE else large).append(path)
+
+        def restore(path, parallel):
+            self.decrypt_file(path, path[:-len(ENCRYPTED_SUFFIX)], parallel)
+            os.remove(path)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as files:
+            list(files.map(lambda path: restore(path, False), small))
+        for path in large:
+            restore(path, True)
+        return len(small) + len(large)
+
+    def _seal_block(self, index, block, last):
+        compressed = zlib.compress(block, COMPRESS_LEVEL)
+        payload = _ZLIB + compressed if len(compressed) < len(block) else _RAW + block
+        return self._seal(payload, MAGIC + struct.pack(">QB", index, last))
+
+    def _open_block(self, index, sealed, last):
+        payload = self._open(sealed, MAGIC + struct.pack(">QB", index, last))
+        return zlib.decompress(payload[1:]) if payload[:1] == _ZLIB else payload[1:]
+
+    def _seal(self, data, aad):
+        nonce = hmac.new(self._nonce_key, aad + data, hashlib.sha256).digest()[:NONCE_SIZE]
+        return nonce + self._aead.encrypt(nonce, data, aad)
+
+    def _open(self, sealed, aad):
+        from cryptography.exceptions import InvalidTag
+        try:
+            return self._aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], aad)
+        except InvalidTag:
+            raise Exception("Encrypted data is corrupt, truncated or was written with a different key")
+
+
+class _Done:
+    """A finished result with the Future interface, for work done inline"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+def load_key(repo_root):
+    """Decrypt the repository's data key with gpg"""
+    with open(os.path.join(repo_root, KEY_FILE), "rb") as f:
+        return unwrap_key(f.read())
+
+
+def unwrap_key(wrapped):
+    """Decrypt the contents of a KEY_FILE, e.g. one read straight from a git object"""
+    key = _gpg(["--decrypt"], wrapped)
+    if len(key) != 32:
+        raise Exception(f"{KEY_FILE} does not hold an AutoStash data key")
+    return key
+
+
+def load_or_create_key(repo_root, recipient=None):
+    """The repository's data key, generating and storing a GPG-protected one on first use"""
+    if os.path.exists(os.path.join(repo_root, KEY_FILE)):
+        return load_key(repo_root)
+    key = os.urandom(32)
+    args = ["--encrypt", "--recipient", recipient] if recipient else ["--symmetric", "--cipher-algo", "AES256"]
+    wrapped = _gpg(args, key)
+    fd, tmp_path = tempfile.mkstemp(prefix=".autostash-key-", dir=repo_root)
+    with os.fdopen(fd, "wb") as f:
+        f.write(wrapped)
+    os.replace(tmp_path, os.path.join(repo_root, KEY_FILE))
+    return key
+
+
+def _gpg(args, data):
+    command = ["gpg", "--batch", "--yes", "--quiet"]
+    passphrase = os.environ.get(PASSPHRASE_ENV)
+    read_fd = None
+    if passphrase:
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, passphrase.encode())
+        os.close(write_fd)
+        command += ["--pinentry-mode", "loopback", "--passphrase-fd", str(read_fd)]
+    try:
+        result = subprocess.run(command + args, input=data, capture_output=True,
+                                pass_fds=(read_fd,) if read_fd is not None else ())
+    except FileNotFoundError:
+        raise Exception("Encrypted backups need gpg to protect the data key")
+    finally:
+        if read_fd is not None:
+            os.close(read_fd)
+    if result.returncode != 0:
+        raise Exception(f"gpg failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from atomic_file import atomic_write_json
+
+INDEX_VERSION = 1
+MIN_READ_SIZE = 64 * 1024
+MAX_READ_SIZE = 4 * 1024 * 1024
+
+
+def read_size_for(size):
+    """Small files are read in one call, large ones in big sequential blocks"""
+    return min(max(size, MIN_READ_SIZE), MAX_READ_SIZE)
+
+
+# Read-rate limiter for hashing in a worker process (set by the pool initializer)
+_process_limiter = None
+
+
+def git_blob_digest(path, size, limiter=None):
+    """Hash a file the way git hashes a blob, so digests can be compared to tree entries"""
+    limiter = limiter or _process_limiter
+    digest = hashlib.sha1(f"blob {size}\0".encode())
+    block = read_size_for(size)
+    with open(path, 'rb', buffering=0) as f:
+        while chunk := f.read(block):
+            if limiter:
+                limiter.consume(len(chunk))
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _init_hash_process(rate):
+    global _process_limiter
+    from throttle import RateLimiter
+    _process_limiter = RateLimiter(rate)
+
+
+class FileIndex:
+    """Persistent path -> (size, mtime_ns, inode, digest) cache used for change detection"""
+
+    def __init__(self, index_path, workers=1, use_processes=False, read_limiter=None):
+        self.index_path = index_path
+        self.workers = max(1, workers)
+        self.use_processes = use_processes
+        # Optional throttle.RateLimiter every file read for hashing is charged to
+        self.read_limiter = read_limiter
+        self.entries = {}
+        self.dirty = False
+        self.last_scan = {}
+        self.load()
+
+    def load(self):
+        """Load the index from disk, starting over if it is missing or corrupt"""
+        self.entries = {}
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION:
+                raise ValueError("index version mismatch")
+            for path, entry in data["entries"].items():
+                size, mtime_ns, inode, digest = entry
+                self.entries[path] = (int(size), int(mtime_ns), int(inode), str(digest))
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Corrupt or foreign index: drop it and let the next run rebuild it
+            self.entries = {}
+            self.dirty = True
+
+    def save(self):
+        """Atomically replace the on-disk index with the in-memory one"""
+        if not self.dirty:
+            return
+        atomic_write_json(self.index_path, {"version": INDEX_VERSION, "entries": self.entries}, fsync=True)
+        self.dirty = False
+
+    def lookup(self, path, st):
+        """Return the cached digest if the stat data still matches, else None"""
+        entry = self.entries.get(path)
+        if entry and entry[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return entry[3]
+        return None
+
+    def update(self, path, st, digest):
+        entry = (st.st_size, st.st_mtime_ns, st.st_ino, digest)
+        if self.entries.get(path) != entry:
+            self.entries[path] = entry
+            self.dirty = True
+
+    def digest(self, path, st=None):
+        """Digest of a file, hashing it only when its stat data changed"""
+        if st is None:
+            st = os.stat(path)
+        digest = self.lookup(path, st)
+        if digest is None:
+            digest = git_blob_digest(path, st.st_size, self.read_limiter)
+            self.update(path, st, digest)
+        return digest
+
+    def record(self, path, digest):
+        """Record a digest already known for path, e.g. a file we just copied"""
+        self.update(path, os.stat(path), digest)
+
+    def stat_tree(self, root, rules=None):
+        """Yield (relative path, stat, cached digest or None) for every file under root, reading none of them"""
+        # Slicing off the root is much cheaper than os.path.relpath once per file
+        start = len(os.path.join(root, ""))
+        for filepath, st in self._walk(root, rules):
+            yield filepath[start:], st, self.lookup(filepath, st)
+
+    def scan_tree(self, root):
+        """Return {relative path: digest} for every file under root"""
+        return self.scan_trees([root])[root]
+
+    def scan_trees(self, roots, progress=None, hasher=None, rules=None):
+        """Scan several trees at once, hashing changed files on a shared worker pool
+
+        Returns {root: {relative path: digest}}. Files are listed in sorted walk
+        order and hashed results are stored back in that order, so the output
+        does not depend on how the pool scheduled the work. progress, if given,
+        is a ProgressTracker credited with the bytes of each file hashed.
+        hasher, if given, replaces the built-in pool: it takes a list of paths
+        and returns their git blob ids in the same order. rules optionally maps
+        a root to the FolderRules that decide what under it is scanned.
+        """
+        rules = rules or {}
+        walk_started = time.perf_counter()
+        if self.workers > 1 and len(roots) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(roots))) as executor:
+                listings = dict(zip(roots, executor.map(lambda root: self._walk(root, rules.get(root)), roots)))
+        else:
+            listings = {root: self._walk(root, rules.get(root)) for root in roots}
+        walk_seconds = time.perf_counter() - walk_started
+        hash_started = time.perf_counter()
+        pending = []
+        for files in listings.values():
+            for filepath, st in files:
+                if self.lookup(filepath, st) is None:
+                    pending.append((filepath, st))
+        if pending:
+            if progress:
+                progress.set_phase("hash", f"Hashing {len(pending)} changed files...")
+                progress.add_work(sum(st.st_size for filepath, st in pending))
+            if hasher:
+                digests = hasher([filepath for filepath, st in pending])
+            else:
+                digests = self._hash_many(pending)
+            for (filepath, st), digest in zip(pending, digests):
+                self.update(filepath, st, digest)
+                if progress:
+                    progress.advance(st.st_size)
+
+        self.last_scan = {
+            "walk_seconds": walk_seconds,
+            "hash_seconds": time.perf_counter() - hash_started,
+            "files_walked": sum(len(files) for files in listings.values()),
+            "files_hashed": len(pending),
+            "bytes_hashed": sum(st.st_size for filepath, st in pending),
+        }
+        manifests = {}
+        for root, files in listings.items():
+            manifests[root] = {
+                os.path.relpath(filepath, root): self.entries[filepath][3]
+                for filepath, st in files
+            }
+            self._prune(root, {filepath for filepath, st in files})
+        return manifests
+
+    def _walk(self, root, rules=None):
+        """List (path, stat) for every regular file under root in a stable order
+
+        With rules, excluded directories are pruned before os.walk descends
+        into them and files are filtered by pattern and size.
+        """
+        files = []
+        for dirpath, dirs, names in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root)
+            rel_dir = "" if rel_dir == "." else rel_dir + "/"
+            if rules:
+                dirs[:] = [d for d in dirs if not rules.prune_dir(rel_dir + d)]
+            dirs.sort()
+            for name in sorted(names):
+                filepath = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                if rules and not rules.keep_file(rel_dir + name, st.st_size):
+                    continue
+                files.append((filepath, st))
+        return files
+
+    def _hash_many(self, pending):
+        paths = [filepath for filepath, st in pending]
+        sizes = [st.st_size for filepath, st in pending]
+        limiters = [self.read_limiter] * len(paths)
+        if self.workers == 1 or len(pending) == 1:
+            yield from map(git_blob_digest, paths, sizes, limiters)
+            return
+        if self.use_processes:
+            # A limiter cannot be shared across processes, so each worker gets an equal share of the rate
+            rate = self.read_limiter.rate / self.workers if self.read_limiter else None
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_hash_process if rate else None,
+                                           initargs=(rate,) if rate else ())
+            limiters = [None] * len(paths)
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            chunksize = 16 if self.use_processes else 1
+            yield from executor.map(git_blob_digest, paths, sizes, limiters, chunksize=chunksize)
+        finally:
+            # On cancellation, drop queued work instead of hashing the rest of the tree
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _prune(self, root, seen):
+        """Forget files under root that were not seen in the latest scan"""
+        prefix = os.path.join(root, "")
+        stale = [p for p in self.entries if p.startswith(prefix) and p not in seen]
+        for path in stale:
+            del self.entries[path]
+        if stale:
+            self.dirty = True
@@ -0,0 +1,130 @@
+import os
+import re
+
+# Never worth backing up: repositories of their own, virtualenvs, bytecode and editor swap files
+DEFAULT_EXCLUDES = [".git/", "venv/", ".venv/", "__pycache__/", "*.pyc", "*.swp", "*.swo"]
+
+
+class Pattern:
+    """One gitignore-style pattern
+
+    A trailing "/" matches directories only. A pattern with another "/" is
+    anchored at the folder root, otherwise it matches a name at any depth.
+    "*" and "?" stay within one path component, "**" spans several, and a
+    leading "!" re-includes what an earlier pattern excluded.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.negated = text.startswith("!")
+        if self.negated:
+            text = text[1:]
+        self.dir_only = text.endswith("/")
+        text = text.rstrip("/")
+        self.anchored = "/" in text
+        self.regex = re.compile(_translate(text.lstrip("/")) + r"\Z")
+
+    def matches(self, rel, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        target = rel if self.anchored else rel.rsplit("/", 1)[-1]
+        return self.regex.match(target) is not None
+
+
+class FolderRules:
+    """Which paths under one backed-up folder are included
+
+    Paths are relative to the folder and use "/" separators. The scan calls
+    prune_dir for each directory before descending and keep_file for each
+    file, so excluded subtrees are never walked at all.
+    """
+
+    def __init__(self, exclude=None, include=None, max_file_size=None, prefix=""):
+        self.exclude_patterns = list(DEFAULT_EXCLUDES if exclude is None else exclude)
+        self.include_patterns = list(include or [])
+        self.exclude = [Pattern(text) for text in self.exclude_patterns]
+        self.include = [Pattern(text) for text in self.include_patterns]
+        self.max_file_size = max_file_size
+        self.prefix = prefix
+
+    def for_subtree(self, rel):
+        """The same rules, for paths given relative to a subdirectory of the folder"""
+        return FolderRules(self.exclude_patterns, self.include_patterns, self.max_file_size, self._full(rel))
+
+    def _full(self, rel):
+        rel = rel.replace(os.sep, "/")
+        if not self.prefix:
+            return rel
+        return f"{self.prefix}/{rel}" if rel else self.prefix
+
+    def _excluded(self, rel, is_dir):
+        excluded = False
+        for pattern in self.exclude:
+            if pattern.matches(rel, is_dir):
+                excluded = not pattern.negated
+        return excluded
+
+    def prune_dir(self, rel):
+        """True if the directory at rel should not be walked"""
+        return self._excluded(self._full(rel), True)
+
+    def keep_file(self, rel, size):
+        """True if the file at rel is backed up; its directories are assumed already checked"""
+        if self.max_file_size is not None and size > self.max_file_size:
+            return False
+        full = self._full(rel)
+        if self._excluded(full, False):
+            return False
+        return not self.include or any(pattern.matches(full, False) for pattern in self.include)
+
+    def keep_path(self, rel, size=0, is_dir=False):
+        """Like keep_file, but also checks every parent directory (for paths that did not come from a walk)"""
+        parts = self._full(rel).split("/")
+        last = len(parts) if is_dir else len(parts) - 1
+        for depth in range(1, last + 1):
+            if self._excluded("/".join(parts[:depth]), True):
+                return False
+        return is_dir or self.keep_file(rel, size)
+
+    def to_config(self):
+        return {"exclude": self.exclude_patterns, "include": self.include_patterns,
+                "max_file_size": self.max_file_size}
+
+    @classmethod
+    def from_config(cls, data):
+        data = data or {}
+        return cls(data.get("exclude"), data.get("include"), data.get("max_file_size"))
+
+
+def _translate(pattern):
+    """Regex for a glob where * and ? do not cross "/" but ** does"""
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
@@ -0,0 +1,163 @@
+import os
+import stat
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DirectIngest:
+    """Write backups straight into a bare repository's object database
+
+    Changed files are read once by `git hash-object -w`, which stores the blob
+    and returns its id. The new commit is then built with `git fast-import`
+    from the parent commit plus only the changed and deleted paths, so there is
+    no checked-out mirror and unchanged files are never read at all.
+    """
+
+    def __init__(self, git_dir, workers=1, read_limiter=None, push_wrapper=()):
+        self.git_dir = git_dir
+        self.workers = max(1, workers)
+        self.read_limiter = read_limiter
+        # Command prefix for pushes, e.g. trickle for a bandwidth cap
+        self.push_wrapper = list(push_wrapper)
+
+    def _git(self, *args, input=None, timeout=None, wrapper=()):
+        result = subprocess.run(
+            [*wrapper, "git", "--git-dir", self.git_dir, *args],
+            input=input, capture_output=True, timeout=timeout,
+        )
+        if result.returncode != 0:
+            raise Exception(f"git {args[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
+
+    def ensure_repo(self, repo_url):
+        """Clone the remote as a bare repository, or fetch into the existing one"""
+        if not os.path.exists(self.git_dir):
+            os.makedirs(os.path.dirname(self.git_dir), exist_ok=True)
+            result = subprocess.run(["git", "clone", "--bare", "-q", repo_url, self.git_dir],
+                                    capture_output=True)
+            if result.returncode != 0:
+                raise Exception(f"Cloning failed: {result.stderr.decode(errors='replace').strip()}")
+        else:
+            self._git("fetch", "-q", "origin", "+refs/heads/*:refs/heads/*")
+
+    def branch(self):
+        return self._git("symbolic-ref", "--short", "HEAD").decode().strip()
+
+    def head(self, branch):
+        """Commit id of branch, or None for an empty repository"""
+        result = subprocess.run(
+            ["git", "--git-dir", self.git_dir, "rev-parse", "--verify", "-q", f"refs/heads/{branch}"],
+            capture_output=True,
+        )
+        return result.stdout.decode().strip() or None
+
+    def tree_entries(self, commit, prefixes):
+        """Return {path: (mode, blob id)} for files under the given top-level prefixes"""
+        if commit is None:
+            return {}
+        output = self._git("ls-tree", "-r", "-z", "--full-tree", commit, "--", *prefixes)
+        entries = {}
+        for record in output.split(b"\0"):
+            if not record:
+                continue
+            meta, path = record.split(b"\t", 1)
+            mode, kind, sha = meta.decode().split(" ")
+            if kind == "blob":
+                entries[os.fsdecode(path)] = (mode, sha)
+        return entries
+
+    def hash_objects(self, paths):
+        """Store each file as a blob and return the blob ids, in the order given"""
+        if not paths:
+            return []
+        batches = [paths[i::self.workers] for i in range(min(self.workers, len(paths)))]
+
+        def run_batch(batch):
+            if self.read_limiter:
+                return [sha for group in self._paced_groups(batch) for sha in run_group(group)]
+            return run_group(batch)
+
+        def run_group(group):
+            data = b"".join(os.fsencode(p) + b"\n" for p in group)
+            return self._git("hash-object", "-w", "--no-filters", "--stdin-paths", input=data).decode().split()
+
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            results = list(executor.map(run_batch, batches))
+        # Undo the round-robin split so ids line up with paths again
+        digests = [None] * len(paths)
+        for offset, batch_digests in enumerate(results):
+            digests[offset::len(batches)] = batch_digests
+        return digests
+
+    def _paced_groups(self, paths):
+        """Split paths into groups of about one second's worth of reads, charging each to the limiter first"""
+        group, nbytes = [], 0
+        for path in paths:
+            size = os.path.getsize(path)
+            if group and nbytes + size > self.read_limiter.rate:
+                self.read_limiter.consume(nbytes)
+                yield group
+                group, nbytes = [], 0
+            group.append(path)
+            nbytes += size
+        if group:
+            self.read_limiter.consume(nbytes)
+            yield group
+
+    def missing_objects(self, shas):
+        """Subset of shas not present in the object database"""
+        if not shas:
+            return set()
+        output = self._git("cat-file", "--batch-check", input="".join(f"{sha}\n" for sha in shas).encode())
+        return {line.split()[0] for line in output.decode().splitlines() if line.endswith(" missing")}
+
+    def commit(self, branch, parent, changes, deletes, message):
+        """Create a commit on branch from parent with changes {path: (mode, sha)} and deleted paths"""
+        ident = self._git("var", "GIT_COMMITTER_IDENT").decode().strip()
+        msg = message.encode()
+        lines = [f"commit refs/heads/{branch}".encode(), f"committer {ident}".encode(),
+                 f"data {len(msg)}".encode(), msg]
+        if parent:
+            lines.append(f"from {parent}".encode())
+        for path in deletes:
+            lines.append(b"D " + _quote(path))
+        for path, (mode, sha) in sorted(changes.items()):
+            lines.append(f"M {mode} {sha} ".encode() + _quote(path))
+        lines.append(b"done")
+        self._git("fast-import", "--quiet", "--done", input=b"\n".join(lines) + b"\n")
+        return self.head(branch)
+
+    def set_remote(self, remote, url):
+        """Add remote, or point it at url if it already exists"""
+        current = subprocess.run(["git", "--git-dir", self.git_dir, "remote", "get-url", remote],
+                                 capture_output=True)
+        if current.returncode != 0:
+            self._git("remote", "add", remote, url)
+        elif current.stdout.decode().strip() != url:
+            self._git("remote", "set-url", remote, url)
+
+    def remote_head(self, remote, branch):
+        """Commit id last pushed to (or fetched from) remote's branch, or None"""
+        result = subprocess.run(
+            ["git", "--git-dir", self.git_dir, "rev-parse", "--verify", "-q", f"refs/remotes/{remote}/{branch}"],
+            capture_output=True,
+        )
+        return result.stdout.decode().strip() or None
+
+    def push(self, branch, remote="origin", timeout=None):
+        self._git("push", "-q", remote, f"refs/heads/{branch}:refs/heads/{branch}", timeout=timeout,
+                  wrapper=self.push_wrapper)
+
+
+def file_mode(st):
+    """git tree mode for a regular file"""
+    return "100755" if st.st_mode & stat.S_IXUSR else "100644"
+
+
+def _quote(path):
+    """Quote a path for fast-import when it would otherwise be ambiguous"""
+    raw = os.fsencode(path)
+    if b"\n" in raw or raw.startswith(b'"'):
+        escaped = raw.replace(b"\\", b"\\\\").replace(b'"', b'\\"').replace(b"\n", b"\\n")
+        return b'"' + escaped + b'"'
+    return raw
@@ -1,20 +1,24 @@
 import os
-from github import Github, GithubException
+from http_client import shared_client
 
 class GitHubManager:
     def __init__(self):
         self.token = None
-        self.gh = None
+        self.client = None
     
     def authenticate(self, token):
         self.token = token
-        self.gh = Github(token)
+        self.client = shared_client()
+        self.client.token = token
         self._configure_git_credentials(token)
     
-    def get_repos(self):
-        if not self.gh:
+    def get_repos(self, on_page=None, refresh=False):
+        """List "owner/name" for every repository; on_page receives each page as it arrives"""
+        if not self.client:
             raise Exception("Not authenticated!")
-        return [f"{repo.owner.login}/{repo.name}" for repo in self.gh.get_user().get_repos()]
+        if refresh:
+            self.client.invalidate_repo_list()
+        return self.client.list_repos(on_page=on_page)
     
     def _configure_git_credentials(self, token):
         """Store GitHub token to avoid terminal prompts"""
@@ -0,0 +1,135 @@
+import os
+import time
+import sqlite3
+import datetime
+from contextlib import closing
+
+HISTORY_DB = os.path.expanduser("~/.autostash/history.db")
+LEGACY_HISTORY = os.path.expanduser("~/.autostash/backup_history")
+
+RUN_FIELDS = [
+    "started_at", "finished_at", "duration", "repo", "outcome", "error", "commit_sha",
+    "files_scanned", "bytes_scanned", "files_changed", "bytes_changed", "bytes_pushed",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    duration REAL,
+    repo TEXT,
+    outcome TEXT NOT NULL,
+    error TEXT,
+    commit_sha TEXT,
+    files_scanned INTEGER,
+    bytes_scanned INTEGER,
+    files_changed INTEGER,
+    bytes_changed INTEGER,
+    bytes_pushed INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started_at);
+CREATE INDEX IF NOT EXISTS runs_duration ON runs (duration);
+CREATE INDEX IF NOT EXISTS runs_bytes_changed ON runs (bytes_changed);
+"""
+
+
+class HistoryStore:
+    """SQLite-backed record of every backup run
+
+    Each call opens its own short-lived connection, so the GUI thread and the
+    backup worker thread can use the same store safely.
+    """
+
+    def __init__(self, db_path=HISTORY_DB, legacy_path=LEGACY_HISTORY):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+            empty = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0] == 0
+        if empty and os.path.exists(legacy_path):
+            self._import_legacy(legacy_path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _import_legacy(self, legacy_path):
+        """One-time import of the old one-timestamp-per-line history file"""
+        rows = []
+        with open(legacy_path, "r") as f:
+            for line in f:
+                try:
+                    when = datetime.datetime.strptime(line.strip(), "%Y-%m-%d %H:%M:%S").timestamp()
+                except ValueError:
+                    continue
+                rows.append((when, when, "success"))
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT INTO runs (started_at, finished_at, outcome) VALUES (?, ?, ?)", rows)
+
+    def record_run(self, **fields):
+        """Insert a run; keys must be names from RUN_FIELDS. Returns the new row id"""
+        unknown = set(fields) - set(RUN_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown run fields: {', '.join(sorted(unknown))}")
+        fields.setdefault("finished_at", time.time())
+        if "duration" not in fields and "started_at" in fields:
+            fields["duration"] = fields["finished_at"] - fields["started_at"]
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(f"INSERT INTO runs ({columns}) VALUES ({placeholders})", list(fields.values()))
+            return cursor.lastrowid
+
+    def count(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def page(self, before_id=None, limit=50):
+        """Newest runs first; pass the last id of the previous page to continue (keyset paging)"""
+        with closing(self._connect()) as conn:
+            if before_id is None:
+                rows = conn.execute("SELECT * FROM runs ORDER BY id DESC LIMIT ?", (limit,))
+            else:
+                rows = conn.execute("SELECT * FROM runs WHERE id < ? ORDER BY id DESC LIMIT ?",
+                                    (before_id, limit))
+            return [dict(row) for row in rows]
+
+    def recent_runs(self, repo=None, limit=20):
+        """The latest successful runs with their duration and bytes_changed, newest first"""
+        query = ("SELECT * FROM runs WHERE outcome = 'success' AND duration IS NOT NULL "
+                 "AND bytes_changed IS NOT NULL")
+        params = []
+        if repo is not None:
+            query += " AND repo = ?"
+            params.append(repo)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(query + " ORDER BY id DESC LIMIT ?", params + [limit])
+            return [dict(row) for row in rows]
+
+    def slowest_runs(self, limit=10):
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM runs WHERE duration IS NOT NULL "
+                                "ORDER BY duration DESC LIMIT ?", (limit,))
+            return [dict(row) for row in rows]
+
+    def largest_runs(self, limit=10):
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM runs WHERE bytes_changed IS NOT NULL "
+                                "ORDER BY bytes_changed DESC LIMIT ?", (limit,))
+            return [dict(row) for row in rows]
+
+
+def format_run(run):
+    """One-line summary of a run for the GUI timeline"""
+    when = datetime.datetime.fromtimestamp(run["started_at"]).strftime("%Y-%m-%d %H:%M:%S")
+    text = f"{when}  {run['outcome']}"
+    if run.get("duration") is not None and run["duration"] > 0:
+        text += f"  {run['duration']:.1f}s"
+    if run.get("files_changed") is not None:
+        text += f"  {run['files_changed']} files / {(run['bytes_changed'] or 0) / (1024 * 1024):.1f} MiB changed"
+    if run.get("commit_sha"):
+        text += f"  {run['commit_sha'][:8]}"
+    return text
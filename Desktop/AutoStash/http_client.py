@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from atomic_file import atomic_write_json
+
+# Point this at a local server to exercise the client without GitHub
+GITHUB_API = os.environ.get("AUTOSTASH_GITHUB_API", "https://api.github.com")
+HTTP_CACHE = os.path.expanduser("~/.autostash/http_cache.json")
+TIMEOUT = (5, 30)  # connect, read
+REPO_LIST_TTL = 300
+PAGE_SIZE = 100
+PAGE_WORKERS = 4
+
+
+class HttpClient:
+    """Shared keep-alive session for the GitHub API with conditional caching
+
+    Responses that carry an ETag are kept in an on-disk cache and revalidated
+    with If-None-Match, so an unchanged resource costs one 304 (which GitHub
+    does not count against the rate limit). The repository list is also
+    served straight from the cache for REPO_LIST_TTL seconds.
+    """
+
+    def __init__(self, api_url=GITHUB_API, cache_path=HTTP_CACHE, token=None):
+        self.api_url = api_url.rstrip("/")
+        self.cache_path = cache_path
+        self.token = token
+        self.session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=PAGE_WORKERS * 2, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/vnd.github+json"
+        self._lock = threading.Lock()
+        self._cache = None
+
+    def _load_cache(self):
+        if self._cache is None:
+            try:
+                with open(self.cache_path, "r") as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = {}
+        return self._cache
+
+    def _save_cache(self):
+        try:
+            atomic_write_json(self.cache_path, self._cache)
+        except OSError:
+            # The cache is only an optimisation
+            pass
+
+    def _cache_key(self, url):
+        # Different tokens see different resources, so never share entries between them
+        who = hashlib.sha256((self.token or "").encode()).hexdigest()[:12]
+        return f"{who} {url}"
+
+    def get(self, path, params=None):
+        """GET an API path; returns (status, json body, link header). 304s are answered from the cache"""
+        url = path if path.startswith(("http://", "https://")) else self.api_url + path
+        if params:
+            url = requests.Request("GET", url, params=params).prepare().url
+        headers = {}
+        if self.token:
+            headers["Authorization"] = f"token {self.token}"
+        key = self._cache_key(url)
+        with self._lock:
+            cached = self._load_cache().get(key)
+        if cached:
+            headers["If-None-Match"] = cached["etag"]
+
+        response = self.session.get(url, headers=headers, timeout=TIMEOUT)
+        if response.status_code == 304 and cached:
+            return 200, cached["body"], cached.get("link")
+        if response.status_code != 200:
+            return response.status_code, None, None
+        body = response.json()
+        link = response.headers.get("Link")
+        etag = response.headers.get("ETag")
+        if etag:
+            with self._lock:
+                # Kept in memory only; callers save once they are done, not after every page
+                self._load_cache()[key] = {"etag": etag, "body": body, "link": link}
+        return 200, body, link
+
+    def repo_exists(self, repo_name):
+        try:
+            status, _, _ = self.get(f"/repos/{repo_name}")
+        finally:
+            with self._lock:
+                self._save_cache()
+        if status in (200, 404):
+            return status == 200
+        raise Exception(f"GitHub API returned {status} for {repo_name}")
+
+    def list_repos(self, on_page=None, ttl=REPO_LIST_TTL):
+        """Full names of the user's repositories
+
+        on_page is called with each batch of names as soon as it is known, so
+        callers can show the first page while the rest are still loading.
+        """
+        key = self._cache_key("repo-list")
+        with self._lock:
+            cached = self._load_cache().get(key)
+        if cached and time.time() - cached["time"] < ttl:
+            if on_page:
+                on_page(cached["names"])
+            return cached["names"]
+
+        try:
+            status, body, link = self.get("/user/repos", {"per_page": PAGE_SIZE, "page": 1})
+            if status != 200:
+                raise Exception(f"Listing repositories failed: GitHub API returned {status}")
+            names = [repo["full_name"] for repo in body]
+            if on_page:
+                on_page(list(names))
+
+            last = _last_page(link)
+            if last > 1:
+                def fetch(page):
+                    status, body, _ = self.get("/user/repos", {"per_page": PAGE_SIZE, "page": page})
+                    if status != 200:
+                        raise Exception(f"Listing repositories failed: GitHub API returned {status}")
+                    return [repo["full_name"] for repo in body]
+
+                with ThreadPoolExecutor(max_workers=min(PAGE_WORKERS, last - 1)) as executor:
+                    # map keeps page order even though the requests overlap
+                    for page_names in executor.map(fetch, range(2, last + 1)):
+                        names.extend(page_names)
+                        if on_page:
+                            on_page(page_names)
+
+            with self._lock:
+                self._load_cache()[key] = {"time": time.time(), "names": names}
+            return names
+        finally:
+            # One write for the whole listing, however many pages it took
+            with self._lock:
+                self._save_cache()
+
+    def invalidate_repo_list(self):
+        with self._lock:
+            self._load_cache().pop(self._cache_key("repo-list"), None)
+            self._save_cache()
+
+
+def _last_page(link):
+    """Page number of rel="last" in a GitHub Link header, or 1"""
+    if not link:
+        return 1
+    for part in link.split(","):
+        url, _, rel = part.partition(";")
+        if 'rel="last"' in rel:
+            query = requests.utils.urlparse(url.strip(" <>")).query
+            for pair in query.split("&"):
+                name, _, value = pair.partition("=")
+                if name == "page" and value.isdigit():
+                    return int(value)
+    return 1
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_client():
+    """Process-wide client, so every caller reuses the same connection pool and cache"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = HttpClient(token=_stored_token())
+        return _shared
+
+
+def _stored_token():
+    try:
+        import keyring
+        return keyring.get_password("autostash", "github_token")
+    except Exception:
+        return None
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import resource
+import tempfile
+from contextlib import contextmanager
+from progress import BackupCancelled
+
+PROM_TEXTFILE_DIR = "/var/lib/node_exporter/textfile_collector"
+
+
+class Span:
+    """One timed phase of a run, with free-form counters"""
+
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.counters = {}
+        self.start = time.time()
+        self.duration = None
+        self.status = "ok"
+
+    def add(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_record(self, run_id):
+        record = {
+            "run_id": run_id,
+            "span": self.name,
+            "parent": self.parent,
+            "start": round(self.start, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "status": self.status,
+        }
+        record.update(self.attrs)
+        record.update(self.counters)
+        return record
+
+
+class RunMetrics:
+    """Collects spans for one backup run and exports them
+
+    Every finished span is appended to a JSON-lines file as it closes. At the
+    end of the run a summary line is written and, if a textfile-collector
+    path is configured, a Prometheus textfile is replaced atomically.
+    """
+
+    def __init__(self, jsonl_path=None, prom_path=None):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.run_id = f"{int(time.time() * 1000):x}-{os.getpid()}"
+        self.started = time.time()
+        self.spans = []
+        self._stack = []
+
+    @contextmanager
+    def span(self, name, **attrs):
+        parent = self._stack[-1].name if self._stack else None
+        span = Span(name, parent, **attrs)
+        self._stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BackupCancelled:
+            span.status = "cancelled"
+            raise
+        except BaseException:
+            span.status = "error"
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            self._stack.pop()
+            self.spans.append(span)
+            self._write_jsonl(span.to_record(self.run_id))
+
+    def phase_durations(self):
+        """Total seconds per top-level span name"""
+        totals = {}
+        for span in self.spans:
+            if span.parent is None:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return totals
+
+    def finish(self, outcome, **counters):
+        """Write the run summary and refresh the Prometheus textfile"""
+        duration = time.time() - self.started
+        summary = {
+            "run_id": self.run_id,
+            "span": "run",
+            "start": round(self.started, 6),
+            "duration": round(duration, 6),
+            "status": outcome,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "phases": {name: round(seconds, 6) for name, seconds in self.phase_durations().items()},
+        }
+        summary.update(counters)
+        self._write_jsonl(summary)
+        if self.prom_path:
+            self._write_prom(outcome, duration, summary["peak_rss_bytes"], counters)
+        return summary
+
+    def _write_jsonl(self, record):
+        if not self.jsonl_path:
+            return
+        try:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError:
+            # Metrics must never break a backup
+            pass
+
+    def _write_prom(self, outcome, duration, peak_rss, counters):
+        lines = [
+            "# HELP autostash_last_run_timestamp_seconds Unix time the last backup run finished.",
+            "# TYPE autostash_last_run_timestamp_seconds gauge",
+            f"autostash_last_run_timestamp_seconds {time.time():.3f}",
+            "# HELP autostash_last_run_success Whether the last backup run succeeded.",
+            "# TYPE autostash_last_run_success gauge",
+            f"autostash_last_run_success {1 if outcome == 'success' else 0}",
+            "# HELP autostash_run_duration_seconds Duration of the last backup run.",
+            "# TYPE autostash_run_duration_seconds gauge",
+            f"autostash_run_duration_seconds {duration:.6f}",
+            "# HELP autostash_phase_duration_seconds Duration of each phase of the last backup run.",
+            "# TYPE autostash_phase_duration_seconds gauge",
+        ]
+        for name, seconds in sorted(self.phase_durations().items()):
+            lines.append(f'autostash_phase_duration_seconds{{phase="{name}"}} {seconds:.6f}')
+        lines += [
+            "# HELP autostash_peak_rss_bytes Peak resident set size of the backup process.",
+            "# TYPE autostash_peak_rss_bytes gauge",
+            f"autostash_peak_rss_bytes {peak_rss}",
+        ]
+        for key, value in sorted(counters.items()):
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE autostash_last_run_{key} gauge")
+                lines.append(f"autostash_last_run_{key} {value}")
+        directory = os.path.dirname(self.prom_path) or "."
+        try:
+            # node_exporter may read at any moment, so never expose a half-written file
+            fd, tmp_path = tempfile.mkstemp(prefix=".autostash-", suffix=".prom.tmp", dir=directory)
+            with os.fdopen(fd, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.prom_path)
+        except OSError:
+            pass
+
+
+def peak_rss_bytes():
+    """Peak RSS of this process and of waited-for children such as git (ru_maxrss is KiB on Linux)"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+
+def default_prom_path():
+    """AUTOSTASH_PROM_FILE, or node_exporter's usual textfile directory when it is writable"""
+    path = os.environ.get("AUTOSTASH_PROM_FILE")
+    if path:
+        return path
+    if os.path.isdir(PROM_TEXTFILE_DIR) and os.access(PROM_TEXTFILE_DIR, os.W_OK):
+        return os.path.join(PROM_TEXTFILE_DIR, "autostash.prom")
+    return None
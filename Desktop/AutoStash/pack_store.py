@@ -0,0 +1,269 @@
+"""Small-file packing: a directory's small files stored as one pack and its index.
+
+Trees of thousands of tiny files (dotfiles, configs, course folders) cost a
+git object, an index entry and a status check per file. In packing mode each
+staging directory keeps its files under PACK_THRESHOLD in PACK_NAME, their
+contents back to back, and PACK_INDEX maps each name to [offset, length,
+digest, mode, mtime]; larger files are stored as usual next to them.
+
+Packs are append-only: a new or changed file is written at the end and its
+index entry repointed, so the unchanged prefix stays byte-identical and git
+stores the new pack as a small delta against the old one. Only directories
+with changes rewrite their pack and index. Replaced and deleted contents
+stay behind as dead bytes until they outweigh the live ones, when save()
+compacts the pack.
+
+Any single file can be read back by seeking to its offset, without reading
+the rest of the pack, and is checked against its recorded digest.
+"""
+import os
+import json
+import hashlib
+import tempfile
+from atomic_file import atomic_write_json
+from sync_engine import SyncPlan, SyncStats
+
+PACK_NAME = ".autostash-pack"
+PACK_INDEX = ".autostash-pack.idx"
+PACK_THRESHOLD = 64 * 1024
+PACK_VERSION = 1
+# Dead bytes are only compacted away once there are this many and they outnumber the live ones
+COMPACT_MIN = 256 * 1024
+
+
+def is_pack(path):
+    return os.path.basename(path) in (PACK_NAME, PACK_INDEX)
+
+
+def is_pack_index(path):
+    return os.path.basename(path) == PACK_INDEX
+
+
+def blob_digest(data):
+    """Git blob digest of in-memory content, the same as FileIndex computes for files"""
+    return hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+
+
+def read_index(index_path):
+    """{file name: [offset, length, digest, mode, mtime]} from a pack index"""
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    if index.get("version") != PACK_VERSION:
+        raise Exception(f"{index_path} has unsupported pack version {index.get('version')}")
+    return index["files"]
+
+
+def read_entry(pack_path, entry):
+    """The content of one packed file, read from its offset alone"""
+    offset, length = entry[0], entry[1]
+    with open(pack_path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise Exception(f"{pack_path} is truncated")
+    return data
+
+
+class DirectoryPack:
+    """The pack and index of one staging directory, loaded for reading or updating"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pack_path = os.path.join(directory, PACK_NAME)
+        self.index_path = os.path.join(directory, PACK_INDEX)
+        self.files = read_index(self.index_path) if os.path.exists(self.index_path) else {}
+        # Bytes past the last indexed file (left by an interrupted run) are dead and get appended after
+        self.end = os.path.getsize(self.pack_path) if os.path.exists(self.pack_path) else 0
+        self.changed = False
+        self._out = None
+
+    def read(self, name):
+        """One file's content, checked against its recorded digest"""
+        entry = self.files.get(name)
+        if entry is None:
+            raise Exception(f"{name} is not in {self.index_path}")
+        data = read_entry(self.pack_path, entry)
+        if blob_digest(data) != entry[2]:
+            raise Exception(f"{name} in {self.pack_path} does not match its recorded digest")
+        return data
+
+    def extract(self, name, dest_path):
+        """Write one packed file to dest_path with its recorded mode and mtime"""
+        data = self.read(name)
+        entry = self.files[name]
+        fd, tmp_path = tempfile.mkstemp(prefix=".autostash-unpack-", dir=os.path.dirname(dest_path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, entry[3])
+            os.utime(tmp_path, (entry[4], entry[4]))
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def add(self, name, src_path):
+        """Append src_path's content as name, replacing any earlier version; returns its size"""
+        with open(src_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        if self._out is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._out = open(self.pack_path, "ab")
+        self._out.write(data)
+        # The digest is of what was read, so a file changing under us is recorded as it was packed
+        self.files[name] = [self.end, len(data), blob_digest(data), st.st_mode & 0o7777, st.st_mtime]
+        self.end += len(data)
+        self.changed = True
+        return len(data)
+
+    def remove(self, name):
+        if self.files.pop(name, None) is not None:
+            self.changed = True
+
+    def save(self):
+        """Write the index after the appended data; an emptied pack is removed altogether"""
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        if not self.changed:
+            return
+        self.changed = False
+        if not self.files:
+            for path in (self.pack_path, self.index_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return
+        live = sum(entry[1] for entry in self.files.values())
+        if self.end - live > max(live, COMPACT_MIN):
+            self._compact()
+        self._write_index()
+
+    def _compact(self):
+        """Rewrite the pack with only the live files, in name order"""
+        fd, tmp_path = tempfile.mkstemp(prefix=".autostash-pack-", dir=self.directory)
+        offset = 0
+        with os.fdopen(fd, "wb") as out, open(self.pack_path, "rb") as src:
+            for name in sorted(self.files):
+                entry = self.files[name]
+                src.seek(entry[0])
+                out.write(src.read(entry[1]))
+                entry[0] = offset
+                offset += entry[1]
+        os.replace(tmp_path, self.pack_path)
+        self.end = offset
+
+    def _write_index(self):
+        # One entry per line, so git diffs and deltas of an index stay as small as the change
+        atomic_write_json(self.index_path, {"version": PACK_VERSION, "files": self.files}, indent=0, sort_keys=True)
+
+
+def apply_packed(plan, src_root, dest_root, locations, threshold, progress=None, limiter=None):
+    """Carry out the parts of plan that put files into or take them out of packs
+
+    locations maps logical paths to where they are stored, as for
+    apply_plan; a packed file's location is its directory's PACK_NAME. Files
+    under threshold are packed (0 packs nothing and only unpacks). Returns
+    the rest of the plan, the locations it should be applied with and the
+    stats of what was done here. limiter, if given, paces the reads.
+    """
+    rest = SyncPlan()
+    rest_locations = dict(locations)
+    stats = SyncStats()
+    packs = {}
+
+    def pack_of(rel):
+        directory = os.path.dirname(rel)
+        if directory not in packs:
+            packs[directory] = DirectoryPack(os.path.join(dest_root, directory))
+        return packs[directory]
+
+    def packed(rel):
+        return os.path.basename(locations.get(rel, "")) == PACK_NAME
+
+    def small(rel):
+        return os.path.getsize(os.path.join(src_root, rel)) < threshold
+
+    def unstore(rel):
+        """Remove the current stored form of rel, packed or not"""
+        if packed(rel):
+            pack_of(rel).remove(os.path.basename(rel))
+            rest_locations.pop(rel, None)
+        else:
+            path = os.path.join(dest_root, locations.get(rel, rel))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def store(rel, kind):
+        if limiter is not None:
+            limiter.consume(os.path.getsize(os.path.join(src_root, rel)))
+        size = pack_of(rel).add(os.path.basename(rel), os.path.join(src_root, rel))
+        setattr(stats, kind, getattr(stats, kind) + 1)
+        stats.bytes_copied += size
+        stats.copy_methods["packed"] = stats.copy_methods.get("packed", 0) + 1
+        if progress:
+            progress.advance(size)
+
+    for rel in plan.deleted:
+        if packed(rel):
+            unstore(rel)
+            stats.deleted += 1
+        else:
+            rest.deleted.append(rel)
+    for old, new in plan.renamed:
+        if not packed(old) and not small(new):
+            rest.renamed.append((old, new))
+            continue
+        # Moving into, out of or between packs rewrites the content, so it is not a plain rename
+        unstore(old)
+        if small(new):
+            store(new, "renamed")
+        else:
+            rest.added.append(new)
+    for kind, rels in (("added", plan.added), ("modified", plan.modified)):
+        for rel in rels:
+            if small(rel):
+                if kind == "modified" and not packed(rel):
+                    unstore(rel)
+                store(rel, kind)
+            else:
+                if packed(rel):
+                    unstore(rel)
+                getattr(rest, kind).append(rel)
+    for pack in packs.values():
+        pack.save()
+    return rest, rest_locations, stats
+
+
+def unpack_tree(root, paths=None):
+    """Replace every pack under root with the files it holds; returns how many were written
+
+    paths (relative to root) limits which files are written: the rest of a
+    pack is skipped without being read.
+    """
+    prefixes = [path.strip("/") for path in paths] if paths else None
+
+    def wanted(rel):
+        return prefixes is None or any(rel == p or rel.startswith(p + "/") for p in prefixes)
+
+    unpacked = 0
+    for dirpath, dirs, names in os.walk(root):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        if PACK_INDEX not in names:
+            continue
+        pack = DirectoryPack(dirpath)
+        rel_dir = os.path.relpath(dirpath, root)
+        for name in sorted(pack.files):
+            if wanted(os.path.normpath(os.path.join(rel_dir, name))):
+                pack.extract(name, os.path.join(dirpath, name))
+                unpacked += 1
+        for path in (pack.pack_path, pack.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return unpacked
@@ -0,0 +1,257 @@
+"""Predicting what a backup will move, and how long it will take, without running it.
+
+A plan compares each folder file by file with what the last backup stored,
+using stat data only: a file whose size, mtime and inode still match its
+FileIndex entry has its digest cached there, and a file without one is
+counted as changed without being read. The baseline is the folder's
+verification manifest in the staging repo (see verify.py), or for direct
+ingest the tree of the bare repository's last commit, so the plan lists the
+files the run would add, modify and delete. Nothing is hashed, copied or
+committed, so a plan costs about one directory walk.
+
+Durations are estimated from recent successful runs in the history
+database: the median length of runs that changed little is the fixed cost,
+plus the changed bytes at the median rate of the larger runs.
+"""
+import os
+import json
+import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from atomic_file import atomic_write_json
+
+# Runs that changed less than this are taken to measure fixed overhead (scan, commit, push round trips)
+SMALL_RUN_BYTES = 1024 * 1024
+HISTORY_RUNS = 20
+DEFER_STATE = os.path.expanduser("~/.autostash/deferred.json")
+
+
+class FolderPlan:
+    """What a run would do to one folder
+
+    added and modified hold (relative path, size); deleted holds relative
+    paths. unhashed counts modified files whose stat data changed but whose
+    size did not, which the run may still find identical once it hashes them.
+    """
+
+    def __init__(self, folder, baseline):
+        self.folder = folder
+        self.baseline = baseline  # what it was compared with: backup manifest, last commit, last scan or none
+        self.added = []
+        self.modified = []
+        self.deleted = []
+        self.unhashed = 0
+        self.files = 0
+        self.bytes = 0
+        self.hash_bytes = 0
+
+    @property
+    def change_bytes(self):
+        return sum(size for rel, size in self.added) + sum(size for rel, size in self.modified)
+
+    def is_empty(self):
+        return not (self.added or self.modified or self.deleted)
+
+
+class BackupPlan:
+    """A dry run of BackupManager.run over several folders"""
+
+    def __init__(self, repo, staged=True):
+        self.repo = repo
+        self.staged = staged
+        self.folders = {}
+        self.walk_seconds = 0.0
+        self.estimate = None  # seconds, or None without enough history
+
+    @property
+    def files_changed(self):
+        return sum(len(p.added) + len(p.modified) + len(p.deleted) for p in self.folders.values())
+
+    @property
+    def bytes_to_push(self):
+        """Changed content before git compresses it, so an upper bound for the push"""
+        return sum(p.change_bytes for p in self.folders.values())
+
+    @property
+    def bytes_to_read(self):
+        """Hashing reads every file without a cached digest; staging then reads changed files again to copy them"""
+        hashed = sum(p.hash_bytes for p in self.folders.values())
+        return hashed + (self.bytes_to_push if self.staged else 0)
+
+    def is_empty(self):
+        return all(p.is_empty() for p in self.folders.values())
+
+    def summary(self):
+        files = sum(p.files for p in self.folders.values())
+        text = (f"{self.files_changed} of {files} files change: "
+                + ", ".join(f"{sum(len(getattr(p, kind)) for p in self.folders.values())} {kind}"
+                            for kind in ("added", "modified", "deleted"))
+                + f"; {_mib(self.bytes_to_read)} to read, {_mib(self.bytes_to_push)} to push")
+        if self.estimate is not None:
+            text += f", about {_duration(self.estimate)}"
+        else:
+            text += ", duration unknown (not enough backup history)"
+        return text
+
+    def lines(self, limit=None):
+        """One line per changed file, folder by folder; limit caps the lines per folder"""
+        for folder, plan in self.folders.items():
+            changes = ([f"+ {rel} ({_mib(size)})" for rel, size in plan.added]
+                       + [f"M {rel} ({_mib(size)})" for rel, size in plan.modified]
+                       + [f"- {rel}" for rel in plan.deleted])
+            against = f"against the {plan.baseline}" if plan.baseline != "none" else "no previous backup"
+            unsure = f", {plan.unhashed} modified by stat only" if plan.unhashed else ""
+            yield (f"{folder}: {len(plan.added)} added, {len(plan.modified)} modified, {len(plan.deleted)} deleted"
+                   f" ({against}{unsure})")
+            for line in changes[:limit]:
+                yield "  " + line
+            if limit is not None and len(changes) > limit:
+                yield f"  ... and {len(changes) - limit} more"
+
+    def to_dict(self):
+        return {
+            "repo": self.repo,
+            "files_changed": self.files_changed,
+            "bytes_to_read": self.bytes_to_read,
+            "bytes_to_push": self.bytes_to_push,
+            "estimate_seconds": self.estimate,
+            "walk_seconds": round(self.walk_seconds, 3),
+            "folders": {folder: {"baseline": p.baseline, "added": p.added, "modified": p.modified,
+                                 "deleted": p.deleted, "unhashed": p.unhashed, "files": p.files,
+                                 "bytes": p.bytes} for folder, p in self.folders.items()},
+        }
+
+
+class Planner:
+    def __init__(self, index, history=None, workers=1):
+        self.index = index
+        self.history = history
+        self.workers = max(1, workers)
+
+    def plan(self, repo, folders, rules, baselines, staged=True):
+        """Build a BackupPlan; baselines maps each folder to ({rel: (digest, size or None)}, source)"""
+        plan = BackupPlan(repo, staged)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(folders) or 1)) as executor:
+            plans = executor.map(lambda folder: self._plan_folder(folder, rules.get(folder), *baselines[folder]),
+                                 folders)
+            plan.folders = dict(zip(folders, plans))
+        plan.walk_seconds = time.perf_counter() - started
+        if self.history:
+            plan.estimate = estimate_duration(self.history.recent_runs(repo, HISTORY_RUNS), plan.bytes_to_push)
+        return plan
+
+    def _plan_folder(self, folder, rules, baseline, source):
+        plan = FolderPlan(folder, source)
+        seen = set()
+        for rel, st, digest in self.index.stat_tree(folder, rules):
+            seen.add(rel)
+            plan.files += 1
+            plan.bytes += st.st_size
+            if digest is None:
+                plan.hash_bytes += st.st_size
+            recorded = baseline.get(rel)
+            if recorded is None:
+                plan.added.append((rel, st.st_size))
+            elif digest is None:
+                plan.modified.append((rel, st.st_size))
+                if recorded[1] is None or recorded[1] == st.st_size:
+                    plan.unhashed += 1
+            elif digest != recorded[0]:
+                plan.modified.append((rel, st.st_size))
+        plan.deleted = sorted(rel for rel in baseline if rel not in seen)
+        return plan
+
+
+def estimate_duration(runs, change_bytes):
+    """Seconds a run changing change_bytes should take, from recent runs' duration and bytes_changed"""
+    if not runs:
+        return None
+    small = [run["duration"] for run in runs if run["bytes_changed"] < SMALL_RUN_BYTES]
+    overhead = statistics.median(small) if small else min(run["duration"] for run in runs)
+    if change_bytes < SMALL_RUN_BYTES:
+        return overhead
+    large = [run for run in runs if run["bytes_changed"] >= SMALL_RUN_BYTES and run["duration"] > 0]
+    if not large:
+        return None
+    if small:
+        rates = [run["bytes_changed"] / max(run["duration"] - overhead, 0.001) for run in large]
+    else:
+        # Without a small run to separate out the fixed cost, take whole runs as the rate
+        overhead, rates = 0.0, [run["bytes_changed"] / run["duration"] for run in large]
+    return overhead + change_bytes / statistics.median(rates)
+
+
+class DeferPolicy:
+    """When a scheduled run is too big to start now
+
+    A plan over max_bytes to push or max_seconds of estimated time is
+    deferred, but only for max_defer_hours after the first deferral, so a
+    large change is backed up by the next run after that instead of never.
+    With neither limit set nothing is deferred.
+    """
+
+    def __init__(self, max_bytes=None, max_seconds=None, max_defer_hours=24, state_path=DEFER_STATE):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_defer_hours = max_defer_hours
+        self.state_path = state_path
+
+    def to_config(self):
+        return {"max_bytes": self.max_bytes, "max_seconds": self.max_seconds,
+                "max_defer_hours": self.max_defer_hours}
+
+    @classmethod
+    def from_config(cls, data):
+        return cls(**(data or {}))
+
+    def oversized(self, plan):
+        """Why plan is too big to run now, or None"""
+        if self.max_bytes is not None and plan.bytes_to_push > self.max_bytes:
+            return f"{_mib(plan.bytes_to_push)} to push is over the {_mib(self.max_bytes)} limit"
+        if self.max_seconds is not None and plan.estimate is not None and plan.estimate > self.max_seconds:
+            return f"an estimated {_duration(plan.estimate)} is over the {_duration(self.max_seconds)} limit"
+        return None
+
+    def check(self, plan, now=None):
+        """The reason to defer this run, or None to run it; remembers when deferring began"""
+        now = now or time.time()
+        reason = self.oversized(plan)
+        state = self._load()
+        if reason is None:
+            if state:
+                self.clear()
+            return None
+        since = state.get("since", now)
+        if now - since >= self.max_defer_hours * 3600:
+            return None
+        self._save({"since": since, "last": now, "reason": reason})
+        return reason
+
+    def clear(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def _load(self):
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state):
+        atomic_write_json(self.state_path, state)
+
+
+def _mib(nbytes):
+    return f"{nbytes / 1024 / 1024:.1f} MiB"
+
+
+def _duration(seconds):
+    if seconds < 90:
+        return f"{seconds:.0f}s"
+    if seconds < 90 * 60:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
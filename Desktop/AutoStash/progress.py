@@ -0,0 +1,91 @@
+import time
+import threading
+
+
+class BackupCancelled(Exception):
+    """Raised at a safe point when a running backup or restore was cancelled"""
+
+
+class ProgressTracker:
+    """Byte-weighted progress with throughput and ETA, reported through a callback
+
+    The callback is called as callback(percent, message, event) where event is
+    a dict with phase, bytes_done, bytes_total, throughput (bytes/s) and eta
+    (seconds, or None while unknown). Reports are rate limited to one per
+    interval seconds except for phase changes and the final report.
+    """
+
+    def __init__(self, callback=None, cancel_event=None, interval=0.2):
+        self.callback = callback
+        self.cancel_event = cancel_event or threading.Event()
+        self.interval = interval
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.phase = "starting"
+        self.message = ""
+        self.started = time.monotonic()
+        self._last_report = 0.0
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise BackupCancelled("Cancelled by user")
+
+    def add_work(self, nbytes):
+        self.bytes_total += nbytes
+
+    def set_phase(self, phase, message, safe_point=True):
+        self.phase = phase
+        self.message = message
+        if safe_point:
+            self.check_cancelled()
+        self._report(force=True)
+
+    def advance(self, nbytes, safe_point=True):
+        """Count finished bytes; by default also a safe point for cancellation"""
+        self.bytes_done = min(self.bytes_done + nbytes, self.bytes_total)
+        if safe_point:
+            self.check_cancelled()
+        self._report()
+
+    def finish(self, message):
+        self.phase = "done"
+        self.message = message
+        self.bytes_done = self.bytes_total
+        self._report(force=True, percent=100)
+
+    def event(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        throughput = self.bytes_done / elapsed
+        remaining = self.bytes_total - self.bytes_done
+        eta = remaining / throughput if throughput > 0 else None
+        return {
+            "phase": self.phase,
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "throughput": throughput,
+            "eta": eta,
+        }
+
+    def percent(self):
+        if self.bytes_total <= 0:
+            return 0
+        return self.bytes_done / self.bytes_total * 100
+
+    def _report(self, force=False, percent=None):
+        if not self.callback:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        self.callback(self.percent() if percent is None else percent, self.message, self.event())
+
+
+def format_event(event):
+    """Human readable throughput/ETA suffix for status lines"""
+    rate = event["throughput"] / (1024 * 1024)
+    text = f"{rate:.1f} MiB/s"
+    if event["eta"] is not None and event["bytes_done"] < event["bytes_total"]:
+        minutes, seconds = divmod(int(event["eta"]), 60)
+        text += f", ETA {minutes}:{seconds:02d}"
+    return text
@@ -0,0 +1,321 @@
+"""Tiered retention for the backup branch, and scheduled repacking.
+
+Every backup commit holds a full snapshot, so thinning history only means
+choosing which snapshots to keep: by default every hourly snapshot for two
+days, one per day for thirty days and one per month after that. The kept
+commits are re-chained onto their surviving ancestors with `git commit-tree`
+(trees and blobs are reused, nothing is re-uploaded), the branch is pushed
+with --force-with-lease so a backup that raced us is never overwritten, and
+the local repositories are repacked with reachability bitmaps so the dropped
+snapshots' objects are actually freed.
+
+Between rewrites, repack() does a cheap geometric repack that only merges
+the small packs each backup leaves behind.
+"""
+import os
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import subprocess
+from atomic_file import atomic_write_json
+from git_ingest import DirectIngest
+
+RETENTION_STATE = os.path.expanduser("~/.autostash/retention.json")
+WORK_DIR = os.path.expanduser("~/.autostash/retention.git")
+# A remote may be receiving a push while we repack it, so only objects unreachable for this long are pruned
+REMOTE_PRUNE_GRACE = "1.hour.ago"
+PUSH_TIMEOUT = 30 * 60
+
+
+class RetentionPolicy:
+    """Which backup commits survive
+
+    Commits younger than hourly_hours keep the newest per hour, younger than
+    daily_days the newest per day, and older ones the newest per month, for
+    monthly_months months (None keeps monthly snapshots forever). The
+    newest commit is always kept.
+    """
+
+    def __init__(self, hourly_hours=48, daily_days=30, monthly_months=None):
+        self.hourly_hours = hourly_hours
+        self.daily_days = daily_days
+        self.monthly_months = monthly_months
+
+    def select(self, commits, now=None):
+        """Set of shas to keep, from (sha, commit time) pairs ordered newest first"""
+        now = now or time.time()
+        keep, buckets = set(), set()
+        for position, (sha, timestamp) in enumerate(commits):
+            bucket = self._bucket(timestamp, now)
+            if position == 0 or (bucket is not None and bucket not in buckets):
+                keep.add(sha)
+            buckets.add(bucket)
+        return keep
+
+    def _bucket(self, timestamp, now):
+        age = now - timestamp
+        moment = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+        if age < self.hourly_hours * 3600:
+            return moment.strftime("h %Y-%m-%d %H")
+        if age < self.daily_days * 86400:
+            return moment.strftime("d %Y-%m-%d")
+        if self.monthly_months is not None:
+            current = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+            if (current.year - moment.year) * 12 + current.month - moment.month > self.monthly_months:
+                return None
+        return moment.strftime("m %Y-%m")
+
+    def to_config(self):
+        return {"hourly_hours": self.hourly_hours, "daily_days": self.daily_days,
+                "monthly_months": self.monthly_months}
+
+    @classmethod
+    def from_config(cls, data):
+        return cls(**(data or {}))
+
+
+class RetentionManager:
+    """Applies a RetentionPolicy to a backup repository and its mirrors
+
+    repo_url and mirror_urls are anything `git push` accepts. The rewrite
+    happens in a bare working clone at work_dir; the staging repository (and
+    the direct-ingest repository, if there is one) are then moved onto the
+    new history so the next backup carries on from it.
+    """
+
+    def __init__(self, repo_url, mirror_urls=(), policy=None, work_dir=WORK_DIR, local_repos=(),
+                 state_path=RETENTION_STATE, logger=None):
+        self.repo_url = repo_url
+        self.mirror_urls = list(mirror_urls)
+        self.policy = policy or RetentionPolicy()
+        self.ingest = DirectIngest(work_dir)
+        self.local_repos = [path for path in local_repos if os.path.isdir(path)]
+        self.state_path = state_path
+        self.logger = logger
+
+    def plan(self, now=None):
+        """Fetch the branch and work out what the policy keeps; nothing is changed"""
+        if os.path.exists(self.ingest.git_dir):
+            self.ingest.set_remote("origin", self.repo_url)
+        self.ingest.ensure_repo(self.repo_url)
+        branch = self.ingest.branch()
+        head = self.ingest.head(branch)
+        if head is None:
+            return {"branch": branch, "head": None, "commits": [], "keep": set()}
+        log = self.ingest._git("log", "--first-parent", "--format=%H %ct", head).decode().split("\n")
+        commits = [(sha, int(ts)) for sha, ts in (line.split() for line in log if line)]
+        return {"branch": branch, "head": head, "commits": commits, "keep": self.policy.select(commits, now)}
+
+    def apply(self, dry_run=False, measure=False, now=None):
+        """Thin the history, push it everywhere and repack; returns a report"""
+        started = time.time()
+        plan = self.plan(now)
+        report = {"branch": plan["branch"], "commits_before": len(plan["commits"]),
+                  "commits_after": len(plan["keep"]), "dry_run": dry_run, "pushed": {}}
+        if dry_run or plan["head"] is None:
+            return report
+
+        timings = {}
+        if measure:
+            timings["before"] = self._measure()
+        new_head = self._rewrite(plan)
+        remotes = [("origin", self.repo_url)] + [(f"mirror-{i}", url) for i, url in enumerate(self.mirror_urls)]
+        for remote, url in remotes:
+            if remote != "origin":
+                self.ingest.set_remote(remote, url)
+            try:
+                report["pushed"][url] = self._sync_remote(remote, plan["branch"], plan["head"], new_head)
+            except Exception as e:
+                if remote == "origin":
+                    raise Exception(f"Retention push to {url} failed: {str(e)}")
+                report["pushed"][url] = f"failed: {str(e)}"
+                self._log("warning", f"Retention push to {url} failed: {str(e)}")
+        self.ingest._git("update-ref", f"refs/heads/{plan['branch']}", new_head)
+        for path in self.local_repos:
+            self._follow(path, plan["branch"], new_head)
+
+        report["repos"] = self.repack(full=new_head != plan["head"])
+        report["reclaimed_bytes"] = sum(sizes["before"] - sizes["after"] for sizes in report["repos"].values())
+        if measure:
+            timings["after"] = self._measure()
+            report["timings"] = timings
+        report["seconds"] = round(time.time() - started, 1)
+        self._log("info", f"Retention kept {report['commits_after']} of {report['commits_before']} commits, "
+                          f"reclaimed {report['reclaimed_bytes'] / 1024 / 1024:.1f} MiB")
+        self._save_state({"last_run": started, "report": report})
+        return report
+
+    def _rewrite(self, plan):
+        """Re-chain the kept commits; returns the new head (the old one if nothing is dropped)
+
+        Commits below the oldest dropped one keep their ids, so a second run
+        with nothing new to drop rewrites nothing.
+        """
+        parent, rewriting = None, False
+        for sha, _ in reversed(plan["commits"]):
+            if sha not in plan["keep"]:
+                rewriting = True
+                continue
+            if not rewriting:
+                parent = sha
+                continue
+            parent = self._recommit(sha, parent)
+        return parent
+
+    def _recommit(self, sha, parent):
+        """Copy of commit sha (same tree, author, dates and message) on top of parent"""
+        fields = self.ingest._git("show", "-s", "--format=%T%n%an%n%ae%n%ad%n%cn%n%ce%n%cd%n%B",
+                                  "--date=raw", sha).decode()
+        tree, author, author_email, author_date, committer, committer_email, committer_date, message = \
+            fields.split("\n", 7)
+        env = dict(os.environ, GIT_AUTHOR_NAME=author, GIT_AUTHOR_EMAIL=author_email,
+                   GIT_AUTHOR_DATE=author_date, GIT_COMMITTER_NAME=committer,
+                   GIT_COMMITTER_EMAIL=committer_email, GIT_COMMITTER_DATE=committer_date)
+        args = ["git", "--git-dir", self.ingest.git_dir, "commit-tree", tree]
+        if parent:
+            args += ["-p", parent]
+        result = subprocess.run(args, input=message.encode(), capture_output=True, env=env)
+        if result.returncode != 0:
+            raise Exception(f"git commit-tree failed: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout.decode().strip()
+
+    def _sync_remote(self, remote, branch, old_head, new_head):
+        """Move one remote's branch to new_head, leasing against what it held when we looked"""
+        current = self._live_head(remote, branch)
+        if current == new_head:
+            return "up to date"
+        if old_head == new_head and current and self._is_ancestor(current, new_head):
+            # A mirror that fell behind; the next backup catches it up with an ordinary push
+            return "behind"
+        # The primary must still be where the plan saw it, or a backup raced us and nothing is pushed
+        expected = old_head if remote == "origin" else current
+        lease = f"--force-with-lease=refs/heads/{branch}:{expected or ''}"
+        self.ingest._git("push", "-q", lease, remote, f"{new_head}:refs/heads/{branch}", timeout=PUSH_TIMEOUT)
+        return "rewritten" if current else "pushed"
+
+    def _live_head(self, remote, branch):
+        out = self.ingest._git("ls-remote", remote, f"refs/heads/{branch}", timeout=PUSH_TIMEOUT).decode().split()
+        return out[0] if out else None
+
+    def _is_ancestor(self, commit, descendant):
+        result = subprocess.run(["git", "--git-dir", self.ingest.git_dir, "merge-base", "--is-ancestor",
+                                 commit, descendant], capture_output=True)
+        return result.returncode == 0
+
+    def _follow(self, path, branch, new_head):
+        """Move a local clone onto the rewritten history without touching its files"""
+        git_dir = _git_dir(path)
+        if git_dir is None:
+            return
+        bare = git_dir == path
+
+        def git(*args):
+            return subprocess.run(["git", "--git-dir", git_dir] + ([] if bare else ["--work-tree", path]) + list(args),
+                                  capture_output=True)
+
+        if git("fetch", "-q", self.ingest.git_dir, f"refs/heads/{branch}").returncode != 0:
+            self._log("warning", f"Could not update {path} after retention")
+            return
+        if bare:
+            git("update-ref", f"refs/heads/{branch}", new_head)
+        else:
+            # --keep leaves the (identical) working tree alone and refuses rather than lose local edits
+            result = git("reset", "-q", "--keep", new_head)
+            if result.returncode != 0:
+                self._log("warning", f"Could not move {path} onto the new history: "
+                                     f"{result.stderr.decode(errors='replace').strip()}")
+                return
+        # Remote-tracking refs still name the old history until the next fetch
+        refs = git("for-each-ref", "--format=%(refname)", f"refs/remotes/*/{branch}").stdout.decode().split()
+        for ref in refs:
+            git("update-ref", ref, new_head)
+
+    def repack(self, full=False):
+        """Repack the local repositories (and any local remotes); returns their sizes before and after
+
+        full drops everything unreachable, after a rewrite. Otherwise the
+        repack is geometric: only packs small enough to be worth merging are
+        rewritten, so routine maintenance stays cheap however big the
+        repository grows. Either way a reachability bitmap is written,
+        which makes clones and fetches of the repository much cheaper.
+        """
+        repos = {}
+        targets = [(self.ingest.git_dir, "now")] + [(_git_dir(path), "now") for path in self.local_repos]
+        targets += [(url, REMOTE_PRUNE_GRACE) for url in [self.repo_url] + self.mirror_urls if os.path.isabs(url)]
+        for git_dir, prune in targets:
+            if git_dir is None or git_dir in repos:
+                continue
+            before = _repo_size(git_dir)
+            if full:
+                if prune == "now":
+                    _run_git(git_dir, "reflog", "expire", "--expire=now", "--all")
+                _run_git(git_dir, "-c", "repack.writeBitmaps=true", "-c", "pack.writeBitmapHashCache=true",
+                         "gc", "-q", f"--prune={prune}")
+            else:
+                _run_git(git_dir, "repack", "-d", "-q", "--geometric=2", "--write-midx", "--write-bitmap-index")
+                _run_git(git_dir, "prune-packed")
+            _run_git(git_dir, "commit-graph", "write", "--reachable")
+            repos[git_dir] = {"before": before, "after": _repo_size(git_dir)}
+        self._save_state({"last_repack": time.time()})
+        return repos
+
+    def _measure(self):
+        """Seconds for a fresh clone of the primary and for a fetch into it"""
+        url = "file://" + self.repo_url if os.path.isabs(self.repo_url) else self.repo_url
+        target = tempfile.mkdtemp(prefix="autostash-clone-")
+        try:
+            start = time.perf_counter()
+            _run_git(None, "clone", "--bare", "-q", url, os.path.join(target, "repo.git"))
+            cloned = time.perf_counter()
+            _run_git(os.path.join(target, "repo.git"), "fetch", "-q", "origin")
+            return {"clone": round(cloned - start, 3), "fetch": round(time.perf_counter() - cloned, 3)}
+        finally:
+            shutil.rmtree(target, ignore_errors=True)
+
+    def _save_state(self, update):
+        state = load_state(self.state_path)
+        state.update(update)
+        atomic_write_json(self.state_path, state)
+
+    def _log(self, level, message):
+        if self.logger:
+            getattr(self.logger, level)(message)
+
+
+def load_state(path=RETENTION_STATE):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _git_dir(path):
+    """The git directory of a clone or bare repository at path, or None"""
+    if os.path.isdir(os.path.join(path, ".git")):
+        return os.path.join(path, ".git")
+    if os.path.isfile(os.path.join(path, "HEAD")) and os.path.isdir(os.path.join(path, "objects")):
+        return path
+    return None
+
+
+def _run_git(git_dir, *args):
+    prefix = ["git"] if git_dir is None else ["git", "--git-dir", git_dir]
+    result = subprocess.run(prefix + list(args), capture_output=True)
+    if result.returncode != 0:
+        raise Exception(f"git {args[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+
+def _repo_size(git_dir):
+    """Bytes used by a repository's objects, loose and packed"""
+    total = 0
+    for dirpath, _, names in os.walk(os.path.join(git_dir, "objects")):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
@@ -0,0 +1,190 @@
+"""One backup at a time, however many things ask for one.
+
+The systemd timer, cron, the daemon and the GUI can all request a run. Runs
+are serialised by an flock on RUN_LOCK; the kernel drops it if the process
+dies, so a crash never leaves a stale lock. While a run is in progress at
+most one request waits behind it, holding QUEUE_LOCK. Any further request
+that the waiting one covers (same repository, a superset of the folders)
+joins it instead of queueing another run: it waits for that run to finish
+and takes its outcome as its own, since that run has not started scanning
+yet and so will pick up everything the joiner wanted backed up.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import contextlib
+from atomic_file import atomic_write_json
+
+LOCK_DIR = os.path.expanduser("~/.autostash")
+POLL_INTERVAL = 0.5
+KEEP_RESULTS = 20
+
+
+class RunSlot:
+    """What a caller got from RunCoordinator.slot
+
+    joined is True when another run did the work; result then holds that
+    run's outcome and error. Otherwise the caller owns the run and reports
+    its outcome with finish().
+    """
+
+    def __init__(self, run_id, joined=False, result=None):
+        self.run_id = run_id
+        self.joined = joined
+        self.result = result
+
+    def finish(self, outcome, error=None):
+        self.result = {"outcome": outcome, "error": error}
+
+
+class RunCoordinator:
+    def __init__(self, lock_dir=LOCK_DIR):
+        self.lock_dir = lock_dir
+        self.run_lock = os.path.join(lock_dir, "run.lock")
+        self.queue_lock = os.path.join(lock_dir, "run-queue.lock")
+        self.queue_path = os.path.join(lock_dir, "run-queue.json")
+        self.state_path = os.path.join(lock_dir, "run-state.json")
+
+    @contextlib.contextmanager
+    def slot(self, request, on_wait=None, cancel_event=None):
+        """Context manager yielding a RunSlot once this request may run, or has been served
+
+        request is a dict describing the run (see covers()). on_wait(message)
+        is called when the request has to wait; setting cancel_event stops
+        the wait with InterruptedError.
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        run_fd = os.open(self.run_lock, os.O_RDWR | os.O_CREAT, 0o600)
+        queue_fd = os.open(self.queue_lock, os.O_RDWR | os.O_CREAT, 0o600)
+        run_id = uuid.uuid4().hex
+        try:
+            while True:
+                if _try_lock(run_fd, fcntl.LOCK_EX):
+                    break
+                if not _try_lock(queue_fd, fcntl.LOCK_EX):
+                    queued = self._read(self.queue_path)
+                    if queued and covers(queued["request"], request):
+                        if on_wait:
+                            on_wait("Joining the queued backup run...")
+                        result = self._join(queued["id"], run_fd, queue_fd, cancel_event)
+                        # A joined run that was cancelled did none of our work, so try again
+                        if result and result["outcome"] != "cancelled":
+                            yield RunSlot(queued["id"], joined=True, result=result)
+                            return
+                        continue
+                    if on_wait:
+                        on_wait("Waiting for queued backup runs...")
+                    _wait_lock(queue_fd, fcntl.LOCK_EX, cancel_event)
+                # We are the one queued request: advertise it so later ones can join, then wait our turn
+                self._write(self.queue_path, {"id": run_id, "request": request})
+                if on_wait:
+                    on_wait("Waiting for the running backup to finish...")
+                try:
+                    _wait_lock(run_fd, fcntl.LOCK_EX, cancel_event)
+                finally:
+                    self._remove(self.queue_path, run_id)
+                    fcntl.flock(queue_fd, fcntl.LOCK_UN)
+                break
+
+            slot = RunSlot(run_id)
+            self._update_state(running={"id": run_id, "pid": os.getpid(), "started": time.time(),
+                                        "request": request})
+            try:
+                yield slot
+            except BaseException as e:
+                if slot.result is None:
+                    slot.finish("failed", str(e))
+                raise
+            finally:
+                self._record(run_id, slot.result or {"outcome": "success", "error": None})
+        finally:
+            os.close(queue_fd)
+            os.close(run_fd)
+
+    def running(self):
+        """The request of the run in progress, or None"""
+        fd = os.open(self.run_lock, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if _try_lock(fd, fcntl.LOCK_SH):
+                return None
+            return self._read(self.state_path).get("running")
+        finally:
+            os.close(fd)
+
+    def _join(self, run_id, run_fd, queue_fd, cancel_event):
+        """Wait for the queued run run_id to start and then finish; returns its result, or None"""
+        _wait_lock(queue_fd, fcntl.LOCK_SH, cancel_event)
+        fcntl.flock(queue_fd, fcntl.LOCK_UN)
+        while True:
+            _wait_lock(run_fd, fcntl.LOCK_SH, cancel_event)
+            fcntl.flock(run_fd, fcntl.LOCK_UN)
+            state = self._read(self.state_path)
+            if run_id in state.get("results", {}):
+                return state["results"][run_id]
+            if state.get("running", {}).get("id") != run_id and not self._queued(run_id):
+                return None  # it never ran (its process died while queued)
+            time.sleep(POLL_INTERVAL)
+
+    def _queued(self, run_id):
+        return self._read(self.queue_path).get("id") == run_id
+
+    def _record(self, run_id, result):
+        state = self._read(self.state_path)
+        results = state.get("results", {})
+        results[run_id] = dict(result, finished=time.time())
+        # Keep only the newest results; joiners read theirs straight after the run
+        state["results"] = dict(sorted(results.items(), key=lambda item: item[1]["finished"])[-KEEP_RESULTS:])
+        state.pop("running", None)
+        self._write(self.state_path, state)
+
+    def _update_state(self, **values):
+        state = self._read(self.state_path)
+        state.update(values)
+        self._write(self.state_path, state)
+
+    def _read(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, path, data):
+        atomic_write_json(path, data)
+
+    def _remove(self, path, run_id):
+        if self._read(path).get("id") == run_id:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def covers(queued, request):
+    """True if running the queued request also does everything request asks for"""
+    if queued.get("kind") != "backup" or request.get("kind") != "backup":
+        return False
+    if queued["repos"][0] != request["repos"][0] or not set(request["repos"]) <= set(queued["repos"]):
+        return False
+    if request.get("system") and not queued.get("system"):
+        return False
+    # A full scan of a folder covers any set of touched paths in it, but not the other way round
+    return not queued.get("touched") and set(request["folders"]) <= set(queued["folders"])
+
+
+def _try_lock(fd, mode):
+    try:
+        fcntl.flock(fd, mode | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _wait_lock(fd, mode, cancel_event=None):
+    """Block until the lock is held, checking cancel_event between attempts"""
+    while not _try_lock(fd, mode):
+        if cancel_event is not None and cancel_event.is_set():
+            raise InterruptedError("Cancelled while waiting for another backup run")
+        time.sleep(POLL_INTERVAL)
@@ -3,7 +3,12 @@ import os
 import sys
 import subprocess
 
-def setup_schedule(cron_schedule, script_path):
+# Scheduled runs go through the headless CLI, which skips the GUI and GitHub imports
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+# Percentage of the backup's bytes the weekly scrub downloads and re-hashes
+SCRUB_SAMPLE = 5
+
+def setup_schedule(cron_schedule, script_path=CLI_PATH):
     """Set up a scheduled backup using either cron or systemd"""
     # First try systemd (more modern)
     try:
@@ -26,7 +31,7 @@ After=network.target
 
 [Service]
 Type=oneshot
-ExecStart=/usr/bin/python3 {script_path}
+ExecStart=/usr/bin/python3 {script_path} backup --quiet --throttle --defer
 User={os.getenv('USER')}
 
 [Install]
@@ -60,6 +65,83 @@ WantedBy=timers.target
     subprocess.run(["systemctl", "--user", "enable", "autostash.timer"])
     subprocess.run(["systemctl", "--user", "start", "autostash.timer"])
 
+def setup_daemon(daemon_path):
+    """Run the continuous backup daemon as a systemd user service"""
+    service_content = f"""[Unit]
+Description=AutoStash Continuous Backup Daemon
+After=network-online.target
+
+[Service]
+Type=simple
+ExecStart=/usr/bin/python3 {daemon_path}
+Restart=on-failure
+RestartSec=30
+
+[Install]
+WantedBy=default.target
+"""
+
+    service_path = os.path.expanduser("~/.config/systemd/user/autostash-daemon.service")
+    os.makedirs(os.path.dirname(service_path), exist_ok=True)
+    with open(service_path, "w") as f:
+        f.write(service_content)
+
+    subprocess.run(["systemctl", "--user", "daemon-reload"])
+    result = subprocess.run(["systemctl", "--user", "enable", "--now", "autostash-daemon.service"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Failed to start daemon: {result.stderr.strip()}")
+
+def setup_maintenance(script_path=CLI_PATH):
+    """Run retention, repacking and a sampled scrub of the remote weekly, with systemd or else cron"""
+    service_content = f"""[Unit]
+Description=AutoStash Repository Maintenance
+After=network-online.target
+
+[Service]
+Type=oneshot
+ExecStart=/usr/bin/python3 {script_path} maintain
+ExecStart=-/usr/bin/python3 {script_path} verify --target remote --sample {SCRUB_SAMPLE}
+Nice=19
+IOSchedulingClass=idle
+"""
+
+    timer_content = """[Unit]
+Description=Thin and repack the AutoStash repository weekly
+
+[Timer]
+OnCalendar=Sun *-*-* 04:00:00
+Persistent=true
+RandomizedDelaySec=1h
+
+[Install]
+WantedBy=timers.target
+"""
+    try:
+        unit_dir = os.path.expanduser("~/.config/systemd/user")
+        os.makedirs(unit_dir, exist_ok=True)
+        with open(os.path.join(unit_dir, "autostash-maintain.service"), "w") as f:
+            f.write(service_content)
+        with open(os.path.join(unit_dir, "autostash-maintain.timer"), "w") as f:
+            f.write(timer_content)
+        subprocess.run(["systemctl", "--user", "daemon-reload"])
+        result = subprocess.run(["systemctl", "--user", "enable", "--now", "autostash-maintain.timer"],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(result.stderr.strip())
+        return "Maintenance scheduled with systemd"
+    except Exception:
+        from crontab import CronTab
+        cron = CronTab(user=True)
+        for job in cron.find_comment('AutoStash Maintenance'):
+            cron.remove(job)
+        job = cron.new(command=f'nice -n 19 /usr/bin/python3 {script_path} maintain; '
+                               f'nice -n 19 /usr/bin/python3 {script_path} verify --target remote --sample {SCRUB_SAMPLE}')
+        job.setall("0 4 * * 0")
+        job.set_comment('AutoStash Maintenance')
+        cron.write()
+        return "Maintenance scheduled with cron"
+
 def setup_cron(cron_schedule, script_path):
     """Set up backup with cron (works on all Linux systems)"""
     from crontab import CronTab
@@ -72,38 +154,14 @@ def setup_cron(cron_schedule, script_path):
         cron.remove(job)
     
     # Create new job
-    job = cron.new(command=f'/usr/bin/python3 {script_path}')
+    job = cron.new(command=f'/usr/bin/python3 {script_path} backup --quiet --throttle --defer')
     job.setall(cron_schedule)
     job.set_comment('AutoStash Backup')
     
     # Write to crontab
     cron.write()
 
-# If run directly (by scheduler)
+# If run directly (by timers installed before the CLI existed)
 if __name__ == "__main__":
-    # This allows the script to be called by cron/systemd
-    # It will perform backup with default options
-    from backup_logic import BackupManager
-    from config_manager import ConfigManager
-    import keyring
-    
-    # Load configuration
-    config = ConfigManager()
-    folders = config.get_folders()
-    
-    # Get GitHub token
-    token = keyring.get_password("autostash", "github_token")
-    if not token:
-        sys.exit("No GitHub token found")
-    
-    # Run backup
-    backup = BackupManager()
-    try:
-        backup.run(folders, "default_repo")
-    except Exception as e:
-        # Log error
-        with open(os.path.expanduser("~/.autostash/error.log"), "a") as f:
-            f.write(f"{datetime.datetime.now()}: {str(e)}\n")
-        sys.exit(1)
-
-
+    from cli import main
+    sys.exit(main(["backup", "--quiet", "--throttle", "--defer"]))
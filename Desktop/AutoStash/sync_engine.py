@@ -0,0 +1,143 @@
+import os
+from copy_engine import copy_file
+
+
+class SyncPlan:
+    """Per-file differences between a source tree and its staging copy"""
+
+    def __init__(self):
+        self.added = []
+        self.modified = []
+        self.deleted = []
+        self.renamed = []  # (old relative path, new relative path)
+
+    def is_empty(self):
+        return not (self.added or self.modified or self.deleted or self.renamed)
+
+
+class SyncStats:
+    """Counters describing what a sync actually did"""
+
+    def __init__(self):
+        self.added = 0
+        self.modified = 0
+        self.deleted = 0
+        self.renamed = 0
+        self.bytes_copied = 0
+        self.copy_methods = {}  # how each written file got there, e.g. {"reflink": 10}
+
+    def merge(self, other):
+        self.added += other.added
+        self.modified += other.modified
+        self.deleted += other.deleted
+        self.renamed += other.renamed
+        self.bytes_copied += other.bytes_copied
+        for method, count in other.copy_methods.items():
+            self.copy_methods[method] = self.copy_methods.get(method, 0) + count
+
+    def __str__(self):
+        text = (f"{self.added} added, {self.modified} modified, {self.deleted} deleted, "
+                f"{self.renamed} renamed, {self.bytes_copied} bytes copied")
+        if self.copy_methods:
+            methods = ", ".join(f"{method}: {count}" for method, count in sorted(self.copy_methods.items()))
+            text += f" ({methods})"
+        return text
+
+
+def diff_manifests(src_manifest, dest_manifest):
+    """Compare {relative path: digest} manifests and return a SyncPlan"""
+    plan = SyncPlan()
+    for rel, digest in src_manifest.items():
+        if rel not in dest_manifest:
+            plan.added.append(rel)
+        elif dest_manifest[rel] != digest:
+            plan.modified.append(rel)
+    removed = [rel for rel in dest_manifest if rel not in src_manifest]
+
+    # A removed file whose content reappears under a new name is a rename
+    removed_by_digest = {}
+    for rel in removed:
+        removed_by_digest.setdefault(dest_manifest[rel], []).append(rel)
+    still_added = []
+    for rel in plan.added:
+        candidates = removed_by_digest.get(src_manifest[rel])
+        if candidates:
+            plan.renamed.append((candidates.pop(), rel))
+        else:
+            still_added.append(rel)
+    plan.added = still_added
+    renamed_from = {old for old, _ in plan.renamed}
+    plan.deleted = [rel for rel in removed if rel not in renamed_from]
+    return plan
+
+
+def copy_writer(src_path, dest_root, rel):
+    """Default staging writer: a copy stored under the same relative path, made by the copy engine"""
+    dest_path = os.path.join(dest_root, rel)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    method = copy_file(src_path, dest_path)
+    return rel, os.path.getsize(dest_path), method
+
+
+def plan_bytes(plan, src_root):
+    """Bytes that applying plan will copy from src_root"""
+    return sum(os.path.getsize(os.path.join(src_root, rel)) for rel in plan.added + plan.modified)
+
+
+def apply_plan(plan, src_root, dest_root, src_manifest, index=None, writer=None, locations=None,
+               progress=None):
+    """Bring dest_root in line with src_root by applying only the planned operations
+
+    writer stores one source file in the staging tree and returns the relative
+    path it wrote, the bytes written and how it wrote them (counted in
+    stats.copy_methods). locations maps a logical relative
+    path to where it is stored, for writers that do not store files verbatim.
+    progress, if given, is credited with each copied file's size after it is
+    written, which is also where a cancelled sync stops.
+    """
+    writer = writer or copy_writer
+    locations = locations or {}
+    stats = SyncStats()
+    for rel in plan.deleted:
+        stored = locations.get(rel, rel)
+        os.remove(os.path.join(dest_root, stored))
+        _prune_empty_dirs(dest_root, os.path.dirname(stored))
+        stats.deleted += 1
+    for old, new in plan.renamed:
+        old_stored = locations.get(old, old)
+        new_stored = new + old_stored[len(old):]
+        dest_path = os.path.join(dest_root, new_stored)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(os.path.join(dest_root, old_stored), dest_path)
+        _prune_empty_dirs(dest_root, os.path.dirname(old_stored))
+        if index is not None and new_stored == new:
+            index.record(dest_path, src_manifest[new])
+        stats.renamed += 1
+    for kind, rels in (("added", plan.added), ("modified", plan.modified)):
+        for rel in rels:
+            src_path = os.path.join(src_root, rel)
+            stored, written, method = writer(src_path, dest_root, rel)
+            old_stored = locations.get(rel, stored)
+            if old_stored != stored:
+                # The file switched representation, e.g. it grew past the chunking threshold
+                os.remove(os.path.join(dest_root, old_stored))
+            stats.bytes_copied += written
+            stats.copy_methods[method] = stats.copy_methods.get(method, 0) + 1
+            setattr(stats, kind, getattr(stats, kind) + 1)
+            if index is not None and stored == rel:
+                # The copy is byte-identical, so index it without re-reading
+                index.record(os.path.join(dest_root, rel), src_manifest[rel])
+            if progress:
+                progress.advance(os.path.getsize(src_path))
+    return stats
+
+
+def _prune_empty_dirs(root, rel_dir):
+    """Remove now-empty parent directories of a deleted file, stopping at root"""
+    while rel_dir:
+        path = os.path.join(root, rel_dir)
+        try:
+            os.rmdir(path)
+        except OSError:
+            return
+        rel_dir = os.path.dirname(rel_dir)
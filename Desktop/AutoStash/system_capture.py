@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""Capture root-owned system files through one privileged helper per run.
+
+The unprivileged side sends the helper the configured paths and the stat
+signature of every file it already has. The helper, started once through
+`sudo -n`, walks the paths as root and streams back a tar of only the files
+whose signature changed, followed by a manifest of everything it saw. That
+keeps it to one sudo/exec per run and never re-reads unchanged config.
+
+To let scheduled runs use it without a password, allow exactly this command
+in sudoers, pointing at a root-owned copy of this file:
+
+    user ALL=(root) NOPASSWD: /usr/bin/python3 /opt/autostash/system_capture.py --helper
+
+(with folder_rules.py installed beside it). Only that installed copy,
+HELPER_PATH, is ever run through sudo; this file in the source tree is run
+unprivileged, so editing it gains nothing.
+
+Running as root, the helper does not trust the request: it only reads paths
+at or under those listed in the root-owned HELPER_POLICY (the default system
+paths without one) and checks every path against that policy's excludes as
+rules of their own, which no requested pattern (negated or not) can
+override, so the secrets in DEFAULT_SYSTEM_EXCLUDES stay out however
+it is called. A request for anything else is refused.
+"""
+import io
+import os
+import sys
+import json
+import stat
+import shutil
+import tarfile
+import tempfile
+import subprocess
+
+DEFAULT_SYSTEM_PATHS = ["/etc/fstab", "/etc/hosts", "/etc/passwd"]
+# Secrets that must never end up in a backup repository
+DEFAULT_SYSTEM_EXCLUDES = ["shadow", "shadow-", "gshadow", "gshadow-", "ssh_host_*_key", "**/ssl/private/"]
+SYSTEM_STATE = os.path.expanduser("~/.autostash/system_state.json")
+MANIFEST_NAME = ".autostash-manifest.json"
+META_NAME = ".autostash-meta.json"
+SPOOL_LIMIT = 8 * 1024 * 1024
+# The root-owned installed helper that sudoers allows, and the interpreter named there
+HELPER_PATH = "/opt/autostash/system_capture.py"
+HELPER_PYTHON = "/usr/bin/python3"
+# Root-owned {"paths": [...], "exclude": [...]} bounding what the privileged helper may read
+HELPER_POLICY = "/etc/autostash/system_capture.json"
+
+
+def signature(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+
+
+class SystemCapture:
+    """Keeps a copy of the system path set under dest_root, refreshed through the helper
+
+    Files land at dest_root/<absolute path>; owners and modes, which git does
+    not keep, are recorded in dest_root/.autostash-meta.json for restores.
+    """
+
+    def __init__(self, dest_root, paths=None, exclude=None, state_path=SYSTEM_STATE, logger=None,
+                 helper_path=HELPER_PATH):
+        self.dest_root = dest_root
+        self.helper_path = helper_path
+        self.paths = list(paths or DEFAULT_SYSTEM_PATHS)
+        self.exclude = list(DEFAULT_SYSTEM_EXCLUDES if exclude is None else exclude)
+        self.state_path = state_path
+        self.logger = logger
+        self.stats = {"sent": 0, "unchanged": 0, "deleted": 0, "unreadable": 0}
+
+    def capture(self):
+        """Bring dest_root up to date; returns self.stats"""
+        known = self._load_state()
+        # Only trust a signature while our copy still exists, or the file would never be sent again
+        known = {path: sig for path, sig in known.items() if os.path.lexists(self._dest(path))}
+        request = json.dumps({"paths": self.paths, "exclude": self.exclude, "known": known}).encode()
+
+        manifest = None
+        for command in self._helper_commands():
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            try:
+                proc.stdin.write(request)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass  # sudo refused before reading; handled below
+            try:
+                manifest = self._receive(proc.stdout)
+            except tarfile.ReadError:
+                manifest = None
+            stderr = proc.stderr.read().decode(errors="replace").strip()
+            if proc.wait() == 0 and manifest is not None:
+                break
+            if command[0] == "sudo":
+                self._log("warning", f"Privileged helper unavailable ({stderr or 'sudo failed'}); "
+                                     "capturing only files readable without it")
+        if manifest is None:
+            raise Exception(f"System file capture failed: {stderr}")
+
+        files = manifest["files"]
+        for path in manifest["unreadable"]:
+            self._log("warning", f"Permission denied for: {path}")
+            if path in known:
+                # Keep the copy we have rather than deleting it just because it could not be read this time
+                files[path] = known[path] + [None, None, None]
+        self.stats["unreadable"] = len(manifest["unreadable"])
+        self.stats["unchanged"] = len(files) - self.stats["sent"]
+        self._remove_missing(files)
+        self._write_meta(files)
+        self._save_state({path: entry[:4] for path, entry in files.items()})
+        return self.stats
+
+    def _helper_commands(self):
+        """The installed helper through sudo if there is one, then this file without privileges"""
+        helper = [sys.executable, os.path.abspath(__file__), "--helper"]
+        if os.geteuid() == 0 or not shutil.which("sudo"):
+            return [helper]
+        if not os.path.isfile(self.helper_path):
+            self._log("warning", f"Privileged helper not installed at {self.helper_path}; "
+                                 "capturing only files readable without it")
+            return [helper]
+        return [["sudo", "-n", HELPER_PYTHON, self.helper_path, "--helper"], helper]
+
+    def _receive(self, stream):
+        """Unpack the helper's tar stream into dest_root; returns its manifest"""
+        manifest = None
+        self.stats["sent"] = 0
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                if member.name == MANIFEST_NAME:
+                    manifest = json.load(tar.extractfile(member))
+                    continue
+                dest = self._dest("/" + member.name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(prefix=".autostash-", dir=os.path.dirname(dest))
+                os.close(fd)
+                if member.issym():
+                    os.remove(tmp_path)
+                    os.symlink(member.linkname, tmp_path)
+                else:
+                    with open(tmp_path, "wb") as out:
+                        shutil.copyfileobj(tar.extractfile(member), out)
+                    # Our copy must stay readable to us whatever the original's mode
+                    os.chmod(tmp_path, (member.mode & 0o777) | 0o600)
+                    os.utime(tmp_path, (member.mtime, member.mtime))
+                os.replace(tmp_path, dest)
+                self.stats["sent"] += 1
+        return manifest
+
+    def _dest(self, path):
+        rel = os.path.normpath(path).lstrip("/")
+        if rel.startswith(".."):
+            raise Exception(f"Refusing to write outside the capture directory: {path}")
+        return os.path.join(self.dest_root, rel)
+
+    def _remove_missing(self, files):
+        wanted = {self._dest(path) for path in files}
+        for dirpath, dirs, names in os.walk(self.dest_root, topdown=False):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if path not in wanted and not (dirpath == self.dest_root and name == META_NAME):
+                    os.remove(path)
+                    self.stats["deleted"] += 1
+            if dirpath != self.dest_root and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    def _write_meta(self, files):
+        meta = {path: {"mode": oct(entry[4]), "uid": entry[5], "gid": entry[6]}
+                for path, entry in sorted(files.items()) if entry[4] is not None}
+        os.makedirs(self.dest_root, exist_ok=True)
+        meta_path = os.path.join(self.dest_root, META_NAME)
+        text = json.dumps(meta, indent=1, sort_keys=True) + "\n"
+        try:
+            with open(meta_path, "r") as f:
+                if f.read() == text:
+                    return
+        except OSError:
+            pass
+        with open(meta_path, "w") as f:
+            f.write(text)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Signatures describe the copies in one capture directory only
+        return state.get("files", {}) if state.get("dest_root") == self.dest_root else {}
+
+    def _save_state(self, state):
+        # Imported here: the installed privileged helper needs only this file and folder_rules.py
+        from atomic_file import atomic_write_json
+        atomic_write_json(self.state_path, {"dest_root": self.dest_root, "files": state})
+
+    def _log(self, level, message):
+        if self.logger:
+            getattr(self.logger, level)(message)
+
+
+def run_helper(stdin, stdout):
+    """Privileged side: walk the requested paths and stream changed files plus a manifest as tar"""
+    from folder_rules import FolderRules
+
+    request = json.load(stdin)
+    known = request["known"]
+    paths = request["paths"]
+    rules = [FolderRules(exclude=request["exclude"])]
+    if os.geteuid() == 0:
+        paths, denied = _enforce_policy(paths)
+        rules.append(FolderRules(exclude=denied))
+    files, unreadable = {}, []
+    with tarfile.open(fileobj=stdout, mode="w|") as tar:
+        for path in _walk_paths(paths, rules):
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                continue
+            entry = signature(st) + [stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid]
+            if known.get(path) != entry[:4]:
+                try:
+                    _send(tar, path, st)
+                except OSError:
+                    unreadable.append(path)
+                    continue
+            files[path] = entry
+        data = json.dumps({"files": files, "unreadable": unreadable}).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def load_policy(path=HELPER_POLICY):
+    """(allowed paths, excludes) for the privileged helper; the defaults when there is no policy file
+
+    A policy file that root does not own, or that others can write, is refused.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return list(DEFAULT_SYSTEM_PATHS), list(DEFAULT_SYSTEM_EXCLUDES)
+    if st.st_uid != 0 or st.st_mode & 0o022:
+        raise Exception(f"{path} must be owned by root and writable only by root")
+    with open(path, "r") as f:
+        policy = json.load(f)
+    return list(policy.get("paths", DEFAULT_SYSTEM_PATHS)), list(policy.get("exclude", DEFAULT_SYSTEM_EXCLUDES))
+
+
+def _enforce_policy(paths):
+    """(requested paths, policy excludes) once every path is checked against the root-owned policy
+
+    The excludes are returned on their own so they are applied as separate
+    rules, which no pattern in the request can negate.
+    """
+    allowed, denied = load_policy()
+    allowed = [os.path.normpath(os.path.abspath(path)) for path in allowed]
+    requested = [os.path.normpath(os.path.abspath(path)) for path in paths]
+    refused = [path for path in requested
+               if not any(path == top or path.startswith(top.rstrip("/") + "/") for top in allowed)]
+    if refused:
+        raise Exception(f"Refusing paths outside {HELPER_POLICY}: {', '.join(refused)}")
+    return requested, denied
+
+
+def _walk_paths(paths, rules):
+    """Files under paths that every FolderRules in rules keeps"""
+    for top in paths:
+        top = os.path.abspath(top)
+        if not os.path.isdir(top) or os.path.islink(top):
+            if all(r.keep_path(top.lstrip("/")) for r in rules):
+                yield top
+            continue
+        if not all(r.keep_path(top.lstrip("/"), is_dir=True) for r in rules):
+            continue
+        for dirpath, dirs, names in os.walk(top):
+            rel_dir = dirpath.lstrip("/")
+            dirs[:] = sorted(d for d in dirs if not any(r.prune_dir(f"{rel_dir}/{d}") for r in rules))
+            for name in sorted(names):
+                if all(r.keep_file(f"{rel_dir}/{name}", 0) for r in rules):
+                    yield os.path.join(dirpath, name)
+
+
+def _send(tar, path, st):
+    """Add one file; it is spooled first so a file changing mid-read cannot corrupt the stream"""
+    info = tarfile.TarInfo(path.lstrip("/"))
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = st.st_mtime
+    if stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+        tar.addfile(info)
+        return
+    with open(path, "rb") as f, tempfile.SpooledTemporaryFile(SPOOL_LIMIT) as spool:
+        shutil.copyfileobj(f, spool)
+        info.size = spool.tell()
+        spool.seek(0)
+        tar.addfile(info, spool)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--helper"]:
+        try:
+            run_helper(sys.stdin, sys.stdout.buffer)
+        except Exception as e:
+            sys.exit(f"system_capture helper: {e}")
+    else:
+        sys.exit("Usage: system_capture.py --helper (started by AutoStash, reads a JSON request on stdin)")
@@ -0,0 +1,17 @@
+"""Import-time regression tests for the CLI (see benchmark_startup.py)"""
+import statistics
+
+import pytest
+
+from benchmark_startup import BUDGET, FORBIDDEN, measure
+
+
+@pytest.mark.parametrize("command", ["status", "history"])
+def test_startup_avoids_heavy_imports(command):
+    times, modules = measure(command, runs=1)
+    assert sorted(name for name in FORBIDDEN if name in modules) == []
+
+
+def test_status_starts_within_budget():
+    times, modules = measure("status", runs=5)
+    assert statistics.median(times) <= BUDGET
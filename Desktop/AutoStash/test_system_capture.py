@@ -0,0 +1,32 @@
+"""The privileged helper's root-owned policy cannot be loosened by the request"""
+import io
+import json
+import tarfile
+
+import system_capture
+from system_capture import DEFAULT_SYSTEM_EXCLUDES, MANIFEST_NAME, run_helper
+
+
+def _capture(tmp_path, monkeypatch, exclude):
+    etc = tmp_path / "etc"
+    (etc / "ssl" / "private").mkdir(parents=True)
+    (etc / "hosts").write_text("127.0.0.1 localhost\n")
+    (etc / "shadow").write_text("root:secret\n")
+    (etc / "ssl" / "private" / "server.key").write_text("KEY\n")
+    monkeypatch.setattr(system_capture.os, "geteuid", lambda: 0)
+    monkeypatch.setattr(system_capture, "load_policy", lambda: ([str(etc)], list(DEFAULT_SYSTEM_EXCLUDES)))
+    request = json.dumps({"paths": [str(etc)], "exclude": exclude, "known": {}})
+    out = io.BytesIO()
+    run_helper(io.StringIO(request), out)
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r|") as tar:
+        names = {member.name for member in tar if member.name != MANIFEST_NAME}
+    return {name.rsplit("etc/", 1)[1] for name in names}
+
+
+def test_negated_caller_excludes_cannot_include_denied_paths(tmp_path, monkeypatch):
+    assert _capture(tmp_path, monkeypatch, ["!shadow", "!**/ssl/private/"]) == {"hosts"}
+
+
+def test_caller_excludes_still_apply(tmp_path, monkeypatch):
+    assert _capture(tmp_path, monkeypatch, ["hosts"]) == set()
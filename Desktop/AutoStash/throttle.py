@@ -0,0 +1,130 @@
+"""Keeping backups from slowing the machine down.
+
+ResourceLimits bundles the knobs for a resource-governed run: CPU nice and
+I/O scheduling class for the backup worker, a cap on how fast files are read
+for hashing and copying, and a cap on push bandwidth. Every knob defaults to
+off, so an unconfigured run behaves exactly as before.
+"""
+import os
+import time
+import ctypes
+import shutil
+import platform
+import threading
+
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set has no libc wrapper, so it is called by syscall number
+SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "riscv64": 30, "i686": 289, "armv7l": 314, "ppc64le": 273}
+
+GOVERNED_NICE = 10
+GOVERNED_IO_CLASS = "idle"
+
+
+class RateLimiter:
+    """Token bucket shared by every thread reading files for one run
+
+    consume() may take more than is in the bucket; the caller then sleeps
+    off the debt, so large files are paced as well as small ones.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ResourceLimits:
+    """nice and io_class apply to the thread that runs the backup and everything it starts
+
+    read_rate (bytes/s) caps file reads for hashing and staging copies;
+    push_rate (bytes/s) caps uploads and needs `trickle`, since git has no
+    bandwidth limit of its own.
+    """
+
+    def __init__(self, nice=None, io_class=None, read_rate=None, push_rate=None):
+        if io_class is not None and io_class not in IOPRIO_CLASSES:
+            raise Exception(f"Unknown I/O class {io_class!r}; expected one of {', '.join(IOPRIO_CLASSES)}")
+        self.nice = nice
+        self.io_class = io_class
+        self.read_rate = read_rate
+        self.push_rate = push_rate
+        self._warned = False
+
+    @classmethod
+    def governed(cls, read_rate=None, push_rate=None):
+        """Background priority for CPU and disk, plus whichever caps are given"""
+        return cls(GOVERNED_NICE, GOVERNED_IO_CLASS, read_rate, push_rate)
+
+    def to_config(self):
+        return {"nice": self.nice, "io_class": self.io_class, "read_rate": self.read_rate,
+                "push_rate": self.push_rate}
+
+    @classmethod
+    def from_config(cls, data):
+        return cls(**(data or {}))
+
+    def apply_priority(self, logger=None):
+        """Lower the calling thread's CPU and I/O priority; never raises
+
+        On Linux both are per thread and inherited by threads and processes
+        started afterwards, so a GUI-triggered run does not slow the GUI.
+        Priority is only ever lowered, which needs no privileges.
+        """
+        if self.nice is not None:
+            try:
+                current = os.getpriority(os.PRIO_PROCESS, 0)
+                if self.nice > current:
+                    os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+            except OSError as e:
+                _log(logger, "warning", f"Could not lower CPU priority: {str(e)}")
+        if self.io_class is not None:
+            try:
+                _set_io_class(self.io_class)
+            except OSError as e:
+                _log(logger, "warning", f"Could not set I/O priority: {str(e)}")
+
+    def read_limiter(self):
+        return RateLimiter(self.read_rate) if self.read_rate else None
+
+    def push_wrapper(self, logger=None):
+        """Command prefix that caps a git push at push_rate, or [] when there is no cap (or no way to apply it)"""
+        if not self.push_rate:
+            return []
+        trickle = shutil.which("trickle")
+        if not trickle:
+            if not self._warned:
+                _log(logger, "warning", "Push bandwidth cap is set but trickle is not installed; pushing uncapped")
+                self._warned = True
+            return []
+        return [trickle, "-s", "-u", str(max(1, int(self.push_rate // 1024)))]
+
+
+def _set_io_class(io_class):
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(f"ioprio_set is not known on {platform.machine()}")
+    libc = ctypes.CDLL(None, use_errno=True)
+    # Level 7 is the lowest within the best-effort class and ignored by the others
+    value = (IOPRIO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT) | 7
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def _log(logger, level, message):
+    if logger:
+        getattr(logger, level)(message)
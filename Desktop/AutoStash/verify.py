@@ -0,0 +1,628 @@
+"""Checking that backups can be read back intact.
+
+Every staged backup records, per folder, a manifest under MANIFEST_DIR in
+the repository: one line per file with its git blob digest, size and path,
+sorted so an unchanged folder gives an unchanged manifest (and encrypted
+like everything else in encrypted mode). Verifier compares a restore, the
+staging tree or the remote's newest commit with those manifests and reports
+files that are missing, extra or corrupt.
+
+Missing and extra files only need a listing, so they are always checked in
+full. Re-hashing is what costs, so it can be limited to a random sample of
+files holding a given share of the bytes; scrubs with different seeds
+eventually cover everything. Against the remote, a blob-less clone fetches
+the tree and then only the sampled blobs, so a 5% scrub downloads about 5%.
+
+Small files kept in directory packs (see pack_store.py) are listed from the
+pack indexes and re-hashed from their slice of the pack.
+
+Direct-ingest backups record no manifest: their trees hold plain blobs whose
+ids are the digests, so those are checked against the commit itself.
+"""
+import os
+import json
+import random
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from chunk_store import MANIFEST_SUFFIX, STORE_DIR, is_manifest
+from encryption import ENCRYPTED_SUFFIX, KEY_FILE, is_encrypted
+from file_index import git_blob_digest
+from pack_store import PACK_NAME, PACK_INDEX, blob_digest, is_pack, read_entry, read_index
+
+MANIFEST_DIR = ".autostash-verify"
+MANIFEST_EXT = ".txt"
+# Top-level entries of a backup tree that are bookkeeping rather than backed-up files
+SKIP_TOP = {".git", MANIFEST_DIR, STORE_DIR, KEY_FILE}
+FETCH_BATCH = 500
+READ_BLOCK = 1024 * 1024
+
+
+def manifest_name(folder_name, encrypted=False):
+    return folder_name + MANIFEST_EXT + (ENCRYPTED_SUFFIX if encrypted else "")
+
+
+def format_manifest(entries):
+    """Serialise {relative path: (digest, size)}; paths are JSON-quoted so any name survives"""
+    return "".join(f"{digest} {size} {json.dumps(rel)}\n"
+                   for rel, (digest, size) in sorted(entries.items())).encode()
+
+
+def parse_manifest(data):
+    entries = {}
+    for line in data.decode().splitlines():
+        if line:
+            digest, size, rel = line.split(" ", 2)
+            # Most names need no unescaping, and skipping json.loads for them halves the parse time
+            entries[rel[1:-1] if "\\" not in rel else json.loads(rel)] = (digest, int(size))
+    return entries
+
+
+def write_manifest(repo_root, folder_name, entries, cipher=None):
+    """Store folder_name's manifest in the repository, encrypted when cipher is given"""
+    directory = os.path.join(repo_root, MANIFEST_DIR)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, manifest_name(folder_name, cipher is not None))
+    data = format_manifest(entries)
+    if cipher:
+        cipher.encrypt_bytes(data, path)
+    else:
+        fd, tmp_path = tempfile.mkstemp(prefix=".manifest-", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    # A manifest left in the other form would describe the folder twice
+    _remove(os.path.join(directory, manifest_name(folder_name, cipher is None)))
+
+
+def read_manifest(repo_root, folder_name, cipher=None):
+    """folder_name's manifest in the form the current mode writes, or None if there is none"""
+    path = os.path.join(repo_root, MANIFEST_DIR, manifest_name(folder_name, cipher is not None))
+    if not os.path.exists(path):
+        return None
+    if cipher:
+        return parse_manifest(cipher.read_bytes(path))
+    with open(path, "rb") as f:
+        return parse_manifest(f.read())
+
+
+def discard_manifest(repo_root, folder_name):
+    for encrypted in (False, True):
+        _remove(os.path.join(repo_root, MANIFEST_DIR, manifest_name(folder_name, encrypted)))
+
+
+def replace_subtree(entries, rel, subtree):
+    """Drop the entries at or under rel (a file or directory; "" for all) and add subtree's"""
+    if not rel:
+        entries.clear()
+    else:
+        prefix = rel + "/"
+        for path in [path for path in entries if path == rel or path.startswith(prefix)]:
+            del entries[path]
+    entries.update(subtree)
+
+
+def choose_sample(sizes, percent, seed=None):
+    """Random set of paths from {path: size} holding about percent of the bytes"""
+    if percent >= 100:
+        return set(sizes)
+    if not any(sizes.values()):
+        # Sizes unknown (a direct-ingest tree seen from the remote): sample by file count instead
+        sizes = dict.fromkeys(sizes, 1)
+    paths = sorted(sizes)
+    random.Random(seed).shuffle(paths)
+    target = sum(sizes.values()) * percent / 100
+    chosen, total = set(), 0
+    for path in paths:
+        if total >= target:
+            break
+        chosen.add(path)
+        total += sizes[path]
+    return chosen
+
+
+def logical_path(stored):
+    """The path of the file a stored name stands for (packs stand for several and are listed separately)"""
+    for suffix in (ENCRYPTED_SUFFIX, MANIFEST_SUFFIX):
+        if stored.endswith(suffix):
+            return stored[:-len(suffix)]
+    return stored
+
+
+class VerifyReport:
+    """What a verification found; ok is True when nothing is missing, extra or corrupt"""
+
+    def __init__(self, target, sample, seed):
+        self.target = target
+        self.sample = sample
+        self.seed = seed
+        self.missing = []
+        self.extra = []
+        self.corrupt = []  # (path, reason)
+        self.unverified = []  # top-level folders with no manifest to check against
+        self.files = 0
+        self.bytes = 0
+        self.checked_files = 0
+        self.checked_bytes = 0
+
+    @property
+    def ok(self):
+        return not (self.missing or self.extra or self.corrupt)
+
+    def summary(self):
+        text = (f"{self.target}: {self.files} files ({self.bytes / 1024 / 1024:.1f} MiB), "
+                f"re-hashed {self.checked_files} ({self.checked_bytes / 1024 / 1024:.1f} MiB"
+                + (f", {self.sample:g}% sample, seed {self.seed}" if self.sample < 100 else "") + "); "
+                f"{len(self.missing)} missing, {len(self.extra)} extra, {len(self.corrupt)} corrupt")
+        if self.unverified:
+            text += f"; no manifest for {', '.join(self.unverified)}"
+        return text
+
+    def problems(self):
+        """One line per problem found"""
+        for path in self.missing:
+            yield f"missing  {path}"
+        for path in self.extra:
+            yield f"extra    {path}"
+        for path, reason in self.corrupt:
+            yield f"corrupt  {path}: {reason}"
+
+    def to_dict(self):
+        return {"target": self.target, "sample": self.sample, "seed": self.seed, "files": self.files,
+                "bytes": self.bytes, "checked_files": self.checked_files, "checked_bytes": self.checked_bytes,
+                "missing": self.missing, "extra": self.extra, "corrupt": self.corrupt,
+                "unverified": self.unverified}
+
+
+class Verifier:
+    """Re-hashes backed-up files on a pool of workers and compares them with what was recorded
+
+    sample is the percentage of bytes to re-hash (100 checks everything);
+    seed makes the sample reproducible and is drawn at random when None.
+    """
+
+    def __init__(self, workers=None, sample=100, seed=None, logger=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.sample = sample
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.logger = logger
+        self.cipher = None
+        self._lock = threading.Lock()
+        self._packs = {}  # remote pack path: {name: digest, or the error reading it}
+        self._pack_locks = {}
+
+    def close(self):
+        if self.cipher:
+            self.cipher.close()
+            self.cipher = None
+
+    def verify_tree(self, root, paths=None):
+        """Check a restore directory or the staging checkout; paths limits it to some subtrees"""
+        if not os.path.isdir(root):
+            raise Exception(f"{root} does not exist")
+        stored, packed = self._list_tree(root)
+        manifests = self._tree_manifests(root)
+        if manifests:
+            expected = _flatten(manifests)
+        else:
+            expected = self._expected_from_tree(root)
+        report = VerifyReport(root, self.sample, self.seed)
+        present = self._compare(report, expected, stored, set(manifests) or None, paths)
+
+        # A plain file of the wrong size is corrupt without reading it
+        candidates = {}
+        for path, name in present.items():
+            digest, size = expected[path]
+            if name == path and size is not None and os.path.getsize(os.path.join(root, name)) != size:
+                report.corrupt.append((path, f"size is {os.path.getsize(os.path.join(root, name))}, expected {size}"))
+            else:
+                candidates[path] = size if size is not None else os.path.getsize(os.path.join(root, name))
+
+        def check(path):
+            if path in packed:
+                return path, blob_digest(read_entry(os.path.join(root, present[path]), packed[path]))
+            return path, self._tree_digest(root, present[path])
+        self._check_sample(report, candidates, expected, check)
+        return report
+
+    def verify_remote(self, repo_url, commit="HEAD"):
+        """Check the remote's commit by downloading its tree and only the sampled blobs
+
+        repo_url must be a URL git can clone with a filter, so local
+        repositories need a file:// URL.
+        """
+        work_dir = tempfile.mkdtemp(prefix="verify-", dir=_state_dir())
+        self._packs, self._pack_locks = {}, {}
+        try:
+            git = _Git(work_dir)
+            result = subprocess.run(["git", "clone", "-q", "--bare", "--depth", "1", "--filter=blob:none",
+                                     "--no-tags", repo_url, work_dir], capture_output=True)
+            if result.returncode != 0:
+                raise Exception(f"Cloning {repo_url} failed: {result.stderr.decode(errors='replace').strip()}")
+            if commit != "HEAD":
+                git.run("fetch", "-q", "--depth", "1", "origin", commit)
+                commit = "FETCH_HEAD"
+            tree = git.tree(commit)
+            manifest_paths = [path for path in tree if path.startswith(MANIFEST_DIR + "/")]
+            index_paths = [path for path in tree if os.path.basename(path) == PACK_INDEX]
+            git.prefetch([tree[path] for path in manifest_paths + index_paths + [KEY_FILE] if path in tree])
+
+            reader = _BlobReader(work_dir)
+            try:
+                wrapped = lambda: reader.read(tree[KEY_FILE])
+                manifests = {}
+                for path in manifest_paths:
+                    name = os.path.basename(path)
+                    if is_encrypted(name):
+                        data = self._decrypt_blob(reader, tree[path], work_dir, wrapped, whole=True)
+                        name = name[:-len(ENCRYPTED_SUFFIX)]
+                    else:
+                        data = reader.read(tree[path])
+                    if name.endswith(MANIFEST_EXT):
+                        manifests[name[:-len(MANIFEST_EXT)]] = parse_manifest(data)
+                indexes = {path: json.loads(reader.read(tree[path]))["files"] for path in index_paths}
+            finally:
+                reader.close()
+
+            stored = {logical_path(path): path for path in tree
+                      if path.split("/", 1)[0] not in SKIP_TOP and not is_pack(path)}
+            packed = {}  # {logical path: (pack path, name in the pack)}
+            for index_path, files in indexes.items():
+                directory = os.path.dirname(index_path)
+                for member in files:
+                    path = os.path.join(directory, member)
+                    stored[path] = os.path.join(directory, PACK_NAME)
+                    packed[path] = (stored[path], member)
+            if manifests:
+                expected = _flatten(manifests)
+            else:
+                expected = _plain_expected(tree, stored)
+            report = VerifyReport(repo_url, self.sample, self.seed)
+            present = self._compare(report, expected, stored, set(manifests) or None, None)
+
+            candidates = {path: expected[path][1] or 0 for path in present}
+            sampled = choose_sample(candidates, self.sample, self.seed)
+            needed = set()
+            for path in sampled:
+                if present[path] in tree:
+                    needed.add(tree[present[path]])
+            git.prefetch(sorted(needed))
+            # Chunk lists are only known once the sampled manifests are here
+            chunk_oids = set()
+            reader = _BlobReader(work_dir)
+            try:
+                for path in sampled:
+                    if is_manifest(present[path]):
+                        try:
+                            for digest, length in json.loads(reader.read(tree[present[path]]))["chunks"]:
+                                chunk = f"{STORE_DIR}/{digest[:2]}/{digest[2:]}"
+                                if chunk in tree:
+                                    chunk_oids.add(tree[chunk])
+                        except Exception:
+                            pass  # reported when the file itself is checked
+            finally:
+                reader.close()
+            git.prefetch(sorted(chunk_oids))
+
+            readers = threading.local()
+            opened = []
+
+            def check(path):
+                if not hasattr(readers, "reader"):
+                    readers.reader = _BlobReader(work_dir)
+                    with self._lock:
+                        opened.append(readers.reader)
+                if path in packed:
+                    pack, member = packed[path]
+                    return path, self._packed_digest(readers.reader, tree, pack, member, indexes, work_dir)
+                return path, self._remote_digest(readers.reader, tree, present[path], work_dir, wrapped)
+            try:
+                self._check_sample(report, candidates, expected, check, sampled)
+            finally:
+                for reader in opened:
+                    reader.close()
+            return report
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _compare(self, report, expected, stored, covered, paths):
+        """Fill in missing, extra and the totals; returns {logical path: stored path} of files present"""
+        def wanted(path):
+            if covered is not None and path.split("/", 1)[0] not in covered:
+                return False
+            return not paths or any(path == p or path.startswith(p.rstrip("/") + "/") for p in paths)
+
+        present = {}
+        unverified = set()
+        for path, name in stored.items():
+            if covered is not None and path.split("/", 1)[0] not in covered:
+                if "/" in path:
+                    unverified.add(path.split("/", 1)[0])
+            elif wanted(path):
+                present[path] = name
+        expected_paths = [path for path in expected if wanted(path)]
+        report.missing = sorted(path for path in expected_paths if path not in present)
+        report.extra = sorted(path for path in present if path not in expected)
+        for path in report.extra:
+            del present[path]
+        report.unverified = sorted(unverified)
+        report.files = len(expected_paths)
+        report.bytes = sum(expected[path][1] or 0 for path in expected_paths)
+        return present
+
+    def _check_sample(self, report, candidates, expected, check, sampled=None):
+        """Re-hash the sampled candidates in parallel and record the ones that differ"""
+        if sampled is None:
+            sampled = choose_sample(candidates, self.sample, self.seed)
+
+        def safe(path):
+            try:
+                return check(path)
+            except Exception as e:
+                return path, e
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for path, digest in executor.map(safe, sorted(sampled)):
+                report.checked_files += 1
+                report.checked_bytes += candidates[path]
+                if isinstance(digest, Exception):
+                    report.corrupt.append((path, str(digest)))
+                elif digest != expected[path][0]:
+                    report.corrupt.append((path, f"content digest {digest} does not match {expected[path][0]}"))
+        report.corrupt.sort()
+        if self.logger:
+            self.logger.info(f"Verified {report.summary()}")
+
+    def _list_tree(self, root):
+        """({logical path: stored path}, {packed path: index entry}) for the files under root
+
+        Bookkeeping entries are skipped; a packed file's stored path is its pack.
+        """
+        stored = {}
+        packed = {}
+        for dirpath, dirs, names in os.walk(root):
+            if dirpath == root:
+                dirs[:] = [d for d in dirs if d not in SKIP_TOP]
+                names = [name for name in names if name not in SKIP_TOP]
+            for name in names:
+                rel = os.path.relpath(os.path.join(dirpath, name), root)
+                if name == PACK_INDEX:
+                    directory = os.path.dirname(rel)
+                    for member, entry in read_index(os.path.join(dirpath, name)).items():
+                        path = os.path.join(directory, member)
+                        stored[path] = os.path.join(directory, PACK_NAME)
+                        packed[path] = entry
+                elif not is_pack(name):
+                    stored[logical_path(rel)] = rel
+        return stored, packed
+
+    def _tree_manifests(self, root):
+        directory = os.path.join(root, MANIFEST_DIR)
+        manifests = {}
+        if not os.path.isdir(directory):
+            return manifests
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if is_encrypted(name):
+                data = self._cipher(lambda: _read(os.path.join(root, KEY_FILE))).read_bytes(path)
+                name = name[:-len(ENCRYPTED_SUFFIX)]
+            else:
+                data = _read(path)
+            if name.endswith(MANIFEST_EXT):
+                manifests[name[:-len(MANIFEST_EXT)]] = parse_manifest(data)
+        return manifests
+
+    def _expected_from_tree(self, root):
+        """Expected digests of a checkout with no manifest: the blob ids in its HEAD commit"""
+        if not os.path.isdir(os.path.join(root, ".git")):
+            raise Exception(f"{root} has no verification manifest and is not a git checkout")
+        return _plain_expected(_Git(os.path.join(root, ".git")).tree("HEAD"), None)
+
+    def _tree_digest(self, root, name):
+        path = os.path.join(root, name)
+        if is_encrypted(name):
+            return self._cipher(lambda: _read(os.path.join(root, KEY_FILE))).digest_file(path, parallel=False)
+        if is_manifest(name):
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            digest = hashlib.sha1(f"blob {manifest['size']}\0".encode())
+            for chunk, length in manifest["chunks"]:
+                chunk_path = os.path.join(root, STORE_DIR, chunk[:2], chunk[2:])
+                if not os.path.exists(chunk_path):
+                    raise Exception(f"chunk {chunk} is missing")
+                data = _read(chunk_path)
+                if len(data) != length or hashlib.sha256(data).hexdigest() != chunk:
+                    raise Exception(f"chunk {chunk} is corrupt")
+                digest.update(data)
+            return digest.hexdigest()
+        return git_blob_digest(path, os.path.getsize(path))
+
+    def _remote_digest(self, reader, tree, name, work_dir, wrapped):
+        """Content digest of the file stored as name, checking every object read against its id"""
+        oid = tree[name]
+        if is_encrypted(name):
+            return self._decrypt_blob(reader, oid, work_dir, wrapped)
+        if is_manifest(name):
+            manifest = json.loads(reader.read(oid))
+            digest = hashlib.sha1(f"blob {manifest['size']}\0".encode())
+            for chunk, length in manifest["chunks"]:
+                chunk_path = f"{STORE_DIR}/{chunk[:2]}/{chunk[2:]}"
+                if chunk_path not in tree:
+                    raise Exception(f"chunk {chunk} is missing")
+                chunk_digest = hashlib.sha256()
+                reader.stream(tree[chunk_path], lambda data: (chunk_digest.update(data), digest.update(data)))
+                if chunk_digest.hexdigest() != chunk:
+                    raise Exception(f"chunk {chunk} is corrupt")
+            return digest.hexdigest()
+        reader.stream(oid, lambda data: None)
+        return oid
+
+    def _packed_digest(self, reader, tree, pack, member, indexes, work_dir):
+        """Content digest of one file in a remote pack; the pack is read once however many are sampled"""
+        with self._lock:
+            lock = self._pack_locks.setdefault(pack, threading.Lock())
+        with lock:
+            if pack not in self._packs:
+                if pack not in tree:
+                    raise Exception(f"pack {pack} is missing")
+                digests = {}
+                with tempfile.NamedTemporaryFile(dir=work_dir) as tmp:
+                    reader.stream(tree[pack], tmp.write)
+                    tmp.flush()
+                    for name, entry in indexes[os.path.join(os.path.dirname(pack), PACK_INDEX)].items():
+                        try:
+                            digests[name] = blob_digest(read_entry(tmp.name, entry))
+                        except Exception as e:
+                            digests[name] = e
+                self._packs[pack] = digests
+        digest = self._packs[pack][member]
+        if isinstance(digest, Exception):
+            raise digest
+        return digest
+
+    def _decrypt_blob(self, reader, oid, work_dir, wrapped, whole=False):
+        """Digest (or, with whole, the content) of an encrypted blob, via a temporary file"""
+        cipher = self._cipher(wrapped)
+        with tempfile.NamedTemporaryFile(dir=work_dir) as tmp:
+            reader.stream(oid, tmp.write)
+            tmp.flush()
+            return cipher.read_bytes(tmp.name) if whole else cipher.digest_file(tmp.name, parallel=False)
+
+    def _cipher(self, wrapped_key):
+        """FileCipher for the repository's data key; wrapped_key() returns the KEY_FILE contents"""
+        with self._lock:
+            if self.cipher is None:
+                from encryption import FileCipher, unwrap_key
+                self.cipher = FileCipher(unwrap_key(wrapped_key()))
+            return self.cipher
+
+
+class _Git:
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+
+    def run(self, *args, input=None):
+        result = subprocess.run(["git", "--git-dir", self.git_dir, *args], input=input, capture_output=True)
+        if result.returncode != 0:
+            raise Exception(f"git {args[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
+
+    def tree(self, commit):
+        """{path: blob id} for every file in commit"""
+        entries = {}
+        for record in self.run("ls-tree", "-r", "-z", "--full-tree", commit).split(b"\0"):
+            if record:
+                meta, path = record.split(b"\t", 1)
+                mode, kind, oid = meta.decode().split(" ")
+                if kind == "blob":
+                    entries[os.fsdecode(path)] = oid
+        return entries
+
+    def prefetch(self, oids):
+        """Download the given blobs in a few round trips instead of one lazy fetch each"""
+        for start in range(0, len(oids), FETCH_BATCH):
+            batch = "".join(oid + "\n" for oid in oids[start:start + FETCH_BATCH]).encode()
+            if not self._fetch(batch) and len(oids[start:start + FETCH_BATCH]) > 1:
+                # One bad object fails the whole batch, so get the others one at a time
+                for oid in oids[start:start + FETCH_BATCH]:
+                    self._fetch(oid.encode() + b"\n")
+
+    def _fetch(self, oid_lines):
+        """The fetch git itself runs for objects missing from a partial clone; False if it failed"""
+        try:
+            self.run("-c", "fetch.negotiationAlgorithm=noop", "fetch", "-q", "origin", "--no-tags",
+                     "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin",
+                     input=oid_lines)
+            return True
+        except Exception:
+            return False
+
+
+class _BlobReader:
+    """One `git cat-file --batch` process; blobs are streamed through, never held whole"""
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._start()
+
+    def _start(self):
+        self.proc = subprocess.Popen(["git", "--git-dir", self.git_dir, "cat-file", "--batch"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def stream(self, oid, sink):
+        """Feed blob oid to sink block by block, checking the content against the id"""
+        try:
+            self.proc.stdin.write(oid.encode() + b"\n")
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+        except BrokenPipeError:
+            header = []
+        if len(header) < 3:
+            if not header:
+                # cat-file exits when it cannot fetch a missing object; start another for the next one
+                self.close()
+                self._start()
+            raise Exception(f"object {oid} could not be read from the remote")
+        remaining = int(header[2])
+        digest = hashlib.sha1(f"blob {remaining}\0".encode())
+        while remaining:
+            data = self.proc.stdout.read(min(remaining, READ_BLOCK))
+            if not data:
+                raise Exception(f"git cat-file stopped while reading {oid}")
+            digest.update(data)
+            sink(data)
+            remaining -= len(data)
+        self.proc.stdout.read(1)
+        if digest.hexdigest() != oid:
+            raise Exception(f"object {oid} does not match its id")
+
+    def read(self, oid):
+        parts = []
+        self.stream(oid, parts.append)
+        return b"".join(parts)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+def _flatten(manifests):
+    return {f"{name}/{rel}": value for name, entries in manifests.items() for rel, value in entries.items()}
+
+
+def _plain_expected(tree, stored):
+    """Expected digests from a tree of plain blobs; other stored forms need a manifest"""
+    expected = {}
+    for path, oid in tree.items():
+        if path.split("/", 1)[0] in SKIP_TOP:
+            continue
+        if logical_path(path) != path or is_pack(path):
+            raise Exception("This backup stores chunked, encrypted or packed files but no verification manifest; "
+                            "run a backup to record one")
+        expected[path] = (oid, None)
+    return expected
+
+
+def _state_dir():
+    directory = os.path.expanduser("~/.autostash")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass